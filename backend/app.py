@@ -4,23 +4,106 @@ Flask API and backend for the assassin game.
 __author__ = 'Pierce Maloney'
 
 
+import gzip
+import hashlib
 import pymongo
-import random
-import csv
-
-from db_info import MONGODB_URI, SENDGRID_API_KEY, IVY_ASSASSIN_EMAIL, ADMIN_API_KEY
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import db
+import emails
+import export
+import idempotency
+import kill_log
+import memberships
+import metrics
+import outbox
+import reads
+from game_state import GameState, game_cache
+from leaderboard import build_leaderboard, build_leaderboard_from_memberships, encode_json, leaderboards
+from events import LeaderboardBroker, streams_enabled
+import players
+from players import build_player_doc, normalize_netid, player_cache
+from search import player_index
+from signup import import_players, read_signup_rows
 
 
 from functools import wraps
 from flask import Flask, jsonify, make_response, json, request, abort
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-
 # -----------------------------------------------------------------
 # Flask
 
 app = Flask(__name__)
+# "mongo", or "memory" to run on the in-memory engine without a database
+app.config["ASSASSIN_STORAGE"] = os.environ.get("ASSASSIN_STORAGE", "mongo")
+# layout of new games: "document", or "memberships" for one document per player, see memberships.py
+app.config["GAME_LAYOUT"] = os.environ.get("GAME_LAYOUT", "document")
+db.use_storage(app.config["ASSASSIN_STORAGE"])
+# request timings and db round trips for /metrics, see metrics.py
+metrics.init_app(app)
+
+
+# db connections opened and most recent games loaded by warmup
+WARMUP_CONNECTIONS = int(os.environ.get("WARMUP_CONNECTIONS", 2))
+WARMUP_GAMES = int(os.environ.get("WARMUP_GAMES", 2))
+
+
+def create_indexes():
+    """ The indexes of every collection. Creating an index that exists is a no-op"""
+    db.ensure_indexes()
+    memberships.ensure_indexes()
+    outbox.ensure_indexes()
+    idempotency.ensure_indexes()
+    kill_log.ensure_indexes(force=True)
+
+
+_warm_pid = None
+_warm_lock = threading.Lock()
+# seconds each step of this worker's warmup took, for /admin/db_health
+warmup_timings = {}
+
+
+def warmup(games=WARMUP_GAMES):
+    """
+    Gets this worker ready for traffic once: opens its db connections, creates the
+    indexes and loads the game state and leaderboard of the most recently created games.
+    Gunicorn calls it before the worker accepts requests (see gunicorn.conf.py), otherwise
+    the first request does. The email stack is left for the first send, and the player
+    search index, which reads every player, for the first moderator search
+    """
+    global _warm_pid
+    if _warm_pid == os.getpid():
+        return warmup_timings
+    with _warm_lock:
+        if _warm_pid == os.getpid():
+            return warmup_timings
+        warmup_timings.clear()
+        start = time.perf_counter()
+        try:
+            db.warmup(WARMUP_CONNECTIONS)
+            warmup_timings["connect"] = round(time.perf_counter() - start, 4)
+            create_indexes()
+            warmup_timings["indexes"] = round(time.perf_counter() - start - warmup_timings["connect"], 4)
+            # a limit of 0 would be no limit
+            if games:
+                for game_info in db.games_collection().find(
+                        {}, {"name": 1}, sort=[("created_at", pymongo.DESCENDING)], limit=games):
+                    get_game_state(game_info["name"])
+                    get_leaderboard(game_info["name"])
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to warm up the worker: {e}")
+        warmup_timings["total"] = round(time.perf_counter() - start, 4)
+        _warm_pid = os.getpid()
+        return warmup_timings
+
+
+@app.before_request
+def warm_worker():
+    if _warm_pid != os.getpid():
+        warmup()
 
 # -----------------------------------------------------------------
 # API endpoints
@@ -35,20 +118,14 @@ def hello_world():
 # Define the API endpoint for getting the player stats (alive/kills)
 @app.route('/api/game-stats/<string:game_name>')
 def get_player_kills_response(game_name: str):
-    collection = connect_to_db()
-    if collection is None:
-        print('Failed connection to db')
-        return {}
-    game_info = collection.find_one({"name": game_name})
-    if game_info is None:
+    game = get_game_state(game_name)
+    if game is None:
         print('Failed retrieval of game')
         return {}
     # Get the dictionary of player kills for the game
-    player_kills = game_info['players']
     game_stats = {}
-    for netid, kills in player_kills.items():
-        is_alive = True if netid in game_info['alive_players'] else False
-        game_stats[netid] = {"kills": kills, "isAlive": is_alive}
+    for netid, kills in game.kills.items():
+        game_stats[netid] = {"kills": kills, "isAlive": game.is_alive(netid)}
 
     # Return the dictionary of player kills
     response = jsonify(game_stats)
@@ -56,19 +133,38 @@ def get_player_kills_response(game_name: str):
     return response
 
 
+@app.route('/api/games', methods=['GET'])
+def get_games_response():
+    """Every game, or with ?netid= only the games of that player. Newest first"""
+    collection = connect_to_db()
+    if collection is None:
+        print('Failed connection to db')
+        return {}
+    query = {}
+    netid = request.args.get('netid')
+    if netid:
+        query["name"] = {"$in": players.games_of(normalize_netid(netid))}
+
+    games = list(collection.find(query, {"_id": 0, "name": 1, "version": 1, "created_at": 1},
+                                 sort=[("created_at", pymongo.DESCENDING), ("name", pymongo.ASCENDING)]))
+    response = jsonify(games)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
 @app.route('/api/players/<string:netid>', methods=['GET'])
 def get_player_info_response(netid: str):
     collection = connect_to_db(collection_name="players")
     if collection is None:
         print('Failed connection to db')
         return {}
-    player_info = collection.find_one({"netid": netid})
+    # only the public fields leave the db
+    netid = normalize_netid(netid)
+    player_info = reads.flights.do(("player", netid),
+                                   lambda: collection.find_one({"netid": netid}, players.public_projection()))
     if player_info is None:
         print(f'Failed retrieval of player: {netid} info')
         return {}
-    
-    # remove object_id attribute to properly jsonify the object
-    player_info.pop('_id', None) 
 
     response = jsonify(player_info)
     response.headers.add('Access-Control-Allow-Origin', '*')
@@ -77,42 +173,96 @@ def get_player_info_response(netid: str):
 
 @app.route('/api/game-players/<string:game_name>', methods=['GET'])
 def get_game_players_info(game_name: str):
-    """API endpoint for assassin leaderboard. Gets all necessary info"""
-    collection = connect_to_db()
-    if collection is None:
-        print('Failed connection to db')
-        return {}
-
-    game_info = collection.find_one({"name": game_name})
-    if game_info is None:
-        print('Failed retrieval of game')
+    """API endpoint for assassin leaderboard. Gets all necessary info, sorted by kills.
+    Served from the materialized leaderboard, and with a 304 if the client's copy is current.
+
+    Without parameters the whole leaderboard is a JSON array. With any of
+    ?limit=<n>&after=<cursor>&alive=<true|false>&fields=<netid,kills,...> it is a page,
+    {"players": [...], "next": <cursor of the next page or null>}"""
+    leaderboard = get_leaderboard(game_name)
+    if leaderboard is None:
         return {}
 
-    players_collection = connect_to_db(collection_name="players")
-    if players_collection is None:
-        print('Failed connection to db')
-        return {}
-
-    players_info = players_collection.find({"netid": {"$in": game_info['alive_players'] + game_info['dead_players']}})
-    players_info = [player for player in players_info]
+    if not any(arg in request.args for arg in ('limit', 'after', 'alive', 'fields')):
+        return compact_response(leaderboard.body, leaderboard.etag, compressed=lambda: leaderboard.gzipped)
+
+    limit = limit_arg(DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    alive = request.args.get('alive')
+    fields = request.args.get('fields')
+    if alive not in (None, 'true', 'false'):
+        abort(400)
+    fields = fields.split(',') if fields else None
+    if fields is not None and not set(fields) <= LEADERBOARD_FIELDS:
+        abort(400)
+    try:
+        rows, next_cursor = leaderboard.page(request.args.get('after'), limit,
+                                             None if alive is None else alive == 'true')
+    except ValueError:
+        abort(400)
+    if fields is not None:
+        rows = [{field: row[field] for field in fields if field in row} for row in rows]
+
+    body = encode_json({"players": rows, "next": next_cursor})
+    return compact_response(body, hashlib.sha1(body).hexdigest())
+
+
+def compact_response(body: bytes, etag: str, compressed=None):
+    """ A JSON response that is gzip compressed when the client accepts it and it is worth it.
+    compressed returns the body already compressed, if the caller keeps it"""
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        gzipped = compressed() if compressed is not None else gzip.compress(body, compresslevel=6)
+        response = app.response_class(gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        # the compressed and plain bodies are different representations
+        etag += '-gzip'
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag')
+    return response.make_conditional(request)
 
-    for player in players_info:
-        player.pop('_id', None)  # remove object_id attribute to properly jsonify the object
-        player['kills'] = game_info['players'][player['netid']]
-        player['isAlive'] = player['netid'] in game_info['alive_players']
 
-    response = jsonify(players_info)
+def limit_arg(default: int, maximum: int):
+    """ The ?limit= of the request, or default, capped at maximum. A 400 unless it is a positive integer"""
+    limit = request.args.get('limit')
+    if limit is None:
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, maximum)
+
+
+@app.route('/api/game-players/<string:game_name>/stream', methods=['GET'])
+def stream_game_players_info(game_name: str):
+    """Server-sent events with the leaderboard changes (kills, deaths, joins) of the game.
+    A 503 where streams would tie up a whole worker, so clients poll the leaderboard instead"""
+    if not streams_enabled():
+        abort(503)
+    leaderboard = get_leaderboard(game_name)
+    if leaderboard is None:
+        abort(404)
+    response = app.response_class(broker.stream(game_name, leaderboard), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
 
-
 # --------------------------------
 # Admin
 
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        # read on first use, so the public endpoints need no db_info
+        from db_info import ADMIN_API_KEY
         api_key = request.args.get('api_key')
         if not api_key or api_key != ADMIN_API_KEY:
             abort(401)
@@ -122,34 +272,202 @@ def require_api_key(f):
 
 @app.route('/admin/killed_target/<game_name>/<killer_netid>', methods=['POST'])
 @require_api_key
+@idempotency.idempotent
 def admin_killed_target(game_name, killer_netid):
     result = killed_target(game_name, killer_netid)
     response = jsonify(result)
+    if isinstance(result, Conflict):
+        response.status_code = 409
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+@app.route('/admin/kills/<game_name>', methods=['POST'])
+@require_api_key
+@idempotency.idempotent
+def admin_kills(game_name):
+    """Body: {"kills": ["killer", ["killer", "victim"], ...]}, applied in order with one write.
+    A batch that does not fit the ring is a 400, one that lost to concurrent updates a 409"""
+    body = request.get_json(silent=True) or {}
+    kills = body.get("kills")
+    if not isinstance(kills, list) or not kills:
+        abort(400)
+    result = killed_targets(game_name, kills)
+    response = jsonify(result)
+    if isinstance(result, Conflict):
+        response.status_code = 409
+    elif isinstance(result, str):
+        response.status_code = 400
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
-# TODO: admin functions
-# @app.route('/admin/get_targets/<game_name>/<killer_netid>', methods=['POST'])
-# @require_api_key
-# def admin_killed_target(game_name, killer_netid):
-#     result = killed_target(game_name, killer_netid)
-#     response = jsonify(result)
-#     response.headers.add('Access-Control-Allow-Origin', '*')
-#     return response
+
+@app.route('/admin/db_health', methods=['GET'])
+@require_api_key
+def admin_db_health():
+    """Ping and connection pool stats of this worker's db client, and its player cache stats"""
+    status = db.health()
+    status["player_cache"] = player_cache.stats()
+    status["game_cache"] = game_cache.stats()
+    status["idempotency_cache"] = idempotency.responses.stats()
+    status["warmup"] = warmup_timings
+    response = jsonify(status)
+    if not status["ok"]:
+        response.status_code = 503
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/metrics', methods=['GET'])
+@require_api_key
+def admin_metrics():
+    """Prometheus text exposition of this worker's metrics"""
+    pool = db.pool_stats.snapshot()
+    cache = player_cache.stats()
+    flights = reads.flights.stats()
+    try:
+        depth = outbox.queue_depth()
+    except pymongo.errors.PyMongoError as e:
+        print(f"Failed to read the outbox queue depth: {e}")
+        depth = {}
+    body = metrics.render(
+        metrics.gauge("assassin_outbox_jobs", "Outbox jobs by status",
+                      {(("status", status),): count for status, count in depth.items()}),
+        metrics.gauge("assassin_db_pool_connections", "Connections of the db pool",
+                      {(("state", "open"),): pool["open"], (("state", "in_use"),): pool["in_use"]}),
+        metrics.gauge("assassin_db_pool_checkout_failures_total", "Failed connection checkouts",
+                      {None: pool["checkout_failures"]}, kind="counter"),
+        metrics.gauge("assassin_player_cache_entries", "Players in the cache", {None: cache["size"]}),
+        metrics.gauge("assassin_player_cache_lookups_total", "Player cache lookups by result",
+                      {(("result", "hit"),): cache["hits"], (("result", "miss"),): cache["misses"]}, kind="counter"),
+        metrics.gauge("assassin_game_cache_entries", "Games in the game state cache", {None: game_cache.stats()["size"]}),
+        metrics.gauge("assassin_game_cache_lookups_total", "Game state cache lookups by result",
+                      {(("result", "hit"),): game_cache.hits, (("result", "miss"),): game_cache.misses}, kind="counter"),
+        metrics.gauge("assassin_leaderboard_cache_lookups_total", "Leaderboard cache lookups by result",
+                      {(("result", "hit"),): leaderboards.hits, (("result", "miss"),): leaderboards.misses}, kind="counter"),
+        metrics.gauge("assassin_stream_subscribers", "Open leaderboard streams", {None: broker.subscriber_count()}),
+        metrics.gauge("assassin_coalesced_reads_total", "Reads by whether they ran or shared an in-flight read",
+                      {(("result", "ran"),): flights["leaders"], (("result", "shared"),): flights["shared"]},
+                      kind="counter"),
+    )
+    response = app.response_class(body, mimetype='text/plain; version=0.0.4')
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/admin/undo_last_kill/<game_name>', methods=['POST'])
+@require_api_key
+@idempotency.idempotent
+def admin_undo_last_kill(game_name):
+    result = undo_last_kill(game_name)
+    response = jsonify(result)
+    if isinstance(result, Conflict):
+        response.status_code = 409
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/admin/game_history/<game_name>', methods=['GET'])
+@require_api_key
+def admin_game_history(game_name):
+    """The game rebuilt from its kill log at ?seq=<version> or ?at=<ISO time>, and the events after ?after="""
+    try:
+        seq = request.args.get('seq', type=int)
+        at = request.args.get('at')
+        at = datetime.fromisoformat(at) if at else None
+        if at is not None and at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+    except ValueError:
+        abort(400)
+    game = kill_log.rebuild(game_name, seq=seq, at=at)
+    response = jsonify({
+        "game": None if game is None else game.to_doc(),
+        "events": kill_log.history(game_name, after=request.args.get('after', -1, type=int),
+                                   limit=min(request.args.get('limit', 100, type=int), 1000)),
+    })
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/admin/add_players/<game_name>', methods=['POST'])
+@require_api_key
+@idempotency.idempotent
+def admin_add_players(game_name):
+    """Body: {"netids": [...], "reshuffle": false, "notify": true}"""
+    body = request.get_json(silent=True) or {}
+    netids = body.get("netids")
+    if not isinstance(netids, list) or not netids or not all(isinstance(netid, str) for netid in netids):
+        abort(400)
+    result = add_players_to_game(game_name, netids,
+                                 reshuffle=bool(body.get("reshuffle", False)),
+                                 notify=bool(body.get("notify", True)))
+    response = jsonify(result)
+    if isinstance(result, Conflict):
+        response.status_code = 409
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+@app.route('/admin/search', methods=['GET'])
+@require_api_key
+def admin_search():
+    """Players whose name, nickname, assassin name or netid starts with ?q=, up to ?limit=.
+    With ?game= only its alive players, with their target"""
+    query = request.args.get('q', '')
+    limit = limit_arg(10, 100)
+    game_name = request.args.get('game')
+    game = None
+    if game_name:
+        game = get_game_state(game_name)
+        if game is None:
+            abort(404)
+    results = player_index.search(query, limit=limit, among=None if game is None else game.alive)
+    if game is not None:
+        for player in results:
+            player["target"] = game.target_of(player["netid"])
+    response = jsonify(results)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+@app.route('/admin/export/<game_name>', methods=['GET'])
+@require_api_key
+def admin_export(game_name):
+    """Every player with their kills, alive status and target, streamed as ?format=ndjson (default) or csv"""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in export.FORMATS:
+        abort(400)
+    game = get_game_state(game_name)
+    if game is None:
+        abort(404)
+    names = export.player_names(game_name, game.kills)
+
+    response = app.response_class(export.encode(export.export_rows(game, names), export_format),
+                                  mimetype=export.FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{game_name}-targets.{export_format}"'
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
 
 
 # -----------------------------------------------------------------
 
+# times a game update is retried when another update got there first
+GAME_UPDATE_RETRIES = 5
+
+
+class Conflict(str):
+    """ The error message of an update that kept losing to concurrent updates. Unlike
+    the other error messages, retrying the same request may succeed"""
+
+# leaderboard pages
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+LEADERBOARD_FIELDS = set(players.PUBLIC_FIELDS) | {"kills", "isAlive"}
+# smaller responses are not worth compressing
+GZIP_MIN_BYTES = 1024
+
 
 def connect_to_db(collection_name="games"):
     """
-    Connects to db and returns collection. Returns None if failure
+    Returns collection on this process's pooled client. Returns None if failure
     """
     try:
-        client = pymongo.MongoClient(MONGODB_URI)
-        db = client["assassin"]
-        collection = db[collection_name]
-        return collection
+        return db.get_collection(collection_name)
     except pymongo.errors.ConnectionFailure as e:
         print(f"Failed to connect to MongoDB server: {e}")
         return None
@@ -171,10 +489,118 @@ def get_game_info(game_name: str):
             f"No game with the name '{game_name}' was found in the database.")
         return None
 
+    if memberships.uses_memberships(game_info):
+        return memberships.load_game_info(game_info)
     return game_info
 
 
-def update_game(game_info: dict):
+def get_game_state(game_name: str):
+    """
+    returns the GameState of the specified name. Served from the game cache when the
+    cached copy is still at the current version, so only the version is read
+    """
+    collection = connect_to_db()
+    if collection is None:
+        return None
+
+    version_info = collection.find_one({"name": game_name}, {"version": 1})
+    if version_info is None:
+        print(
+            f"No game with the name '{game_name}' was found in the database.")
+        return None
+    cached = game_cache.get(game_name, version_info.get("version"))
+    if cached is not None:
+        return cached
+
+    def load():
+        game_info = get_game_info(game_name)
+        if game_info is None:
+            return None
+        game = GameState.from_doc(game_info)
+        game_cache.put(game)
+        return game
+
+    # concurrent loads of the same version share one, and each caller gets its own copy
+    game = reads.flights.do(("game", game_name, version_info.get("version")), load)
+    return None if game is None else game.copy()
+
+
+def get_leaderboard(game_name: str):
+    """
+    returns the materialized leaderboard of the game, rebuilding it only if the game
+    changed since it was last built. Concurrent rebuilds of the same version share one
+    """
+    collection = connect_to_db()
+    if collection is None:
+        print('Failed connection to db')
+        return None
+
+    # cheap version check before touching the whole game
+    version_info = collection.find_one({"name": game_name}, {"version": 1, "layout": 1})
+    if version_info is None:
+        print('Failed retrieval of game')
+        return None
+    version = version_info.get("version")
+    cached = leaderboards.get(game_name, version)
+    if cached is not None:
+        return cached
+    return reads.flights.do(("leaderboard", game_name, version),
+                            lambda: build_game_leaderboard(game_name, version_info))
+
+
+def build_game_leaderboard(game_name: str, version_info: dict):
+    """ Builds and caches the leaderboard, fetching the game and its players at the same time"""
+    collection = connect_to_db()
+    players_collection = connect_to_db(collection_name="players")
+    if collection is None or players_collection is None:
+        print('Failed connection to db')
+        return None
+
+    def game_players():
+        return list(players_collection.find({"games": game_name}, players.public_projection()))
+
+    if memberships.uses_memberships(version_info):
+        # already in leaderboard order, straight from the (game, kills) index
+        membership_rows, players_info = reads.concurrently(
+            lambda: memberships.leaderboard_rows(game_name), game_players)
+        players_info = with_missing_players(players_info, [netid for netid, _, _ in membership_rows])
+        return leaderboards.put(game_name, version_info.get("version"),
+                                build_leaderboard_from_memberships(membership_rows, players_info))
+
+    game_info, players_info = reads.concurrently(lambda: collection.find_one({"name": game_name}), game_players)
+    if game_info is None:
+        print('Failed retrieval of game')
+        return None
+    players_info = with_missing_players(players_info, game_info['alive_players'] + game_info['dead_players'])
+    return leaderboards.put(game_name, game_info.get("version"), build_leaderboard(game_info, players_info))
+
+
+def with_missing_players(players_info, netids):
+    """
+    The profiles of exactly the netids, from the ones found by their game membership plus
+    a lookup of any player whose membership was never recorded (see backfill_memberships)
+    """
+    wanted = set(netids)
+    players_info = [player for player in players_info if player["netid"] in wanted]
+    missing = wanted.difference(player["netid"] for player in players_info)
+    if missing:
+        players_info += connect_to_db(collection_name="players").find(
+            {"netid": {"$in": list(missing)}}, players.public_projection())
+    return players_info
+
+
+# pushes leaderboard changes to the open streams of this worker
+broker = LeaderboardBroker(get_leaderboard)
+
+
+def update_game(game_info: dict, event=None, previous=None):
+    """
+    Writes the game back if no one else changed it since it was read, and records
+    event, an (event type, data) pair, in the kill log as the new version.
+    previous, the game document as it was read, limits the write to the players that
+    changed in the memberships layout.
+    Returns False if the version in the db moved on, so the caller can reload and retry
+    """
     # connect to database
     collection = connect_to_db()
     if collection is None:
@@ -185,11 +611,28 @@ def update_game(game_info: dict):
     alive_players = game_info["alive_players"]
     dead_players = game_info["dead_players"]
 
-    collection.update_one({"_id": game_info["_id"]}, {"$set": {
-        "players": players,
-        "targets": targets,
-        "alive_players": alive_players,
-        "dead_players": dead_players}})
+    # games created before versioning have no version field, which matches None
+    version = game_info.get("version")
+    if memberships.uses_memberships(game_info):
+        updated = memberships.write_game(game_info, previous)
+    else:
+        result = collection.update_one({"_id": game_info["_id"], "version": version}, {"$set": {
+            "players": players,
+            "targets": targets,
+            "alive_players": alive_players,
+            "dead_players": dead_players},
+            "$inc": {"version": 1}})
+        updated = result.matched_count == 1
+    if not updated:
+        print(f"Game {game_info['name']} was changed by someone else, not updated")
+        return False
+
+    game_info["version"] = (version or 0) + 1
+    game_cache.put(GameState.from_doc(game_info))
+    if event is not None:
+        kill_log.record(game_info["name"], game_info["version"], *event)
+    broker.notify(game_info["name"])
+    return True
 
 
 def new_player(netid: str, name: str, nickname = None, email = None):
@@ -201,51 +644,34 @@ def new_player(netid: str, name: str, nickname = None, email = None):
         return None
     
     # clean netid
-    netid = netid.lower()
+    netid = normalize_netid(netid)
     
     # check if a player with the given netid already exists
     existing_player = players_collection.find_one({"netid": netid})
     if existing_player is not None:
         return f"Player with netid {netid} already exists"
-    
-    # give princeton email
-    if email is None:
-        email = f'{netid}@princeton.edu'
-
-    # construct the fullAssassinName field
-    if nickname is None or nickname == "*":
-        full_assassin_name = name
-    else:
-        words = name.split()
-        first_word = words[0]
-        rest_of_words = ' '.join(words[1:])
-        full_assassin_name = f"{first_word} '{nickname}' {rest_of_words}"
 
     # create a document for the new player
-    player_info = {
-        "netid": netid.lower(),
-        "name": name,
-        "nickname": nickname,
-        "email": email.lower(),
-        "fullAssassinName": full_assassin_name
-    }
+    player_info = build_player_doc(netid, name, nickname, email)
 
     # insert the new player document into the players collection
     players_collection.insert_one(player_info)
+    player_cache.invalidate(netid)
+    player_index.add(player_info)
 
     # return the player information
     return player_info
 
 
 def get_player_info(netid: str):
-    """ To be used locally
+    """ To be used locally. Served from the player cache when possible
     """
-    collection = connect_to_db(collection_name="players")
-    if collection is None:
-        print('Failed connection to db')
+    try:
+        player_info = players.get_player(netid)
+    except pymongo.errors.PyMongoError as e:
+        print(f'Failed connection to db: {e}')
         return None
 
-    player_info = collection.find_one({"netid": netid})
     if player_info is None:
         print(f'Failed retrieval of player: {netid} info')
         return None
@@ -253,44 +679,84 @@ def get_player_info(netid: str):
     return player_info
 
 
+def get_players(netids):
+    """ Returns {netid: player_info} for all the netids. Cache misses are fetched with one query
+    """
+    try:
+        return players.get_players(netids)
+    except pymongo.errors.PyMongoError as e:
+        print(f'Failed connection to db: {e}')
+        return {}
+
+
 def add_player_to_game(game_name: str, netid: str):
     """
     adds player to game and shuffles the targets
     """
-    game_info = get_game_info(game_name)
-    if game_info == None:
-        return
+    add_players_to_game(game_name, [netid], reshuffle=True)
 
-    # Check if player is already in game
-    if netid in game_info["players"]:
-        return
 
-    # add player to game
-    game_info["players"][netid] = 0
-    game_info["alive_players"].append(netid)
-    update_game(game_info)
-    shuffle_game(game_name)
+def add_players_to_game(game_name: str, netids, reshuffle=False, notify=False):
+    """
+    Adds many players to a running game in one write.
+    Newcomers are spliced into the ring after random alive players, or with reshuffle
+    the whole alive ring is shuffled again. With notify, only the players whose
+    target changed are emailed.
+    Returns the players added, the ones skipped and the ones whose target changed,
+    or an error message if the game kept changing
+    """
+    netids = list(dict.fromkeys(normalize_netid(netid) for netid in netids))
+    known_players = get_players(netids)
+    unknown = [netid for netid in netids if netid not in known_players or not is_valid_netid(netid)]
+
+    for attempt in range(GAME_UPDATE_RETRIES):
+        game = get_game_state(game_name)
+        if game is None:
+            return None
+        previous = game.to_doc()
+        old_targets = dict(game.targets)
+
+        added = game.insert_many(netid for netid in netids if netid not in unknown)
+        if reshuffle:
+            game.shuffle()
+            event = ("join", {"added": added, "ring": list(game.alive)})
+        else:
+            event = ("join", {"added": added, "targets": {
+                netid: target for netid, target in game.targets.items() if old_targets.get(netid) != target}})
+        if not added and not reshuffle:
+            break
+        if update_game(game.to_doc(), event, previous) is not False:
+            break
+    else:
+        print(f"Could not add players to {game_name}, it kept changing")
+        return Conflict(f"Adding players to {game_name} conflicted with other updates, try again")
+    players.add_memberships(game_name, added)
+
+    changed = [netid for netid in game.alive if old_targets.get(netid) != game.target_of(netid)]
+    if notify and changed:
+        send_target_emails(game, changed, welcome=added)
+
+    return {
+        "added": added,
+        "already_in_game": [netid for netid in netids if netid not in added and netid not in unknown],
+        "unknown": unknown,
+        "changed_targets": changed,
+    }
 
 
 def shuffle_game(game_name: str):
     """
     Shuffles the targets of the alive players in the game
     """
-    game_info = get_game_info(game_name)
-    if game_info is None:
-        return
-
-    if len(game_name["alive_players"]) > 0:
-        # shuffle the list of players to create a random order
-        random.shuffle(game_name["alive_players"])
-
-    # create a dictionary where each player's target is the next player in the shuffled list
-    targets = {}
-    for i in range(len(game_name["alive_players"])):
-        targets[game_name["alive_players"][i]] = game_name["alive_players"][(
-            i+1) % len(game_name["alive_players"])]
+    for attempt in range(GAME_UPDATE_RETRIES):
+        game = get_game_state(game_name)
+        if game is None:
+            return
 
-    update_game(game_info)
+        previous = game.to_doc()
+        game.shuffle()
+        if update_game(game.to_doc(), ("shuffle", {"ring": list(game.alive)}), previous) is not False:
+            return
 
 
 def new_game(game_name: str, player_list=[]):
@@ -303,107 +769,261 @@ def new_game(game_name: str, player_list=[]):
         return None
 
     # check if a game with the same name already exists in the database
-    if collection.find_one({"name": game_name}) is not None:
+    if collection.find_one({"name": game_name}, {"_id": 1}) is not None:
         print(
             f"A game with the name '{game_name}' already exists in the database.")
         return None
 
-    alive_players = list(player_list)
-    if len(alive_players) > 0:
-        # shuffle the list of alive players to create a random order
-        random.shuffle(alive_players)
-
-    # player: kill_count dict
-    players = {}
-    for player in player_list:
-        players[player] = 0
-
-    # create a dictionary where each player's target is the next alive player in the shuffled list
-    targets = {}
-    for i in range(len(alive_players)):
-        targets[alive_players[i]] = alive_players[(i+1) % len(alive_players)]
-
-    # create a list of dead players and initialize it to be empty
-    dead_players = []
+    # each player's target is the next alive player in a shuffled order, no one is dead yet
+    game_info = GameState.new(game_name, player_list).to_doc()
+    game_info["version"] = 0
+    game_info["created_at"] = datetime.now(timezone.utc)
 
     # insert the game information and player status into the database
-    game_info = {
-        "name": game_name,
-        "players": players,
-        "targets": targets,
-        "alive_players": alive_players,
-        "dead_players": dead_players
-    }
-    collection.insert_one(game_info)
+    try:
+        if app.config["GAME_LAYOUT"] == memberships.LAYOUT:
+            memberships.create(game_info)
+        else:
+            collection.insert_one(game_info)
+    except pymongo.errors.DuplicateKeyError:
+        print(
+            f"A game with the name '{game_name}' already exists in the database.")
+        return None
+    players.add_memberships(game_name, game_info["players"])
+    kill_log.record(game_name, 0, "created", {"ring": game_info["alive_players"]})
 
     # return the game information
     return game_info
 
 
+def is_valid_netid(netid: str):
+    """ netids are used as field names in the game document"""
+    return bool(netid) and "." not in netid and not netid.startswith("$")
+
+
 def killed_target(game_name: str, netid: str):
     """
     The netid of the player that killed their target.
-    Removes target from alive list and increases player's kill count
+    Removes target from alive list and increases player's kill count.
+    Applied as one atomic update that touches only the fields of the killer and victim,
+    or the memberships of the killer, victim and new target
     """
-    game_info = get_game_info(game_name)
-    if game_info is None:
+    collection = connect_to_db()
+    if collection is None:
         return None
-    
-    # Ensure the killer is alive
-    if netid not in game_info["alive_players"]:
-        return f"Player with netid {netid} is not alive in the game"
-
-    # get the player's target
-    target = game_info["targets"][netid]
-
-    # remove the target from the alive list and add them to the dead list
-    game_info["alive_players"].remove(target)
-    game_info["dead_players"].append(target)
+    if not is_valid_netid(netid):
+        return f"Invalid netid {netid}"
+
+    for attempt in range(GAME_UPDATE_RETRIES):
+        # read only the killer's target. Only alive players have a target
+        game_info = collection.find_one({"name": game_name}, {f"targets.{netid}": 1, "layout": 1})
+        if game_info is None:
+            print(f"No game with the name '{game_name}' was found in the database.")
+            return None
+        if memberships.uses_memberships(game_info):
+            result = memberships.kill(game_name, netid)
+            if isinstance(result, str):
+                return result
+            target, new_target, version = result
+            break
+        target = game_info.get("targets", {}).get(netid)
+        if target is None:
+            return f"Player with netid {netid} is not alive in the game"
+        if target == netid:
+            return f"Player with netid {netid} has no target left"
+
+        # and the target's target, who the killer inherits
+        target_info = collection.find_one({"_id": game_info["_id"]}, {f"targets.{target}": 1})
+        new_target = target_info.get("targets", {}).get(target)
+
+        # applied only if neither link changed since they were read
+        result = collection.find_one_and_update({
+            "_id": game_info["_id"],
+            f"targets.{netid}": target,
+            f"targets.{target}": new_target,
+        }, {
+            "$inc": {f"players.{netid}": 1, "version": 1},
+            "$pull": {"alive_players": target},
+            "$push": {"dead_players": target},
+            "$set": {f"targets.{netid}": new_target},
+            "$unset": {f"targets.{target}": ""},
+        }, projection={"version": 1}, return_document=pymongo.ReturnDocument.AFTER)
+        if result is not None:
+            version = result["version"]
+            break
+    else:
+        return Conflict(f"Kill by {netid} conflicted with other updates, try again")
+    kill_log.record(game_name, version, "kill", {"killer": netid, "victim": target, "target": new_target})
+    game_cache.advance(game_name, version, lambda game: game.kill(netid) == target)
+    broker.notify(game_name)
 
-    # Send email informing the victim that they have been slain
+    # queue the emails only once the kill is committed
     send_you_have_been_slain_email(target)
+    send_new_target_email(netid, new_target, game_name=game_name)
 
-    # assign the dead player's target to the player who killed them
-    game_info["targets"][netid] = game_info["targets"][target]
-
-    # Send email with the new target
-    send_new_target_email(netid, game_info["targets"][netid])
-
-    # remove the dead player from the "targets" dictionary
-    del game_info["targets"][target]
+    # return the dead player's name
+    return target
 
-    # increment the player's kill count
-    game_info["players"][netid] += 1
 
-    # update the game information in the database
-    update_game(game_info)
+def killed_targets(game_name: str, kills):
+    """
+    Applies many confirmed kills in order with one write. A kill is a killer netid, or a
+    [killer, victim] pair whose victim must be the killer's target at that point of the batch.
+    Nothing is applied if any kill does not fit the ring. Victims are told they were slain,
+    and each killer still alive gets one email with their final target.
+    Returns the applied kills, or an error message
+    """
+    requested = []
+    for i, kill in enumerate(kills):
+        if isinstance(kill, str):
+            kill = [kill, None]
+        if not isinstance(kill, list) or len(kill) != 2 \
+                or not all(netid is None or isinstance(netid, str) and is_valid_netid(netid) for netid in kill):
+            return f"Kill {i}: invalid kill {kill}"
+        killer, victim = kill
+        if killer is None:
+            return f"Kill {i}: invalid kill {kill}"
+        requested.append((normalize_netid(killer), victim and normalize_netid(victim)))
+
+    for attempt in range(GAME_UPDATE_RETRIES):
+        game = get_game_state(game_name)
+        if game is None:
+            return None
+        previous = game.to_doc()
+
+        applied = []
+        for i, (killer, victim) in enumerate(requested):
+            target = game.target_of(killer)
+            if target is None:
+                return f"Kill {i}: player with netid {killer} is not alive in the game"
+            if target == killer:
+                return f"Kill {i}: player with netid {killer} has no target left"
+            if victim is not None and victim != target:
+                return f"Kill {i}: the target of {killer} is {target}, not {victim}"
+            game.kill(killer)
+            applied.append({"killer": killer, "victim": target, "target": game.target_of(killer)})
+
+        if update_game(game.to_doc(), ("kills", {"kills": applied}), previous) is not False:
+            break
+    else:
+        return Conflict(f"Kills in {game_name} conflicted with other updates, try again")
 
-    # return the dead player's name
-    return target
+    # one email per player, with where the whole batch left them
+    send_slain_emails([kill["victim"] for kill in applied], game_name)
+    killers = [netid for netid in dict.fromkeys(kill["killer"] for kill in applied) if game.is_alive(netid)]
+    if killers:
+        send_target_emails(game, killers)
+    return applied
 
 
 def unalive_player(game_name: str, netid: str):
-    """ Makes a player unalive. Does not add to anyone's kill count, but updates the game
+    """ Makes a player unalive. Does not add to anyone's kill count, but updates the game.
+    Applied as one atomic update that touches only the fields of the player and who had them
     """
-    game_info = get_game_info(game_name)
-    if game_info is None:
+    collection = connect_to_db()
+    if collection is None:
+        return None
+    if not is_valid_netid(netid):
         return None
 
-    if netid in game_info["alive_players"]:
-        game_info["alive_players"].remove(netid)
-        game_info["dead_players"].append(netid)
+    layout_info = collection.find_one({"name": game_name}, {"layout": 1})
+    if layout_info is not None and memberships.uses_memberships(layout_info):
+        # memberships know their hunter, so only the player, hunter and target are read
+        result = memberships.unalive(game_name, netid)
+        if result is None:
+            return None
+        hunter, _, version = result
+        kill_log.record(game_name, version, "unalive", {"netid": netid})
+        game_cache.advance(game_name, version, lambda cached: cached.unalive(netid) == hunter)
+        broker.notify(game_name)
+        game = get_game_state(game_name)
+        return None if game is None else game.to_doc()
+
+    for attempt in range(GAME_UPDATE_RETRIES):
+        # the reverse lookup needs the whole ring
+        game = get_game_state(game_name)
+        if game is None or not game.is_alive(netid):
+            return None
+        target = game.target_of(netid)
+
+        # the player who had them inherits their target
+        hunter = game.unalive(netid)
+        update = {
+            "$inc": {"version": 1},
+            "$pull": {"alive_players": netid},
+            "$push": {"dead_players": netid},
+            "$unset": {f"targets.{netid}": ""},
+        }
+        if hunter != netid:
+            update["$set"] = {f"targets.{hunter}": target}
+
+        result = collection.find_one_and_update({
+            "_id": game._id,
+            f"targets.{hunter}": netid,
+            f"targets.{netid}": target,
+        }, update, projection={"version": 1}, return_document=pymongo.ReturnDocument.AFTER)
+        if result is not None:
+            kill_log.record(game_name, result["version"], "unalive", {"netid": netid})
+            game_cache.advance(game_name, result["version"], lambda cached: cached.unalive(netid) == hunter)
+            broker.notify(game_name)
+            game_info = game.to_doc()
+            game_info["version"] = result["version"]
+            return game_info
+    return None
 
-        # assign the dead player's target to the player who had them
-        player_who_had_them = next(
-            iter({i for i in game_info["targets"] if game_info["targets"][i] == netid}))
-        game_info["targets"][player_who_had_them] = game_info["targets"][netid]
 
-        # remove the player from the "targets" dictionary
-        del game_info["targets"][netid]
+def undo_last_kill(game_name: str):
+    """
+    Takes back the latest kill of the game that was not taken back yet: the victim is
+    alive again as the killer's target and the killer loses the kill. Both are emailed
+    their targets. Returns the undone kill event, or an error message. Refused with a
+    Conflict while the kill log is behind the game
+    """
+    for attempt in range(GAME_UPDATE_RETRIES):
+        # the game first, so the kill is looked up among the events of that version
+        game = get_game_state(game_name)
+        if game is None:
+            return None
+        previous = game.to_doc()
+        version = game.extra.get("version") or 0
+
+        kill = kill_log.last_kill(game_name, through=version)
+        if kill is None:
+            return f"No kill to undo in {game_name}"
+        if not kill_log.recorded(game_name, kill["seq"], version):
+            # a later kill may be the one missing, and undoing this one would take back the wrong kill
+            return Conflict(f"The kill log of {game_name} is missing events before version {version}, "
+                            f"cannot tell which kill was the last one")
+        killer, victim = kill["data"]["killer"], kill["data"]["victim"]
+
+        if not game.undo_kill(killer, victim):
+            return f"Cannot undo the kill of {victim}, {killer} is no longer alive or {victim} is not dead"
+        event = ("undo", {"seq": kill["seq"], "killer": killer, "victim": victim})
+        if "index" in kill:
+            event[1]["index"] = kill["index"]
+        if update_game(game.to_doc(), event, previous) is not False:
+            break
+    else:
+        return Conflict(f"Undo in {game_name} conflicted with other updates, try again")
+
+    send_new_target_email(killer, victim, game_name=game_name)
+    send_new_target_email(victim, game.target_of(victim), game_name=game_name)
+    kill.pop("_id", None)
+    return kill
 
-        update_game(game_info)
-        return game_info
-    return None
+
+def backfill_memberships():
+    """
+    Records the games of every player in their documents, for games created before
+    memberships were kept. Returns the number of players updated
+    """
+    collection = connect_to_db()
+    if collection is None:
+        return None
+    updated = 0
+    for game_info in collection.find({}, {"name": 1, "alive_players": 1, "dead_players": 1}):
+        updated += players.add_memberships(game_info["name"], game_info["alive_players"] + game_info["dead_players"])
+    return updated
 
 
 def unpack_game(game_info: dict):
@@ -415,91 +1035,113 @@ def unpack_game(game_info: dict):
 
 
 def process_csv_and_create_game(file_path, game_name):
-    player_netids = []
-    with open(file_path, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            # Extract player information
-            netid = row['netID']
-            full_name = row['Full Name']
-            nickname = row['Assassin Name']
-            email_address = row['Email Address']
-
-            if full_name and netid:
-                # Create a new player using the new_player function
-                new_player(netid, full_name, nickname, email_address)
-                player_netids.append(netid.lower())
-                print('Added:', netid, full_name, nickname, email_address)
-            else:
-                print(f"Skipping row due to missing required fields: {row}")
+    """
+    Imports the players of the signup CSV in bulk and creates the game with them
+    """
+    report = import_players(read_signup_rows(file_path))
+    print(f"Imported {report['rows']} rows in {report['seconds']}s ({report['rows_per_second']} rows/s): "
+          f"{report['inserted']} new players, {report['existing']} already existed")
+    for rejected in report["rejected"]:
+        print(f"Skipping row {rejected['line']} ({rejected['reason']}): {rejected['row']}")
 
     # create the new game
-    new_game(game_name, player_netids)
+    new_game(game_name, report["netids"])
+    return report
 
 
 # -----------------------------------------------------------------
 # Twilio/Sendgrid
 
-def send_email(to_email:str, subject, content):
+def send_email(to_email:str, subject, content, text=None):
+    """ Queues the email in the outbox. It is sent by the background email workers"""
+    try:
+        outbox.enqueue_email(to_email, subject, content, text=text)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Error queueing email: {e}")
+
+
+def send_coalesced_emails(messages, game_name=None):
+    """ Queues target emails that replace the ones still waiting for the same players"""
     try:
-        message = Mail(
-            from_email=IVY_ASSASSIN_EMAIL,  # replace with your email or desired sender email
-            to_emails=to_email,
-            subject=subject,
-            html_content=content
-        )
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
-        print(f"Email sent to {to_email} with status code {response.status_code}")
-    except Exception as e:
-        print(f"Error sending email: {e}")
+        outbox.enqueue_coalesced(messages, game_name)
+    except pymongo.errors.PyMongoError as e:
+        print(f"Error queueing emails: {e}")
+        return
+    outbox.wake_email_workers()
 
 
 # -----------------------------
 # Email types:
 
-def send_new_target_email(netid: str, target_netid: str, welcome_email = False):
-    """ Sends an email to netid that tells them their target"""
+def send_new_target_email(netid: str, target_netid: str, welcome_email = False, game_name = None):
+    """ Sends an email to netid that tells them their target. A new target email replaces
+    the one still waiting for them in the game, if any"""
     # Retrieve player and target information
     player_info = get_player_info(netid)
     target_info = get_player_info(target_netid)
 
-    player_full_assassin_name = player_info["fullAssassinName"]
-    target_full_assassin_name = target_info["fullAssassinName"]
-
-    # Create email content
-    if welcome_email is True:
-        subject = "Your First Target"
-        content = f"""
-        <p>Hello {player_full_assassin_name},</p>
-        <p>Welcome to Assassin!<br> <br>
-        Your first target is:<br>
-        <strong>{target_full_assassin_name}</strong></p>
-        <p>Reminder:</p>
-        <ul>
-            <li>Film your kill, and send it in the Assassin GroupMe for it to be confirmed.</li>
-        </ul>
-        <p>Happy hunting!</p>
-        <p>Good luck,</p>
-        <p>HQ</p>
-        """
+    subject, content, text = render_new_target_email(player_info, target_info, welcome_email)
+    to_email = player_info["email"]
+    if welcome_email:
+        send_email(to_email, subject, content, text)
     else:
-        subject = "Your New Target"
-        content = f"""
-        <p>Hello {player_full_assassin_name},</p>
-        <p>Your new target is:<br>
-        <strong>{target_full_assassin_name}</strong></p>
-        <p>Reminder:</p>
-        <ul>
-            <li>Film your kill, and send it in the Assassin GroupMe for it to be confirmed.</li>
-        </ul>
-        <p>Happy hunting!</p>
-        <p>Good luck,</p>
-        <p>HQ</p>
-        """
+        send_coalesced_emails([(to_email, subject, content, text)], game_name)
 
-    to_email = player_info["email"]
-    send_email(to_email, subject, content)
+
+def render_new_target_email(player_info: dict, target_info: dict, welcome_email = False):
+    """ Returns the subject, HTML and plain-text content of the email telling a player their target"""
+    return emails.render("new_target", player=player_info, target=target_info, welcome=welcome_email is True)
+
+
+def send_target_emails(game: GameState, netids, welcome=()):
+    """ Queues an email with their current target to each of the netids, with one player lookup.
+    Players in welcome get the welcome email instead
+    """
+    welcome = set(welcome)
+    players_info = get_players(list(netids) + [game.target_of(netid) for netid in netids])
+
+    welcome_messages, messages = [], []
+    for netid in netids:
+        player_info = players_info.get(netid)
+        target_info = players_info.get(game.target_of(netid))
+        if player_info is None or target_info is None:
+            print(f"Could not find player or target information for {netid}")
+            continue
+        message = (player_info["email"], *render_new_target_email(player_info, target_info,
+                                                                  welcome_email=netid in welcome))
+        (welcome_messages if netid in welcome else messages).append(message)
+
+    outbox.enqueue_emails(welcome_messages, game.name)
+    # new targets replace the ones still waiting, so players only get the latest
+    send_coalesced_emails(messages, game.name)
+
+
+def send_welcome_emails(game_name: str, max_workers=8):
+    """ Sends every alive player their first target.
+    Players are loaded with one query and the emails are sent concurrently.
+    Returns the send report, with the error of every recipient that failed
+    """
+    game_info = get_game_info(game_name)
+    if game_info is None:
+        return None
+
+    targets = game_info["targets"]
+    players_info = get_players(game_info["alive_players"])
+
+    messages = []
+    failed = {}
+    for netid in game_info["alive_players"]:
+        player_info = players_info.get(netid)
+        target_info = players_info.get(targets.get(netid))
+        if player_info is None or target_info is None:
+            failed[netid] = "missing player or target info"
+            continue
+        messages.append((player_info["email"], *render_new_target_email(player_info, target_info, welcome_email=True)))
+
+    job_ids = outbox.enqueue_emails(messages, game_name)
+    report = outbox.send_jobs(job_ids, max_workers=max_workers, label="Welcome emails")
+    report["failed"].update(failed)
+    return report
 
 # def send_kill_confirmation_pending_email(netid):
 #     """ Sends an email to netid that tells them their target"""
@@ -526,19 +1168,28 @@ def send_you_have_been_slain_email(netid):
     # Retrieve player and target information
     player_info = get_player_info(netid)
 
-    player_full_assassin_name = player_info["fullAssassinName"]
+    subject, content, text = render_you_have_been_slain_email(player_info)
+    to_email = player_info["email"]
+    send_email(to_email, subject, content, text)
+
 
-    subject = "You Have Been Slain"
-    content = f"""
-    <p>Hello {player_full_assassin_name},</p>
-    <p>Unfortunately, you have been slain in the game of Assassin. Your journey has come to an end.</p>
-    <p>Thanks for participating in the game. We hope you enjoyed it.</p>
-    <p>Regards,</p>
-    <p>HQ</p>
-    """
+def send_slain_emails(netids, game_name=None):
+    """ Queues the slain email to each of the netids, with one player lookup"""
+    players_info = get_players(netids)
+    messages = []
+    for netid in netids:
+        player_info = players_info.get(netid)
+        if player_info is None:
+            print(f"Could not find player information for {netid}")
+            continue
+        messages.append((player_info["email"], *render_you_have_been_slain_email(player_info)))
+    outbox.enqueue_emails(messages, game_name)
+    outbox.wake_email_workers()
 
-    to_email = player_info["email"]
-    send_email(to_email, subject, content)
+
+def render_you_have_been_slain_email(player_info: dict):
+    """ Returns the subject, HTML and plain-text content of the email telling a player they're dead"""
+    return emails.render("slain", player=player_info)
 
 
 
@@ -580,6 +1231,7 @@ def test_assassin_game():
         assert game_info["players"][killer] == 1
 
         # Check that emails have been sent (manually, by checking your inbox)
+        outbox.drain_outbox()
         print("Check the inboxes of the specified email addresses for the 'Your New Target' and 'You Have Been Slain' emails.")
 
 
@@ -592,10 +1244,8 @@ def test_ivy_assassin():
         game_info = get_game_info(game_name)
         print("alive:", game_info["alive_players"])
 
-        targets = game_info["targets"]
-
-        for player in game_info["alive_players"]:
-            send_new_target_email(player, targets[player], welcome_email=True)
+        report = send_welcome_emails(game_name)
+        print("welcome emails:", report)
 
 
 def print_targets(game_name, netids):
@@ -603,15 +1253,17 @@ def print_targets(game_name, netids):
 
     if game_info is not None:
         targets = game_info["targets"]
+        # the players and their targets, fetched together
+        players_info = get_players(list(netids) + [targets[netid] for netid in netids if netid in targets])
 
         for netid in netids:
-            player_info = get_player_info(netid)
+            player_info = players_info.get(netid)
             if player_info is not None:
                 player_name = player_info["name"]
 
                 target_netid = targets.get(netid)
                 if target_netid:
-                    target_info = get_player_info(target_netid)
+                    target_info = players_info.get(target_netid)
                     if target_info is not None:
                         target_name = target_info["name"]
                         print(f"{player_name} has target: {target_name}")
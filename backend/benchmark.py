@@ -0,0 +1,497 @@
+"""
+Benchmarks for kill processing and leaderboard reads, run on the in-memory storage
+engine with the fake email transport so they need no database or SendGrid.
+
+    python benchmark.py --sizes 100,1000,10000 --output bench.json
+    python benchmark.py --load --requests 5000 --concurrency 16
+    BENCH_SERVER=gevent python benchmark.py --load --concurrency 200
+    python benchmark.py --startup --sizes 10000
+    python benchmark.py --compare old.json new.json
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+
+# must be set before the app and its modules are imported
+os.environ.setdefault("ASSASSIN_STORAGE", "memory")
+os.environ.setdefault("EMAIL_TRANSPORT", "fake")
+# queued emails are left in the outbox, so background senders do not compete
+# with the operations being timed
+os.environ.setdefault("EMAIL_WORKER_THREADS", "0")
+# "threaded" werkzeug server for the load test, or "gevent" as served by serve.py
+BENCH_SERVER = os.environ.get("BENCH_SERVER", "threaded")
+if BENCH_SERVER == "gevent":
+    # gevent has to patch the standard library before anything else imports it
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import contextlib
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+
+import app
+import reads
+import storage
+from leaderboard import leaderboards
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, allocations=None):
+    """ ops/sec and latency percentiles (ms) of a list of per-operation seconds"""
+    total = sum(latencies)
+    summary = {
+        "ops": len(latencies),
+        "ops_per_sec": round(len(latencies) / total, 1) if total else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 4) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4) if latencies else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 4) if latencies else None,
+    }
+    if allocations:
+        summary["alloc_kib_per_op"] = round(statistics.fmean(allocations) / 1024, 2)
+    return summary
+
+
+def traced(operation, *args):
+    """ Calls operation and returns its result and the peak bytes it allocated"""
+    tracemalloc.start()
+    try:
+        result = operation(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+# -----------------------------------------------------------------
+# Synthetic games
+
+def reset_storage():
+    # the timed requests must not pay for the worker's warmup
+    app.warmup(games=0)
+    storage.memory_db.drop()
+    # the dropped collections took their indexes with them
+    app.create_indexes()
+    app.player_cache.clear()
+
+
+def create_synthetic_game(game_name: str, size: int):
+    """ Inserts size players and creates a game with all of them. Returns the seconds new_game took"""
+    netids = [f"bench{i}" for i in range(size)]
+    players = app.connect_to_db(collection_name="players")
+    players.insert_many([
+        app.build_player_doc(netid, f"Player {i} Bench", nickname=f"nick{i}")
+        for i, netid in enumerate(netids)])
+
+    start = time.perf_counter()
+    app.new_game(game_name, netids)
+    return time.perf_counter() - start
+
+
+class AliveSet:
+    """ Alive netids with O(1) random choice and removal, mirrored from the game"""
+
+    def __init__(self, netids):
+        self.netids = list(netids)
+        self.index = {netid: i for i, netid in enumerate(self.netids)}
+
+    def __len__(self):
+        return len(self.netids)
+
+    def choice(self):
+        return random.choice(self.netids)
+
+    def remove(self, netid):
+        i = self.index.pop(netid)
+        last = self.netids.pop()
+        if i < len(self.netids):
+            self.netids[i] = last
+            self.index[last] = i
+
+
+def bench_game(size: int, max_kills=None, unalive_every=20, alloc_samples=50, leaderboard_reads=200):
+    """ Replays a random game of size players until one is left (or max_kills) and times every operation"""
+    reset_storage()
+    game_name = f"bench-{size}"
+    new_game_seconds = create_synthetic_game(game_name, size)
+    alive = AliveSet(app.get_game_info(game_name)["alive_players"])
+    client = app.app.test_client()
+
+    kill_latencies, unalive_latencies, read_latencies = [], [], []
+    kill_allocations = []
+    # traced kills are slower, so they are left out of the latencies
+    alloc_every = max(1, (max_kills or size) // alloc_samples) if alloc_samples else 0
+    kills = 0
+    while len(alive) > 1 and (max_kills is None or kills < max_kills):
+        if unalive_every and kills % unalive_every == unalive_every - 1 and len(alive) > 2:
+            netid = alive.choice()
+            start = time.perf_counter()
+            app.unalive_player(game_name, netid)
+            unalive_latencies.append(time.perf_counter() - start)
+            alive.remove(netid)
+            kills += 1
+            continue
+
+        killer = alive.choice()
+        if alloc_every and kills % alloc_every == 0:
+            victim, peak = traced(app.killed_target, game_name, killer)
+            kill_allocations.append(peak)
+        else:
+            start = time.perf_counter()
+            victim = app.killed_target(game_name, killer)
+            kill_latencies.append(time.perf_counter() - start)
+        alive.remove(victim)
+        kills += 1
+
+        # a leaderboard read after some kills measures the rebuild
+        if leaderboard_reads and kills % max(1, (max_kills or size) // leaderboard_reads) == 0:
+            start = time.perf_counter()
+            client.get(f"/api/game-players/{game_name}")
+            read_latencies.append(time.perf_counter() - start)
+
+    # cached reads, with and without a matching ETag
+    cached_latencies, not_modified_latencies = [], []
+    etag = client.get(f"/api/game-players/{game_name}").headers["ETag"]
+    for _ in range(max(leaderboard_reads, 1)):
+        start = time.perf_counter()
+        client.get(f"/api/game-players/{game_name}")
+        cached_latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        client.get(f"/api/game-players/{game_name}", headers={"If-None-Match": etag})
+        not_modified_latencies.append(time.perf_counter() - start)
+
+    return {
+        "players": size,
+        "new_game_ms": round(new_game_seconds * 1000, 3),
+        "killed_target": summarize(kill_latencies, kill_allocations),
+        "unalive_player": summarize(unalive_latencies),
+        "leaderboard_rebuild": summarize(read_latencies),
+        "leaderboard_cached": summarize(cached_latencies),
+        "leaderboard_304": summarize(not_modified_latencies),
+    }
+
+
+# -----------------------------------------------------------------
+# HTTP load
+
+def serve_in_background(port: int):
+    """ Runs the app with a threaded werkzeug server, or gevent's, and returns its base url and a stop function"""
+    if BENCH_SERVER == "gevent":
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(("127.0.0.1", port), app.app, log=None)
+        server.start()
+        return f"http://127.0.0.1:{port}", server.stop
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", port, app.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}", server.shutdown
+
+
+def http_load(url: str, requests: int, concurrency: int, etag=False):
+    """ GETs url requests times from concurrency threads. Returns throughput and latency"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+    headers = {}
+    if etag:
+        with urllib.request.urlopen(url) as response:
+            headers["If-None-Match"] = response.headers["ETag"]
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    with lock:
+                        errors.append(e.code)
+                    continue
+            except OSError as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    summary = summarize(latencies)
+    summary["requests_per_sec"] = round(len(latencies) / wall, 1)
+    summary["concurrency"] = concurrency
+    summary["errors"] = len(errors)
+    return summary
+
+
+def stampede(url: str, game_name: str, rounds: int, concurrency: int):
+    """
+    After each of rounds kills, concurrency readers load the leaderboard at once, as when a
+    kill is announced. Returns their latency and how many rebuilds they shared
+    """
+    latencies = []
+    lock = threading.Lock()
+    alive = AliveSet(app.get_game_info(game_name)["alive_players"])
+    flights_before, misses_before = reads.flights.stats(), leaderboards.misses
+
+    def reader(barrier):
+        barrier.wait()
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            response.read()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    for _ in range(rounds):
+        if len(alive) < 2:
+            break
+        alive.remove(app.killed_target(game_name, alive.choice()))
+        barrier = threading.Barrier(concurrency)
+        threads = [threading.Thread(target=reader, args=(barrier,)) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    flights = reads.flights.stats()
+    summary = summarize(latencies)
+    summary["concurrency"] = concurrency
+    summary["rebuilds"] = flights["leaders"] - flights_before["leaders"]
+    summary["shared_rebuilds"] = flights["shared"] - flights_before["shared"]
+    summary["cache_misses"] = leaderboards.misses - misses_before
+    return summary
+
+
+def bench_http(size: int, requests: int, concurrency: int, url=None, port=5055, stampede_rounds=20):
+    """ Load test of the leaderboard endpoint, against url or a local server on the memory engine"""
+    stop = None
+    game_name = f"bench-{size}"
+    if url is None:
+        reset_storage()
+        create_synthetic_game(game_name, size)
+        url, stop = serve_in_background(port)
+    endpoint = f"{url}/api/game-players/{game_name}"
+    try:
+        result = {
+            "players": size,
+            "url": endpoint,
+            "server": BENCH_SERVER if stop is not None else None,
+            "full": http_load(endpoint, requests, concurrency),
+            "if_none_match": http_load(endpoint, requests, concurrency, etag=True),
+        }
+        # kills are made in this process, so only against the local server
+        if stop is not None and stampede_rounds:
+            result["after_kill"] = stampede(endpoint, game_name, stampede_rounds, concurrency)
+        return result
+    finally:
+        if stop is not None:
+            stop()
+
+
+# -----------------------------------------------------------------
+# Startup
+
+# run in a new process: imports the app, optionally warms it up and serves it
+STARTUP_SCRIPT = """
+import contextlib, json, os, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+
+setup = 0.0
+if {size} and app.app.config["ASSASSIN_STORAGE"] == "memory":
+    import benchmark
+    start = time.perf_counter()
+    benchmark.create_synthetic_game("startup", {size})
+    setup = time.perf_counter() - start
+
+start = time.perf_counter()
+if {warm}:
+    app.warmup()
+warmed = time.perf_counter() - start
+
+import logging
+from werkzeug.serving import make_server
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+server = make_server("127.0.0.1", {port}, app.app, threaded=True)
+print("STARTUP " + json.dumps({{"import": imported, "setup": setup, "warmup": warmed}}), flush=True)
+# nothing reads the pipe from here on
+sys.stdout = open(os.devnull, "w")
+server.serve_forever()
+"""
+
+
+def time_to_first_byte(url: str):
+    """ Seconds until the response headers of a GET arrive, the body is then read"""
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        elapsed = time.perf_counter() - start
+        response.read()
+    return elapsed
+
+
+def bench_startup(size: int, warm: bool, runs=3, port=5056):
+    """
+    Starts the app in new processes, as a host does after a lull, and times the import,
+    the warmup and the first leaderboard requests. The synthetic game is created in the
+    new process and its setup is left out of the times. Returns the median of the runs
+    """
+    env = dict(os.environ)
+    env.pop("BENCH_SERVER", None)
+    samples = []
+    for _ in range(runs):
+        spawned = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT.format(size=size, warm=warm, port=port)],
+                                   stdout=subprocess.PIPE, text=True, env=env)
+        try:
+            child = None
+            for line in process.stdout:
+                if line.startswith("STARTUP "):
+                    child = json.loads(line[len("STARTUP "):])
+                    break
+            if child is None:
+                raise RuntimeError(f"The app exited with {process.wait()} before serving")
+            ready = time.perf_counter() - spawned - child["setup"]
+            url = f"http://127.0.0.1:{port}/api/game-players/startup"
+            first = time_to_first_byte(url)
+            second = time_to_first_byte(url)
+        finally:
+            process.terminate()
+            process.wait()
+        samples.append({
+            "import_ms": child["import"] * 1000,
+            "warmup_ms": child["warmup"] * 1000,
+            "ready_ms": ready * 1000,
+            "first_request_ms": first * 1000,
+            "second_request_ms": second * 1000,
+            "time_to_first_byte_ms": (ready + first) * 1000,
+        })
+    summary = {key: round(statistics.median(sample[key] for sample in samples), 3) for key in samples[0]}
+    summary.update({"players": size, "warm": warm, "runs": runs})
+    return summary
+
+
+# -----------------------------------------------------------------
+# Results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path: str, new_path: str):
+    """ Prints the ops/sec and p99 of every benchmark in new relative to old"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    old_games = {game["players"]: game for game in old.get("games", [])}
+    for game in new.get("games", []):
+        before = old_games.get(game["players"])
+        if before is None:
+            continue
+        for name, result in game.items():
+            if not isinstance(result, dict) or name not in before or not result.get("ops_per_sec"):
+                continue
+            old_ops, old_p99 = before[name].get("ops_per_sec"), before[name].get("p99_ms")
+            if not old_ops or not old_p99:
+                continue
+            print(f"{game['players']:>7} {name:<22} ops/sec x{result['ops_per_sec'] / old_ops:6.2f}"
+                  f"   p99 x{result['p99_ms'] / old_p99:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated player counts")
+    parser.add_argument("--max-kills", type=int, default=None, help="stop each game after this many kills")
+    parser.add_argument("--load", action="store_true", help="also run the HTTP load test")
+    parser.add_argument("--startup", action="store_true",
+                        help="only time the startup of new processes, cold and warmed up")
+    parser.add_argument("--url", default=None, help="load test a running server instead of a local one")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    random.seed(args.seed)
+    # the fake transport prints every email it sends
+    quiet = open(os.devnull, "w")
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "storage": app.app.config["ASSASSIN_STORAGE"],
+        "games": [],
+        "http": [],
+        "startup": [],
+    }
+    if args.startup:
+        for size in sizes:
+            for warm in (False, True):
+                result = bench_startup(size, warm)
+                results["startup"].append(result)
+                print(json.dumps(result))
+        sizes = []
+    for size in sizes:
+        with contextlib.redirect_stdout(quiet):
+            result = bench_game(size, max_kills=args.max_kills)
+        results["games"].append(result)
+        print(json.dumps(result))
+    if args.load:
+        for size in sizes:
+            with contextlib.redirect_stdout(quiet):
+                result = bench_http(size, args.requests, args.concurrency, url=args.url)
+            results["http"].append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+MongoDB client registry. One pooled client per worker process.
+With the "memory" storage backend, collections come from the in-memory engine instead.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+import threading
+import time
+
+import pymongo
+from pymongo import monitoring
+from pymongo.collection import Collection
+
+import metrics
+import storage
+
+
+DB_NAME = "assassin"
+
+# "mongo" or "memory", see use_storage
+STORAGE = os.environ.get("ASSASSIN_STORAGE", "mongo")
+
+# Pool settings, tunable per deployment through the environment
+MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))
+MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000))
+CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000))
+SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 10000))
+
+
+# -----------------------------------------------------------------
+# Pool stats
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so the pool can be inspected at runtime"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.created = 0
+            self.closed = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.clears = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "open": self.created - self.closed,
+                "in_use": self.checked_out,
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "pool_cleared": self.clears,
+            }
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.clears += 1
+
+    # unused pool events
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+pool_stats = PoolStats()
+
+
+# -----------------------------------------------------------------
+# Client registry
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def get_client() -> pymongo.MongoClient:
+    """
+    Returns the process-wide MongoClient, creating it on first use.
+    A client inherited from a parent process (Gunicorn pre-fork) is never reused.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            # read on first use, the memory backend needs no db_info
+            from db_info import MONGODB_URI
+            _client = pymongo.MongoClient(
+                MONGODB_URI,
+                maxPoolSize=MAX_POOL_SIZE,
+                minPoolSize=MIN_POOL_SIZE,
+                maxIdleTimeMS=MAX_IDLE_TIME_MS,
+                connectTimeoutMS=CONNECT_TIMEOUT_MS,
+                serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS,
+                socketTimeoutMS=SOCKET_TIMEOUT_MS,
+                event_listeners=[pool_stats],
+            )
+            _client_pid = pid
+        return _client
+
+
+def warmup(connections=1):
+    """
+    Creates the client of this process and opens connections to the server at the same
+    time, so the first requests do not pay for DNS, TLS and authentication.
+    Returns the number of open connections. A no-op with the memory backend
+    """
+    if STORAGE == "memory":
+        return 0
+    client = get_client()
+
+    def ping():
+        try:
+            client.admin.command("ping")
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to open a db connection: {e}")
+
+    threads = [threading.Thread(target=ping) for _ in range(connections - 1)]
+    for thread in threads:
+        thread.start()
+    # the calling thread's ping raises, so a down server fails the warmup
+    client.admin.command("ping")
+    for thread in threads:
+        thread.join()
+    return pool_stats.snapshot()["open"]
+
+
+def use_storage(backend: str):
+    """
+    Selects where collections live: "mongo" or "memory"
+    """
+    global STORAGE
+    if backend not in ("mongo", "memory"):
+        raise ValueError(f"Unknown storage backend {backend}")
+    STORAGE = backend
+
+
+def get_collection(collection_name: str) -> Collection:
+    """
+    Returns a handle to a collection of the assassin db on the pooled client,
+    or the in-memory collection of that name with the memory backend.
+    Operations made through the handle are counted and timed by metrics
+    """
+    if STORAGE == "memory":
+        return metrics.instrument_collection(storage.memory_db[collection_name])
+    return metrics.instrument_collection(get_client()[DB_NAME][collection_name])
+
+
+def games_collection() -> Collection:
+    return get_collection("games")
+
+
+def players_collection() -> Collection:
+    return get_collection("players")
+
+
+def run_transaction(callback):
+    """
+    Runs callback(session) as one multi-document transaction, retried on transient
+    errors, and returns its result. Mongo transactions need a replica set, which
+    Atlas always is. The memory engine runs transactions one at a time instead,
+    with no rollback if the callback raises
+    """
+    if STORAGE == "memory":
+        with storage.memory_db.transaction_lock:
+            return callback(None)
+    with get_client().start_session() as session:
+        return session.with_transaction(callback)
+
+
+def ensure_indexes():
+    """
+    Unique game names and netids, and the index of the games each player is in.
+    Safe to call on every startup, existing indexes are left alone
+    """
+    games_collection().create_index("name", unique=True)
+    players_collection().create_index("netid", unique=True)
+    players_collection().create_index("games")
+
+
+def close_client():
+    """
+    Closes the client of this process. The next get_client() call opens a new one
+    """
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def _reset_after_fork():
+    # The child must not touch the parent's sockets or monitor threads,
+    # so just drop the reference and let the child build its own client.
+    global _client, _client_pid, _lock
+    _client = None
+    _client_pid = None
+    _lock = threading.Lock()
+    pool_stats._lock = threading.Lock()
+    pool_stats.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# -----------------------------------------------------------------
+# Introspection
+
+def ping():
+    """
+    Round trips to the server. Returns a dict describing the health of the connection
+    """
+    if STORAGE == "memory":
+        return {"ok": True, "latency_ms": 0.0, "storage": "memory"}
+    start = time.perf_counter()
+    try:
+        get_client().admin.command("ping")
+    except pymongo.errors.PyMongoError as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": True, "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+def health():
+    """
+    Health of this worker's client, including the pool stats
+    """
+    status = ping()
+    status["pid"] = os.getpid()
+    status["pool"] = pool_stats.snapshot()
+    status["settings"] = {
+        "max_pool_size": MAX_POOL_SIZE,
+        "min_pool_size": MIN_POOL_SIZE,
+        "max_idle_time_ms": MAX_IDLE_TIME_MS,
+        "connect_timeout_ms": CONNECT_TIMEOUT_MS,
+        "server_selection_timeout_ms": SERVER_SELECTION_TIMEOUT_MS,
+        "socket_timeout_ms": SOCKET_TIMEOUT_MS,
+    }
+    return status
@@ -0,0 +1,104 @@
+"""
+Email templates. Each kind of email has a subject, an HTML body and a plain-text body,
+compiled once, on the first send, and rendered from the player's context.
+Names are escaped in the HTML body.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import threading
+
+from jinja2 import DictLoader, Environment, StrictUndefined, select_autoescape
+
+
+REMINDER_HTML = """\
+<p>Reminder:</p>
+<ul>
+    <li>Film your kill, and send it in the Assassin GroupMe for it to be confirmed.</li>
+</ul>
+<p>Happy hunting!</p>
+<p>Good luck,</p>
+<p>HQ</p>
+"""
+
+TEMPLATES = {
+    "reminder.html": REMINDER_HTML,
+
+    "new_target.subject": "{% if welcome %}Your First Target{% else %}Your New Target{% endif %}",
+    "new_target.html": """\
+<p>Hello {{ player.fullAssassinName }},</p>
+{% if welcome %}
+<p>Welcome to Assassin!<br> <br>
+Your first target is:<br>
+{% else %}
+<p>Your new target is:<br>
+{% endif %}
+<strong>{{ target.fullAssassinName }}</strong></p>
+{% include "reminder.html" %}
+""",
+    "new_target.txt": """\
+Hello {{ player.fullAssassinName }},
+
+{% if welcome %}
+Welcome to Assassin!
+
+Your first target is: {{ target.fullAssassinName }}
+{% else %}
+Your new target is: {{ target.fullAssassinName }}
+{% endif %}
+
+Reminder: film your kill, and send it in the Assassin GroupMe for it to be confirmed.
+
+Happy hunting!
+Good luck,
+HQ
+""",
+
+    "slain.subject": "You Have Been Slain",
+    "slain.html": """\
+<p>Hello {{ player.fullAssassinName }},</p>
+<p>Unfortunately, you have been slain in the game of Assassin. Your journey has come to an end.</p>
+<p>Thanks for participating in the game. We hope you enjoyed it.</p>
+<p>Regards,</p>
+<p>HQ</p>
+""",
+    "slain.txt": """\
+Hello {{ player.fullAssassinName }},
+
+Unfortunately, you have been slain in the game of Assassin. Your journey has come to an end.
+Thanks for participating in the game. We hope you enjoyed it.
+
+Regards,
+HQ
+""",
+}
+
+_environment = Environment(
+    loader=DictLoader(TEMPLATES),
+    autoescape=select_autoescape(enabled_extensions=("html",), default_for_string=False),
+    undefined=StrictUndefined,
+    trim_blocks=True,
+    lstrip_blocks=True,
+)
+_templates = None
+_templates_lock = threading.Lock()
+
+
+def compiled_templates():
+    """ Every template, compiled on first use. Rendering is then a call of the compiled template"""
+    global _templates
+    if _templates is None:
+        with _templates_lock:
+            if _templates is None:
+                _templates = {name: _environment.get_template(name) for name in TEMPLATES}
+    return _templates
+
+
+def render(kind: str, **context):
+    """ The (subject, html, text) of the email kind ("new_target" or "slain") for the context"""
+    templates = compiled_templates()
+    return (
+        templates[f"{kind}.subject"].render(context),
+        templates[f"{kind}.html"].render(context),
+        templates[f"{kind}.txt"].render(context),
+    )
@@ -0,0 +1,196 @@
+"""
+Live leaderboard updates. One watcher thread per worker process notices new game
+versions, diffs the materialized leaderboards and fans the changes out to every
+subscribed stream. Subscribers are just queues, so idle streams cost no thread of
+their own; run Gunicorn with gevent workers (gunicorn -k gevent app:app) to hold
+thousands of open streams per worker.
+
+A stream never ends, so a sync worker serving one serves nothing else until it times
+out. Streams are only served where streams_enabled(), by default gevent workers, and
+the frontend polls the leaderboard with its ETag unless it is built to stream.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import json
+import os
+import queue
+import threading
+
+
+# how often the watcher checks for changes made by other workers
+POLL_SECONDS = float(os.environ.get("STREAM_POLL_SECONDS", 2))
+# comment line sent to idle streams so proxies keep them open
+KEEPALIVE_SECONDS = 15
+# events a slow subscriber may fall behind before it is asked to reload
+SUBSCRIBER_BUFFER = 100
+# "true" or "false" forces streams on or off, otherwise only gevent workers serve them
+STREAMS = os.environ.get("LEADERBOARD_STREAMS")
+
+
+def streams_enabled():
+    """ Whether this process can hold open streams: it runs on gevent, where a stream is a greenlet"""
+    if STREAMS is not None:
+        return STREAMS == "true"
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def leaderboard_diff(old_rows, new_rows):
+    """
+    The changes between two builds of a game's leaderboard, as (event, data) pairs:
+    a "kills" event when a player's kill count changed, "died" when they stopped being alive,
+    "revived" when an undone kill made them alive again and "joined" for new players
+    """
+    old = {row['netid']: row for row in old_rows}
+    events = []
+    for row in new_rows:
+        before = old.get(row['netid'])
+        if before is None:
+            events.append(("joined", row))
+            continue
+        if row['kills'] != before['kills']:
+            events.append(("kills", {"netid": row['netid'], "kills": row['kills']}))
+        if before['isAlive'] and not row['isAlive']:
+            events.append(("died", {"netid": row['netid']}))
+        elif not before['isAlive'] and row['isAlive']:
+            events.append(("revived", {"netid": row['netid']}))
+    return events
+
+
+def format_event(event: str, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class LeaderboardBroker:
+    """
+    In-process pub/sub of leaderboard changes, keyed by game.
+    load_leaderboard(game_name) returns the current materialized leaderboard or None
+    """
+
+    def __init__(self, load_leaderboard):
+        self.load_leaderboard = load_leaderboard
+        self._subscribers = {}
+        self._leaderboards = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._watcher_pid = None
+
+    def subscribe(self, game_name: str, leaderboard=None):
+        """
+        A queue that receives the formatted events of the game, or None if the game
+        cannot be loaded. The first subscriber of a game loads its leaderboard, unless
+        it is given, outside the lock so db reads do not hold up other subscribers
+        """
+        with self._lock:
+            watched = game_name in self._subscribers
+        if not watched and leaderboard is None:
+            leaderboard = self.load_leaderboard(game_name)
+            if leaderboard is None:
+                return None
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_BUFFER)
+        with self._lock:
+            if game_name not in self._subscribers:
+                self._subscribers[game_name] = set()
+            if leaderboard is not None:
+                self._leaderboards.setdefault(game_name, leaderboard)
+            self._subscribers[game_name].add(subscriber)
+        self._start_watcher()
+        return subscriber
+
+    def unsubscribe(self, game_name: str, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(game_name)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[game_name]
+                self._leaderboards.pop(game_name, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def notify(self, game_name: str):
+        """ Called after a commit in this process, so its streams update without waiting for the poll"""
+        self._wakeup.set()
+
+    def publish(self, game_name: str):
+        """ Diffs the game against the last leaderboard its streams saw and sends the changes"""
+        with self._lock:
+            if game_name not in self._subscribers:
+                return
+            previous = self._leaderboards.get(game_name)
+        leaderboard = self.load_leaderboard(game_name)
+        if leaderboard is None or (previous is not None and leaderboard.version == previous.version):
+            return
+
+        if previous is None:
+            messages = [format_event("reload", {})]
+        else:
+            messages = [format_event(event, data) for event, data in leaderboard_diff(previous.rows, leaderboard.rows)]
+        messages.append(format_event("version", {"version": leaderboard.version, "etag": leaderboard.etag}))
+
+        with self._lock:
+            self._leaderboards[game_name] = leaderboard
+            subscribers = list(self._subscribers.get(game_name, ()))
+        for subscriber in subscribers:
+            for message in messages:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    # too far behind to patch, have it fetch the whole leaderboard again
+                    _replace_with_reload(subscriber)
+                    break
+
+    def _watch(self):
+        while True:
+            self._wakeup.wait(POLL_SECONDS)
+            self._wakeup.clear()
+            with self._lock:
+                game_names = list(self._subscribers)
+            for game_name in game_names:
+                try:
+                    self.publish(game_name)
+                except Exception as e:
+                    print(f"Failed to publish leaderboard of {game_name}: {e}")
+
+    def _start_watcher(self):
+        # threads do not survive a fork, so each worker starts its own
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name="leaderboard-watcher", daemon=True).start()
+
+    def stream(self, game_name: str, leaderboard=None):
+        """
+        Generator of the SSE messages of a game, for a streaming response. Ends at once if
+        the game cannot be loaded, so check that the game exists before streaming it
+        """
+        subscriber = self.subscribe(game_name, leaderboard)
+        if subscriber is None:
+            return
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    message = subscriber.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    message = ": keepalive\n\n"
+                yield message
+        finally:
+            self.unsubscribe(game_name, subscriber)
+
+
+def _replace_with_reload(subscriber):
+    try:
+        while True:
+            subscriber.get_nowait()
+    except queue.Empty:
+        pass
+    subscriber.put_nowait(format_event("reload", {}))
@@ -0,0 +1,132 @@
+"""
+Roster and target export of a game for admins: every player with their kills, whether
+they are alive and their target, alive players in ring order and then the dead in the
+order they died. Written as NDJSON or CSV in chunks, so a roster of any size is streamed
+without building the whole output.
+
+    python export.py ivy --format csv --output ivy.csv
+"""
+__author__ = 'Pierce Maloney'
+
+
+import argparse
+import csv
+import io
+import sys
+
+import db
+from leaderboard import encode_json
+
+
+FIELDS = ("netid", "name", "assassin_name", "kills", "alive", "target", "target_name", "target_assassin_name")
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# rows encoded per chunk written
+CHUNK_ROWS = 1000
+
+
+def player_names(game_name: str, netids):
+    """
+    {netid: (name, fullAssassinName)} of the players of the game, from one query on
+    their games, plus a lookup of any player whose membership was never recorded
+    """
+    collection = db.get_collection("players")
+    projection = {"_id": 0, "netid": 1, "name": 1, "fullAssassinName": 1}
+    names = {player["netid"]: (player.get("name"), player.get("fullAssassinName"))
+             for player in collection.find({"games": game_name}, projection)}
+    missing = [netid for netid in netids if netid not in names]
+    if missing:
+        for player in collection.find({"netid": {"$in": missing}}, projection):
+            names[player["netid"]] = (player.get("name"), player.get("fullAssassinName"))
+    return names
+
+
+def ring_order(game):
+    """ The alive players of the GameState, each followed by their target"""
+    if not game.alive:
+        return
+    first = netid = next(iter(game.alive))
+    for _ in range(len(game.alive)):
+        yield netid
+        netid = game.target_of(netid)
+        if netid == first:
+            return
+
+
+def export_rows(game, names):
+    """ Yields the row of every player of the GameState, with the names of {netid: (name, fullAssassinName)}"""
+    unknown = (None, None)
+    for netid in list(ring_order(game)) + list(game.dead):
+        target = game.target_of(netid)
+        name, assassin_name = names.get(netid, unknown)
+        target_name, target_assassin_name = names.get(target, unknown) if target else unknown
+        yield {
+            "netid": netid,
+            "name": name,
+            "assassin_name": assassin_name,
+            "kills": game.kills.get(netid, 0),
+            "alive": game.is_alive(netid),
+            "target": target,
+            "target_name": target_name,
+            "target_assassin_name": target_assassin_name,
+        }
+
+
+def _chunks(rows, chunk_rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def to_ndjson(rows, chunk_rows=CHUNK_ROWS):
+    """ Yields the rows as chunks of newline delimited JSON"""
+    for chunk in _chunks(rows, chunk_rows):
+        yield b"".join(encode_json(row) + b"\n" for row in chunk)
+
+
+def to_csv(rows, chunk_rows=CHUNK_ROWS):
+    """ Yields the rows as chunks of CSV, starting with the header"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for chunk in _chunks(rows, chunk_rows):
+        writer.writerows([row[field] for field in FIELDS] for row in chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def encode(rows, export_format: str):
+    return to_csv(rows) if export_format == "csv" else to_ndjson(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("game")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("--output", default=None, help="write to this file instead of stdout")
+    args = parser.parse_args()
+
+    import app
+
+    game = app.get_game_state(args.game)
+    if game is None:
+        raise SystemExit(1)
+    names = player_names(args.game, game.kills)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in encode(export_rows(game, names), args.format):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
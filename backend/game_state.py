@@ -0,0 +1,244 @@
+"""
+In-memory game state. The target ring is kept as forward (targets) and reverse
+(hunters) maps so kills, unalives, inserts and "who has me" lookups are O(1).
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+import random
+
+from lru import LRUCache
+
+
+class GameState:
+    """
+    A game loaded from its db document. alive and dead are dicts used as ordered
+    sets, so membership checks are O(1) and the list order of the document survives
+    a round trip through from_doc/to_doc.
+    """
+    __slots__ = ("_id", "name", "kills", "targets", "hunters", "alive", "dead", "extra")
+
+    def __init__(self, name: str, kills=None, targets=None, alive_players=(), dead_players=(), _id=None):
+        self._id = _id
+        self.name = name
+        # netid: kill_count
+        self.kills = dict(kills or {})
+        # netid: netid of their target, and the reverse
+        self.targets = dict(targets or {})
+        self.hunters = {target: netid for netid, target in self.targets.items()}
+        self.alive = dict.fromkeys(alive_players)
+        self.dead = dict.fromkeys(dead_players)
+        # fields of the document the game state does not manage
+        self.extra = {}
+
+    @classmethod
+    def from_doc(cls, game_info: dict):
+        game = cls(
+            game_info["name"],
+            kills=game_info["players"],
+            targets=game_info["targets"],
+            alive_players=game_info["alive_players"],
+            dead_players=game_info["dead_players"],
+            _id=game_info.get("_id"),
+        )
+        game.extra = {k: v for k, v in game_info.items()
+                      if k not in ("_id", "name", "players", "targets", "alive_players", "dead_players")}
+        return game
+
+    def to_doc(self):
+        game_info = dict(self.extra)
+        if self._id is not None:
+            game_info["_id"] = self._id
+        game_info.update({
+            "name": self.name,
+            "players": dict(self.kills),
+            "targets": dict(self.targets),
+            "alive_players": list(self.alive),
+            "dead_players": list(self.dead),
+        })
+        return game_info
+
+    def copy(self):
+        game = GameState.__new__(GameState)
+        game._id = self._id
+        game.name = self.name
+        game.kills = dict(self.kills)
+        game.targets = dict(self.targets)
+        game.hunters = dict(self.hunters)
+        game.alive = dict(self.alive)
+        game.dead = dict(self.dead)
+        game.extra = dict(self.extra)
+        return game
+
+    @classmethod
+    def new(cls, name: str, player_list=()):
+        """ A game where each player's target is the next player in a random order"""
+        game = cls(name, kills=dict.fromkeys(player_list, 0))
+        alive_players = list(player_list)
+        random.shuffle(alive_players)
+        game.alive = dict.fromkeys(alive_players)
+        game._link_ring(alive_players)
+        return game
+
+    # lookups
+
+    def is_alive(self, netid: str):
+        return netid in self.alive
+
+    def target_of(self, netid: str):
+        return self.targets.get(netid)
+
+    def hunter_of(self, netid: str):
+        """ The player who has netid as their target"""
+        return self.hunters.get(netid)
+
+    # mutations
+
+    def _link(self, hunter: str, target: str):
+        self.targets[hunter] = target
+        self.hunters[target] = hunter
+
+    def _link_ring(self, order):
+        for i in range(len(order)):
+            self._link(order[i], order[(i + 1) % len(order)])
+
+    def _remove_from_ring(self, netid: str):
+        """ Hands netid's target to their hunter and moves netid to the dead"""
+        hunter = self.hunters.pop(netid)
+        target = self.targets.pop(netid)
+        if hunter != netid:
+            self._link(hunter, target)
+        del self.alive[netid]
+        self.dead[netid] = None
+        return hunter, target
+
+    def kill(self, killer: str):
+        """
+        killer kills their target, who is removed from the ring.
+        Returns the victim's netid, or None if the killer is not alive
+        """
+        if killer not in self.alive:
+            return None
+        victim = self.targets[killer]
+        if victim == killer:
+            return None
+        self._remove_from_ring(victim)
+        self.kills[killer] = self.kills.get(killer, 0) + 1
+        return victim
+
+    def unalive(self, netid: str):
+        """
+        Removes netid from the ring without giving anyone a kill.
+        Returns the player who had them, or None if they were not alive
+        """
+        if netid not in self.alive:
+            return None
+        hunter, _ = self._remove_from_ring(netid)
+        return hunter
+
+    def insert(self, netid: str, hunter=None):
+        """
+        Adds netid to the game as alive and splices them into the ring right after
+        hunter. O(1) when hunter is given, otherwise a random alive player is picked.
+        Returns False if they were already in the game
+        """
+        if netid in self.kills:
+            return False
+        self.kills[netid] = 0
+        if hunter is None and self.alive:
+            hunter = random.choice(list(self.alive))
+        self.alive[netid] = None
+        if hunter is None:
+            self._link(netid, netid)
+        else:
+            self._link(netid, self.targets[hunter])
+            self._link(hunter, netid)
+        return True
+
+    def insert_many(self, netids):
+        """
+        Adds every netid not already in the game, each spliced in after a random alive
+        player (newcomers included). Returns the netids that were added
+        """
+        order = list(self.alive)
+        added = []
+        for netid in netids:
+            hunter = random.choice(order) if order else None
+            if self.insert(netid, hunter):
+                order.append(netid)
+                added.append(netid)
+        return added
+
+    def shuffle(self):
+        """ Reassigns the targets of the alive players to a new random ring"""
+        order = list(self.alive)
+        random.shuffle(order)
+        self.set_ring(order)
+
+    def set_ring(self, order):
+        """ Makes order the alive players, each targeting the next one"""
+        self.alive = dict.fromkeys(order)
+        self.targets = {}
+        self.hunters = {}
+        self._link_ring(order)
+
+    def join(self, added, targets):
+        """
+        Adds the added netids as alive and sets the given targets, the links that
+        changed when they were spliced into the ring. Replays an insert_many
+        """
+        for netid in added:
+            self.kills[netid] = 0
+            self.alive[netid] = None
+        for hunter, target in targets.items():
+            self._link(hunter, target)
+
+    def undo_kill(self, killer: str, victim: str):
+        """
+        Brings victim back to life as killer's target, with killer's current target
+        as their own, and takes the kill back. Returns False if killer is no longer
+        alive or victim is not dead
+        """
+        if killer not in self.alive or victim not in self.dead:
+            return False
+        self.kills[killer] -= 1
+        del self.dead[victim]
+        self.alive[victim] = None
+        self._link(victim, self.targets[killer])
+        self._link(killer, victim)
+        return True
+
+
+class GameStateCache(LRUCache):
+    """
+    GameStates of the most recently used games, so hot games are not reloaded from
+    their (large) documents on every request while cold ones are evicted.
+    An entry is only valid for the game version it holds, and callers get copies
+    """
+
+    def __init__(self, max_games=16):
+        super().__init__(max_games)
+
+    def get(self, game_name: str, version):
+        game = super().get(game_name, lambda game: game.extra.get("version") == version)
+        return None if game is None else game.copy()
+
+    def put(self, game: GameState):
+        super().put(game.name, game.copy())
+
+    def advance(self, game_name: str, version, change):
+        """
+        Applies change(game) to the cached game if it is at the version right before
+        version, so a small update does not make the next read reload the whole game.
+        change returns False if it does not apply, and the entry is dropped
+        """
+        def advance_game(game):
+            if game.extra.get("version", 0) != version - 1 or change(game) is False:
+                return False
+            game.extra["version"] = version
+
+        self.update(game_name, advance_game)
+
+
+game_cache = GameStateCache(max_games=int(os.environ.get("GAME_CACHE_SIZE", 16)))
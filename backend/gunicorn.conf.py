@@ -0,0 +1,33 @@
+"""
+Gunicorn settings, read by default from the working directory:
+
+    gunicorn app:app
+
+Workers are sync workers unless GUNICORN_WORKER_CLASS=gevent selects gevent workers,
+which hold many leaderboard streams each (see serve.py and reads.py). Sync workers do
+not serve streams (see events.py), so the frontend polls the leaderboard by default.
+Either way each worker warms up before it accepts traffic, so the first leaderboard load
+after a host spins a worker up does not pay for the db connections and the first game
+loads. The warmup stays short: the player search index is built by the first search.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+# the app is imported by each worker, after gevent patched it when gevent workers are
+# used; a preloaded app would import pymongo and ssl before the patching
+preload_app = False
+
+
+def post_worker_init(worker):
+    """ Runs in the worker after the app is imported and before it accepts requests"""
+    import app
+
+    timings = app.warmup()
+    worker.log.info(f"Worker {worker.pid} warmed up: {timings}")
@@ -0,0 +1,216 @@
+"""
+Idempotency keys for the admin endpoints that change a game. A client that sends an
+Idempotency-Key header (or ?idempotency_key=) with a POST can retry it safely: the first
+request with the key runs and its response is stored, and every retry gets that response
+back without running the kill or add again.
+
+Responses are stored in the idempotency collection, whose TTL index drops them after
+TTL_SECONDS, and the most recent ones are kept in a bounded LRU of this worker, so a
+retry is answered without a db read. A key is claimed before the request runs, so a
+retry that arrives while the first request is still running gets a 409 instead of
+running it a second time. A claim whose request failed with a 5xx, or lost to concurrent
+updates with a 409, is released so a retry runs it again. A claim is never taken over:
+one still without a response after PENDING_SECONDS belongs to a worker that died or
+could not store it, and whether the request ran is unknown, so retries are refused
+until it expires rather than risking a second kill.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+import pymongo
+from bson import Binary
+from flask import abort, jsonify, make_response, request
+
+import db
+from lru import LRUCache
+import metrics
+
+
+IDEMPOTENCY_COLLECTION = "idempotency"
+
+# stored responses are replayed for this long
+TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 86400))
+# a claim not completed this long after it was made has an unknown outcome
+PENDING_SECONDS = float(os.environ.get("IDEMPOTENCY_PENDING_SECONDS", 120))
+# writes of a response to the db before it is only kept in this worker
+STORE_ATTEMPTS = 3
+CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 1000))
+MAX_KEY_LENGTH = 255
+HEADER = "Idempotency-Key"
+# statuses of responses that are not stored, so a retry with the key runs the request again:
+# 409 is an update that lost to concurrent updates (see app.Conflict), and 5xx a failure
+RETRYABLE_STATUSES = {409}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _aware(when: datetime):
+    """ pymongo returns naive UTC datetimes"""
+    return when if when.tzinfo else when.replace(tzinfo=timezone.utc)
+
+
+def idempotency_collection():
+    return db.get_collection(IDEMPOTENCY_COLLECTION)
+
+
+def ensure_indexes():
+    """ Unique keys, and a TTL index that drops each record at its expires_at"""
+    collection = idempotency_collection()
+    collection.create_index("key", unique=True)
+    collection.create_index("expires_at", expireAfterSeconds=0)
+
+
+def fingerprint(method: str, path: str, body: bytes):
+    """ Identifies the request a key was first used with. The api key is left out"""
+    digest = hashlib.sha256(f"{method} {path}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+# stored (fingerprint, status, body, mimetype) of the most recent keys, expiring with their records
+responses = LRUCache(CACHE_SIZE, TTL_SECONDS)
+
+
+# -----------------------------------------------------------------
+# Claims
+
+def claim(key: str, request_fingerprint: str):
+    """
+    Claims the key for a request, or finds what it was used for before. Returns None
+    once claimed, else the stored (fingerprint, status, body, mimetype), or
+    (fingerprint, None, None, created_at) while the request that claimed it has no response
+    """
+    now = _now()
+    collection = idempotency_collection()
+    try:
+        collection.insert_one({
+            "key": key,
+            "fingerprint": request_fingerprint,
+            "status": None,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=TTL_SECONDS),
+        })
+        return None
+    except pymongo.errors.DuplicateKeyError:
+        pass
+
+    record = collection.find_one({"key": key})
+    if record is None:
+        # expired since the insert
+        return claim(key, request_fingerprint)
+    if record["status"] is None:
+        return record["fingerprint"], None, None, _aware(record["created_at"])
+    return record["fingerprint"], record["status"], bytes(record["body"]), record.get("mimetype")
+
+
+def complete(key: str, stored: tuple):
+    """
+    Stores the response of the request that claimed the key, for TTL_SECONDS. It is kept
+    in this worker first, so a db that cannot take it leaves retries here answered and
+    the claim refusing retries everywhere else
+    """
+    responses.put(key, stored)
+    request_fingerprint, status, body, mimetype = stored
+    for attempt in range(STORE_ATTEMPTS):
+        try:
+            idempotency_collection().update_one({"key": key}, {"$set": {
+                "status": status,
+                "body": Binary(body),
+                "mimetype": mimetype,
+                "expires_at": _now() + timedelta(seconds=TTL_SECONDS),
+            }})
+            return True
+        except pymongo.errors.PyMongoError as e:
+            print(f"Failed to store the response of idempotency key {key} (attempt {attempt + 1}): {e}")
+            time.sleep(0.1 * 2 ** attempt)
+    return False
+
+
+def release(key: str):
+    """ Drops the claim of a request that failed, so a retry runs it again"""
+    idempotency_collection().delete_one({"key": key, "status": None})
+
+
+# -----------------------------------------------------------------
+# Decorator
+
+def _release(key: str):
+    try:
+        release(key)
+        metrics.idempotent_requests.inc(outcome="released")
+    except pymongo.errors.PyMongoError as e:
+        # retries are refused until the claim expires, never run twice
+        print(f"Failed to release idempotency key {key}: {e}")
+
+
+def _replay(stored: tuple):
+    _, status, body, mimetype = stored
+    response = make_response(body, status)
+    response.mimetype = mimetype
+    response.headers["Idempotent-Replayed"] = "true"
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    metrics.idempotent_requests.inc(outcome="replayed")
+    return response
+
+
+def _error(message: str, status: int):
+    response = jsonify(message)
+    response.status_code = status
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+
+
+def idempotent(f):
+    """
+    Makes a route safe to retry with an idempotency key. Requests without one run as before.
+    A key reused for a different request is a 422, and one whose request is running a 409
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get(HEADER) or request.args.get('idempotency_key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            abort(400)
+        request_fingerprint = fingerprint(request.method, request.path, request.get_data())
+
+        stored = responses.get(key)
+        if stored is None:
+            try:
+                stored = claim(key, request_fingerprint)
+            except pymongo.errors.PyMongoError as e:
+                print(f"Failed to claim idempotency key {key}: {e}")
+                return _error("Could not check the idempotency key, try again", 503)
+        if stored is not None:
+            if stored[0] != request_fingerprint:
+                metrics.idempotent_requests.inc(outcome="mismatch")
+                return _error(f"Idempotency key {key} was used for a different request", 422)
+            if stored[1] is None:
+                metrics.idempotent_requests.inc(outcome="in_progress")
+                if stored[3] + timedelta(seconds=PENDING_SECONDS) < _now():
+                    return _error(f"The request with idempotency key {key} did not record its outcome, "
+                                  f"check the game before sending it again with a new key", 409)
+                return _error(f"A request with idempotency key {key} is still running", 409)
+            return _replay(stored)
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+        if response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES:
+            _release(key)
+        elif complete(key, (request_fingerprint, response.status_code, response.get_data(), response.mimetype)):
+            metrics.idempotent_requests.inc(outcome="stored")
+        else:
+            metrics.idempotent_requests.inc(outcome="unstored")
+        return response
+    return decorated_function
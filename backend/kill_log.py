@@ -0,0 +1,262 @@
+"""
+Append-only log of every change to a game. Each change that bumps a game's version
+to n is recorded as event n of that game, so the game document is a projection of
+its log: the latest snapshot plus the events after it rebuild the game at any version.
+
+    created  {"ring": [...]}                        the players, in ring order
+    kill     {"killer", "victim", "target"}        target is who the killer inherited
+    kills    {"kills": [{"killer", "victim", "target"}, ...]}   a batch, in order
+    unalive  {"netid"}
+    join     {"added": [...], "targets": {...}}    or "ring" when the game was reshuffled
+    shuffle  {"ring": [...]}
+    undo     {"seq", "killer", "victim"}           takes back the kill event seq, or with
+             "index" the kill at that index of the kills event seq
+
+An event is written right after the game update it describes commits. If the process
+dies in between, the log has a gap and rebuilding past it fails rather than guessing,
+and undoing the last kill is refused, since the missing event may be a later kill.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+import threading
+from datetime import datetime, timezone
+
+import pymongo
+
+import db
+import memberships
+import metrics
+from game_state import GameState
+
+
+EVENTS_COLLECTION = "game_events"
+SNAPSHOTS_COLLECTION = "game_snapshots"
+
+# a snapshot of the game is stored every this many events
+SNAPSHOT_EVERY = int(os.environ.get("GAME_SNAPSHOT_EVERY", 500))
+# older snapshots are deleted, earlier versions are rebuilt from the start of the log
+SNAPSHOTS_KEPT = int(os.environ.get("GAME_SNAPSHOTS_KEPT", 5))
+
+
+def events_collection():
+    return db.get_collection(EVENTS_COLLECTION)
+
+
+def snapshots_collection():
+    return db.get_collection(SNAPSHOTS_COLLECTION)
+
+
+_indexes_pid = None
+_indexes_lock = threading.Lock()
+
+
+def ensure_indexes(force=False):
+    """ Creates the indexes of the log once per process, or again with force"""
+    global _indexes_pid
+    if _indexes_pid == os.getpid() and not force:
+        return
+    with _indexes_lock:
+        if _indexes_pid == os.getpid() and not force:
+            return
+        events_collection().create_index(
+            [("game", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], unique=True)
+        snapshots_collection().create_index(
+            [("game", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], unique=True)
+        _indexes_pid = os.getpid()
+
+
+# -----------------------------------------------------------------
+# Writing
+
+def record(game_name: str, seq, event_type: str, data: dict):
+    """
+    Appends the event that moved game_name to version seq, and snapshots the game
+    every SNAPSHOT_EVERY events. Returns False if it could not be written
+    """
+    ensure_indexes()
+    try:
+        events_collection().insert_one({
+            "game": game_name,
+            "seq": seq,
+            "type": event_type,
+            "data": data,
+            "at": datetime.now(timezone.utc),
+        })
+    except pymongo.errors.DuplicateKeyError:
+        print(f"Event {seq} of {game_name} was already recorded, not recording {event_type} {data}")
+        metrics.game_event_failures.inc(reason="duplicate")
+        return False
+    except pymongo.errors.PyMongoError as e:
+        # the log now has a gap, see last_kill and rebuild
+        print(f"Failed to record {event_type} event {seq} of {game_name}: {e}")
+        metrics.game_event_failures.inc(reason="db")
+        return False
+
+    if seq and seq % SNAPSHOT_EVERY == 0:
+        snapshot(game_name)
+    return True
+
+
+def snapshot(game_name: str):
+    """
+    Stores the current game document as a snapshot at its version. Games created before
+    the log need one before they can be rebuilt. Returns the version, or None on failure
+    """
+    ensure_indexes()
+    game_info = db.get_collection("games").find_one({"name": game_name})
+    if game_info is None:
+        print(f"No game with the name '{game_name}' was found in the database.")
+        return None
+    if memberships.uses_memberships(game_info):
+        game_info = memberships.load_game_info(game_info)
+        # the memberships are read after the version, skip the snapshot if a write got in between
+        current = db.get_collection("games").find_one({"name": game_name}, {"version": 1})
+        if current is None or current.get("version") != game_info.get("version"):
+            return None
+    game_info.pop("_id", None)
+    seq = game_info.get("version") or 0
+
+    snapshots = snapshots_collection()
+    snapshots.update_one({"game": game_name, "seq": seq},
+                         {"$setOnInsert": {"state": game_info, "at": datetime.now(timezone.utc)}},
+                         upsert=True)
+    old = list(snapshots.find({"game": game_name}, {"seq": 1}, sort=[("seq", pymongo.DESCENDING)],
+                              skip=SNAPSHOTS_KEPT, limit=1))
+    if old:
+        snapshots.delete_many({"game": game_name, "seq": {"$lte": old[0]["seq"]}})
+    return seq
+
+
+# -----------------------------------------------------------------
+# Replay
+
+def apply_event(game: GameState, event: dict):
+    """ Applies one event to the game. Raises ValueError if it does not fit the game"""
+    data = event["data"]
+    event_type = event["type"]
+    if event_type == "kill":
+        _apply_kill(game, data)
+    elif event_type == "kills":
+        for kill in data["kills"]:
+            _apply_kill(game, kill)
+    elif event_type == "unalive":
+        if game.unalive(data["netid"]) is None:
+            raise ValueError(f"{data['netid']} was not alive")
+    elif event_type == "join":
+        if "ring" in data:
+            game.join(data["added"], {})
+            game.set_ring(data["ring"])
+        else:
+            game.join(data["added"], data["targets"])
+    elif event_type == "shuffle":
+        game.set_ring(data["ring"])
+    elif event_type == "undo":
+        if not game.undo_kill(data["killer"], data["victim"]):
+            raise ValueError(f"kill of {data['victim']} by {data['killer']} cannot be taken back")
+    else:
+        raise ValueError(f"unknown event type {event_type}")
+
+
+def _apply_kill(game: GameState, kill: dict):
+    victim = game.kill(kill["killer"])
+    if victim != kill["victim"]:
+        raise ValueError(f"{kill['killer']} killed {kill['victim']} but had {victim}")
+
+
+def rebuild(game_name: str, seq=None, at=None):
+    """
+    The GameState of the game at version seq, or as of the datetime at, or now.
+    Replays the events after the latest snapshot at or before that version.
+    Returns None if the log cannot get there
+    """
+    events = events_collection()
+    if at is not None:
+        last = events.find_one({"game": game_name, "at": {"$lte": at}}, {"seq": 1},
+                               sort=[("seq", pymongo.DESCENDING)])
+        if last is None:
+            print(f"{game_name} had no events by {at}")
+            return None
+        seq = last["seq"] if seq is None else min(seq, last["seq"])
+
+    snapshot_query = {"game": game_name}
+    event_query = {"game": game_name}
+    if seq is not None:
+        snapshot_query["seq"] = {"$lte": seq}
+        event_query["seq"] = {"$lte": seq}
+    latest = snapshots_collection().find_one(snapshot_query, sort=[("seq", pymongo.DESCENDING)])
+
+    game = None
+    expected = 0
+    if latest is not None:
+        game = GameState.from_doc(latest["state"])
+        expected = latest["seq"] + 1
+        event_query["seq"] = dict(event_query.get("seq", {}), **{"$gte": expected})
+
+    for event in events.find(event_query, {"_id": 0, "at": 0, "game": 0}, sort=[("seq", pymongo.ASCENDING)]):
+        if event["seq"] != expected:
+            print(f"Event {expected} of {game_name} is missing from the log, cannot rebuild past it")
+            return None
+        if game is None:
+            if event["type"] != "created":
+                print(f"{game_name} has no snapshot or created event to rebuild from")
+                return None
+            game = GameState(game_name, kills=dict.fromkeys(event["data"]["ring"], 0))
+            game.set_ring(event["data"]["ring"])
+        else:
+            try:
+                apply_event(game, event)
+            except ValueError as e:
+                print(f"Event {event['seq']} of {game_name} does not apply: {e}")
+                return None
+        expected += 1
+
+    if game is None:
+        print(f"{game_name} has no snapshot or created event to rebuild from")
+        return None
+    if seq is not None and expected - 1 != seq:
+        print(f"The log of {game_name} ends at {expected - 1}, before {seq}")
+        return None
+    game.extra["version"] = expected - 1
+    return game
+
+
+def last_kill(game_name: str, through=None):
+    """
+    The latest kill of the game, up to version through, that has not been taken back, or
+    None. A kill of a kills event is returned as a kill event with the "index" of the kill
+    in the batch. Reads the kill and undo events one at a time from the newest, since an
+    undo is always newer than the kill it takes back
+    """
+    events = events_collection()
+    undone = set()
+    query = {"game": game_name, "type": {"$in": ["kill", "kills", "undo"]}}
+    if through is not None:
+        query["seq"] = {"$lte": through}
+    while True:
+        event = events.find_one(query, sort=[("seq", pymongo.DESCENDING)])
+        if event is None:
+            return None
+        if event["type"] == "undo":
+            undone.add((event["data"]["seq"], event["data"].get("index")))
+        elif event["type"] == "kill":
+            if (event["seq"], None) not in undone:
+                return event
+        else:
+            for index in reversed(range(len(event["data"]["kills"]))):
+                if (event["seq"], index) not in undone:
+                    return dict(event, type="kill", data=event["data"]["kills"][index], index=index)
+        query["seq"] = {"$lt": event["seq"]}
+
+
+def recorded(game_name: str, after, through):
+    """ Whether the log has every event of the game after seq after, up to seq through"""
+    count = events_collection().count_documents({"game": game_name, "seq": {"$gt": after, "$lte": through}})
+    return count == through - after
+
+
+def history(game_name: str, after=-1, limit=100):
+    """ The events of the game after seq after, oldest first"""
+    return list(events_collection().find({"game": game_name, "seq": {"$gt": after}}, {"_id": 0},
+                                         sort=[("seq", pymongo.ASCENDING)], limit=limit))
@@ -0,0 +1,127 @@
+"""
+Materialized leaderboards. Each game's leaderboard is built once per game version,
+pre-sorted by kills and kept in memory as the JSON body served to the frontend.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import bisect
+import gzip
+import hashlib
+import json
+
+from game_state import GameState
+from lru import LRUCache
+
+
+def build_leaderboard(game_info: dict, players_info):
+    """
+    The leaderboard rows for a game: every player's profile with their kills and
+    whether they are alive, most kills first
+    """
+    game = GameState.from_doc(game_info)
+    rows = []
+    for player in players_info:
+        player.pop('_id', None)  # remove object_id attribute to properly jsonify the object
+        player['kills'] = game.kills[player['netid']]
+        player['isAlive'] = game.is_alive(player['netid'])
+        rows.append(player)
+    rows.sort(key=lambda player: (-player['kills'], player['netid']))
+    return rows
+
+
+def build_leaderboard_from_memberships(membership_rows, players_info):
+    """
+    The same rows for a game in the memberships layout, from its (netid, kills, alive)
+    rows, which already come in leaderboard order
+    """
+    profiles = {player['netid']: player for player in players_info}
+    rows = []
+    for netid, kills, alive in membership_rows:
+        player = profiles.get(netid)
+        if player is None:
+            continue
+        player.pop('_id', None)
+        player['kills'] = kills
+        player['isAlive'] = alive
+        rows.append(player)
+    return rows
+
+
+def encode_json(value):
+    """ Compact JSON bytes, as served"""
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def cursor_of(row: dict):
+    """ Opaque position of a row in the leaderboard order, for ?after="""
+    return f"{row['kills']}:{row['netid']}"
+
+
+def parse_cursor(cursor: str):
+    """ The sort key of a cursor. Raises ValueError if it is not one"""
+    kills, _, netid = cursor.partition(":")
+    if not netid:
+        raise ValueError(f"invalid cursor {cursor!r}")
+    return (-int(kills), netid)
+
+
+class Leaderboard:
+    """ A built leaderboard, its JSON body and the strong ETag of that body"""
+    __slots__ = ("version", "rows", "body", "etag", "_keys", "_gzipped")
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = rows
+        self.body = encode_json(rows)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self._keys = None
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        """ The body gzip compressed, once per build"""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+    def page(self, after=None, limit=None, alive=None):
+        """
+        The rows after the cursor after, at most limit of them, and only the alive
+        (or dead) players if alive is given. Returns the rows and the cursor of the
+        next page, or None if this is the last one
+        """
+        if self._keys is None:
+            self._keys = [(-row['kills'], row['netid']) for row in self.rows]
+        i = 0 if after is None else bisect.bisect_right(self._keys, parse_cursor(after))
+        page = []
+        while i < len(self.rows) and (limit is None or len(page) < limit):
+            row = self.rows[i]
+            i += 1
+            if alive is None or row['isAlive'] == alive:
+                page.append(row)
+        # only point to a next page if one more matching row exists
+        while page and len(page) == limit and i < len(self.rows):
+            if alive is None or self.rows[i]['isAlive'] == alive:
+                return page, cursor_of(page[-1])
+            i += 1
+        return page, None
+
+
+class LeaderboardCache(LRUCache):
+    """
+    Leaderboards of the most recently read games. An entry is only valid for the
+    game version it was built from, so any kill, unalive or join makes it stale
+    """
+
+    def __init__(self, max_games=32):
+        super().__init__(max_games)
+
+    def get(self, game_name: str, version):
+        return super().get(game_name, lambda entry: entry.version == version)
+
+    def put(self, game_name: str, version, rows):
+        return super().put(game_name, Leaderboard(version, rows))
+
+
+leaderboards = LeaderboardCache()
@@ -0,0 +1,73 @@
+"""
+The bounded LRU cache that the per-worker caches build on.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache of at most max_size entries. With ttl_seconds an entry expires
+    that long after it was put. Lookups are counted as hits and misses
+    """
+
+    def __init__(self, max_size: int, ttl_seconds=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # key: (expiry or None, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, valid=None):
+        """ The value of key, or None if it is missing, expired or valid(value) is false"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()) \
+                    or (valid is not None and not valid(entry[1])):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """ Stores value, evicting the least recently used entries past max_size. Returns value"""
+        expiry = None if self.ttl_seconds is None else time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def update(self, key, change):
+        """ Calls change(value) on the entry of key under the lock. It is dropped if change returns False"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and change(entry[1]) is False:
+                del self._entries[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
@@ -0,0 +1,311 @@
+"""
+The memberships layout of a game: one small document per (game, netid) with the
+player's kills, whether they are alive, their target and their hunter, instead of
+the players/targets/alive_players/dead_players maps of one large game document.
+A kill then touches three memberships and the version of the game document.
+
+A game document with "layout": "memberships" keeps only its name, version, the number
+of deaths so far and metadata. Each dead player's "died" is their place in the order
+the players died, numbered from 0 on, so the dead_players order survives the split.
+Everything else still sees the single-document shape through load_game_info, so the
+API output is the same for both layouts.
+
+    python memberships.py migrate ivy
+    python memberships.py migrate --all
+"""
+__author__ = 'Pierce Maloney'
+
+
+import argparse
+
+import pymongo
+from pymongo import UpdateOne
+
+import db
+
+
+MEMBERSHIPS_COLLECTION = "memberships"
+LAYOUT = "memberships"
+
+# the fields of the single-document layout that live in the memberships instead
+DOCUMENT_FIELDS = ("players", "targets", "alive_players", "dead_players")
+
+
+def memberships_collection():
+    return db.get_collection(MEMBERSHIPS_COLLECTION)
+
+
+def ensure_indexes():
+    collection = memberships_collection()
+    collection.create_index([("game", pymongo.ASCENDING), ("netid", pymongo.ASCENDING)], unique=True)
+    collection.create_index([("game", pymongo.ASCENDING), ("alive", pymongo.ASCENDING)])
+    # serves the leaderboard order
+    collection.create_index([("game", pymongo.ASCENDING), ("kills", pymongo.DESCENDING), ("netid", pymongo.ASCENDING)])
+
+
+def uses_memberships(game_info: dict):
+    return game_info.get("layout") == LAYOUT
+
+
+# -----------------------------------------------------------------
+# Conversion
+
+def rows_of(game_info: dict):
+    """ {netid: membership fields} of a game in the single-document shape"""
+    targets = game_info["targets"]
+    hunters = {target: netid for netid, target in targets.items()}
+    alive = set(game_info["alive_players"])
+    dead_order = {netid: i for i, netid in enumerate(game_info["dead_players"])}
+    rows = {}
+    for netid, kills in game_info["players"].items():
+        rows[netid] = {
+            "kills": kills,
+            "alive": netid in alive,
+            "target": targets.get(netid),
+            "hunter": hunters.get(netid),
+            "died": dead_order.get(netid),
+        }
+    return rows
+
+
+def load_game_info(game_info: dict, session=None):
+    """ The game document in the single-document shape, assembled from its memberships"""
+    game_info = dict(game_info)
+    players, targets, alive_players, dead = {}, {}, [], []
+    for row in memberships_collection().find({"game": game_info["name"]}, {"_id": 0, "game": 0}, session=session):
+        netid = row["netid"]
+        players[netid] = row["kills"]
+        if row["alive"]:
+            targets[netid] = row["target"]
+            alive_players.append(netid)
+        else:
+            dead.append((row.get("died") or 0, netid))
+    dead.sort()
+    game_info.update({
+        "players": players,
+        "targets": targets,
+        "alive_players": alive_players,
+        "dead_players": [netid for _, netid in dead],
+    })
+    return game_info
+
+
+def leaderboard_rows(game_name: str):
+    """ (netid, kills, alive) of every player, most kills first, from the (game, kills) index"""
+    return [(row["netid"], row["kills"], row["alive"]) for row in memberships_collection().find(
+        {"game": game_name}, {"_id": 0, "netid": 1, "kills": 1, "alive": 1},
+        sort=[("kills", pymongo.DESCENDING), ("netid", pymongo.ASCENDING)])]
+
+
+# -----------------------------------------------------------------
+# Writes
+
+def _bump_version(game_name: str, session):
+    game = db.get_collection("games").find_one_and_update(
+        {"name": game_name}, {"$inc": {"version": 1}}, projection={"version": 1},
+        return_document=pymongo.ReturnDocument.AFTER, session=session)
+    return game["version"]
+
+
+def _reserve_deaths(game_name: str, count: int, session):
+    """
+    The first of count death numbers reserved for players dying in this write, in order.
+    Games that never counted their deaths carry on from their last recorded death
+    """
+    games = db.get_collection("games")
+    game = games.find_one_and_update(
+        {"name": game_name, "deaths": {"$exists": True}}, {"$inc": {"deaths": count}},
+        projection={"deaths": 1}, return_document=pymongo.ReturnDocument.AFTER, session=session)
+    if game is not None:
+        return game["deaths"] - count
+    last = memberships_collection().find_one(
+        {"game": game_name, "alive": False}, {"died": 1},
+        sort=[("died", pymongo.DESCENDING)], session=session)
+    first = 0 if last is None or last.get("died") is None else last["died"] + 1
+    result = games.update_one({"name": game_name, "deaths": {"$exists": False}},
+                              {"$set": {"deaths": first + count}}, session=session)
+    if result.matched_count == 0:
+        return _reserve_deaths(game_name, count, session)
+    return first
+
+
+def create(game_info: dict):
+    """
+    Inserts a new game in the memberships layout. game_info is in the single-document
+    shape. Raises DuplicateKeyError if the name is taken
+    """
+    rows = rows_of(game_info)
+    game_doc = {k: v for k, v in game_info.items() if k not in DOCUMENT_FIELDS}
+    game_doc["layout"] = LAYOUT
+    game_doc["deaths"] = len(game_info["dead_players"])
+
+    def transaction(session):
+        db.get_collection("games").insert_one(game_doc, session=session)
+        if rows:
+            memberships_collection().insert_many(
+                [dict(row, game=game_info["name"], netid=netid) for netid, row in rows.items()], session=session)
+
+    db.run_transaction(transaction)
+    game_info["_id"] = game_doc["_id"]
+    game_info["layout"] = LAYOUT
+    return game_info
+
+
+def kill(game_name: str, killer: str):
+    """
+    killer kills their target. Returns (victim, the killer's new target, the new game version),
+    or an error message
+    """
+    def transaction(session):
+        collection = memberships_collection()
+        killer_row = collection.find_one({"game": game_name, "netid": killer},
+                                         {"alive": 1, "target": 1}, session=session)
+        if killer_row is None or not killer_row["alive"]:
+            return f"Player with netid {killer} is not alive in the game"
+        victim = killer_row["target"]
+        if victim == killer:
+            return f"Player with netid {killer} has no target left"
+        victim_row = collection.find_one({"game": game_name, "netid": victim}, {"target": 1}, session=session)
+        new_target = victim_row["target"]
+
+        version = _bump_version(game_name, session)
+        died = _reserve_deaths(game_name, 1, session)
+        collection.bulk_write([
+            UpdateOne({"_id": victim_row["_id"]}, {"$set": {
+                "alive": False, "target": None, "hunter": None, "died": died}}),
+            UpdateOne({"_id": killer_row["_id"]}, {"$set": {"target": new_target}, "$inc": {"kills": 1}}),
+            UpdateOne({"game": game_name, "netid": new_target}, {"$set": {"hunter": killer}}),
+        ], session=session)
+        return victim, new_target, version
+
+    return db.run_transaction(transaction)
+
+
+def unalive(game_name: str, netid: str):
+    """
+    Removes netid from the ring without giving anyone a kill.
+    Returns (their hunter, their target, the new game version), or None if they were not alive
+    """
+    def transaction(session):
+        collection = memberships_collection()
+        row = collection.find_one({"game": game_name, "netid": netid}, session=session)
+        if row is None or not row["alive"]:
+            return None
+        hunter, target = row["hunter"], row["target"]
+
+        version = _bump_version(game_name, session)
+        died = _reserve_deaths(game_name, 1, session)
+        requests = [UpdateOne({"_id": row["_id"]}, {"$set": {
+            "alive": False, "target": None, "hunter": None, "died": died}})]
+        if hunter != netid:
+            requests.append(UpdateOne({"game": game_name, "netid": hunter}, {"$set": {"target": target}}))
+            requests.append(UpdateOne({"game": game_name, "netid": target}, {"$set": {"hunter": hunter}}))
+        collection.bulk_write(requests, session=session)
+        return hunter, target, version
+
+    return db.run_transaction(transaction)
+
+
+def write_game(game_info: dict, previous=None):
+    """
+    Writes a game changed in the single-document shape, if its version did not move.
+    Only the memberships that differ from previous, the game as it was read, are written.
+    Returns False on a version conflict
+    """
+    rows = rows_of(game_info)
+    before = {}
+    if previous is not None:
+        before = rows_of(previous)
+        rows = {netid: row for netid, row in rows.items() if before.get(netid) != row}
+    # the players who died in this write, in the order they died
+    died = [netid for netid in game_info["dead_players"] if before.get(netid, {}).get("alive")]
+
+    def fields(netid, row, deaths):
+        # dead players keep their death number, the ones who just died get the next ones
+        fields = {k: v for k, v in row.items() if k != "died" or row["alive"]}
+        if netid in deaths:
+            fields["died"] = deaths[netid]
+        return fields
+
+    def transaction(session):
+        result = db.get_collection("games").update_one(
+            {"_id": game_info["_id"], "version": game_info.get("version")},
+            {"$inc": {"version": 1}}, session=session)
+        if result.matched_count == 0:
+            return False
+        deaths = {}
+        if died:
+            first = _reserve_deaths(game_info["name"], len(died), session)
+            deaths = {netid: first + i for i, netid in enumerate(died)}
+        if rows:
+            memberships_collection().bulk_write([
+                UpdateOne({"game": game_info["name"], "netid": netid},
+                          {"$set": fields(netid, row, deaths)}, upsert=True)
+                for netid, row in rows.items()], session=session)
+        return True
+
+    return db.run_transaction(transaction)
+
+
+# -----------------------------------------------------------------
+# Migration
+
+def migrate_game(game_name: str, retries=5):
+    """
+    Moves a game from the single-document layout to memberships. The game document
+    is switched only if it did not change while its memberships were prepared.
+    Returns True if the game is in the memberships layout afterwards
+    """
+    games = db.get_collection("games")
+    for attempt in range(retries):
+        game_info = games.find_one({"name": game_name})
+        if game_info is None:
+            print(f"No game with the name '{game_name}' was found in the database.")
+            return False
+        if uses_memberships(game_info):
+            print(f"{game_name} already uses the memberships layout")
+            return True
+        rows = rows_of(game_info)
+
+        def transaction(session):
+            # switch first, so nothing is written if the game changed since it was read
+            result = games.update_one(
+                {"_id": game_info["_id"], "version": game_info.get("version")},
+                {"$set": {"layout": LAYOUT, "deaths": len(game_info["dead_players"])},
+                 "$unset": {field: "" for field in DOCUMENT_FIELDS}},
+                session=session)
+            if result.matched_count == 0:
+                return False
+            collection = memberships_collection()
+            collection.delete_many({"game": game_name}, session=session)
+            if rows:
+                collection.insert_many(
+                    [dict(row, game=game_name, netid=netid) for netid, row in rows.items()], session=session)
+            return True
+
+        if db.run_transaction(transaction):
+            print(f"Migrated {game_name}: {len(rows)} memberships")
+            return True
+    print(f"Could not migrate {game_name}, it kept changing")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    migrate = subcommands.add_parser("migrate", help="move games to the memberships layout")
+    migrate.add_argument("games", nargs="*")
+    migrate.add_argument("--all", action="store_true", help="every game still in the single-document layout")
+    args = parser.parse_args()
+
+    ensure_indexes()
+    game_names = list(args.games)
+    if args.all:
+        game_names += [game["name"] for game in db.get_collection("games").find(
+            {"layout": {"$ne": LAYOUT}}, {"name": 1})]
+    ok = all([migrate_game(game_name) for game_name in game_names])
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
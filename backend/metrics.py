@@ -0,0 +1,236 @@
+"""
+Process-wide metrics: request timing histograms, db round trip counters, email
+delivery stats and queue gauges, rendered in the Prometheus text format by /metrics.
+Every Gunicorn worker keeps its own, so scrape each worker or sum them.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import contextvars
+import cProfile
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, request
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds of the db round trips per request histogram
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# requests slower than this are profiled and dumped to PROFILE_DIR. Unset (default) disables profiling
+PROFILE_SLOW_MS = float(os.environ["PROFILE_SLOW_MS"]) if os.environ.get("PROFILE_SLOW_MS") else None
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count of observed values, per label set"""
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(key, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(key, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class Counter:
+    """ Monotonic counts per label set"""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(key)} {value}")
+        return lines
+
+
+def gauge(name: str, help: str, values: dict, kind="gauge"):
+    """
+    Lines of a value read at scrape time, such as a queue depth or the counters another
+    module keeps. values maps label tuples, or None, to numbers
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for key, value in values.items():
+        lines.append(f"{name}{_labels(key or ())} {value}")
+    return lines
+
+
+def _labels(key, **extra):
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+request_seconds = Histogram("assassin_request_seconds", "Time spent handling requests, by endpoint")
+request_round_trips = Histogram("assassin_request_db_round_trips", "Db round trips made by a request, by endpoint",
+                                buckets=ROUND_TRIP_BUCKETS)
+db_operations = Counter("assassin_db_operations_total", "Db operations, by collection and operation")
+db_seconds = Histogram("assassin_db_operation_seconds", "Time spent in db operations, by collection and operation")
+email_send_seconds = Histogram("assassin_email_send_seconds", "Time spent in email transport calls, by transport")
+email_send_failures = Counter("assassin_email_send_failures_total", "Failed email transport calls, by transport and reason")
+emails = Counter("assassin_emails_total", "Outbox jobs processed, by outcome")
+game_event_failures = Counter("assassin_game_event_failures_total",
+                              "Game changes whose kill log event could not be recorded, by reason")
+idempotent_requests = Counter("assassin_idempotent_requests_total",
+                              "Admin requests with an idempotency key, by outcome")
+
+
+# -----------------------------------------------------------------
+# Db round trips
+
+# round trips made by the current request, None outside of requests
+_round_trips = contextvars.ContextVar("round_trips", default=None)
+
+# collection methods that talk to the server. find and aggregate return lazy cursors,
+# so they are counted but not timed
+TIMED_OPERATIONS = frozenset((
+    "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+    "count_documents", "estimated_document_count", "distinct", "bulk_write", "create_index",
+))
+CURSOR_OPERATIONS = frozenset(("find", "aggregate"))
+
+
+class InstrumentedCollection:
+    """ A collection that counts and times the operations made through it"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in TIMED_OPERATIONS:
+            return self._timed(name, attr)
+        if name in CURSOR_OPERATIONS:
+            return self._counted(name, attr)
+        return attr
+
+    def _count(self, operation):
+        db_operations.inc(collection=self._collection.name, operation=operation)
+        trips = _round_trips.get()
+        if trips is not None:
+            trips[0] += 1
+
+    def _timed(self, operation, method):
+        def timed(*args, **kwargs):
+            self._count(operation)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                db_seconds.observe(time.perf_counter() - start,
+                                   collection=self._collection.name, operation=operation)
+        return timed
+
+    def _counted(self, operation, method):
+        def counted(*args, **kwargs):
+            self._count(operation)
+            return method(*args, **kwargs)
+        return counted
+
+
+def instrument_collection(collection):
+    return InstrumentedCollection(collection)
+
+
+# -----------------------------------------------------------------
+# Requests
+
+def init_app(app):
+    """ Times every request of the Flask app and, when PROFILE_SLOW_MS is set, profiles slow ones"""
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        g.metrics_round_trips = [0]
+        _round_trips.set(g.metrics_round_trips)
+        g.metrics_profiler = None
+        if PROFILE_SLOW_MS is not None:
+            g.metrics_profiler = cProfile.Profile()
+            g.metrics_profiler.enable()
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        _round_trips.set(None)
+        endpoint = request.endpoint or "unmatched"
+        request_seconds.observe(elapsed, endpoint=endpoint)
+        request_round_trips.observe(g.metrics_round_trips[0], endpoint=endpoint)
+
+        profiler = g.metrics_profiler
+        if profiler is not None:
+            profiler.disable()
+            if elapsed * 1000 >= PROFILE_SLOW_MS:
+                _dump_profile(profiler, endpoint, elapsed)
+
+
+def _dump_profile(profiler, endpoint: str, elapsed: float):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{endpoint}-{int(time.time() * 1000)}-{os.getpid()}.prof")
+    try:
+        pstats.Stats(profiler).dump_stats(path)
+    except OSError as e:
+        print(f"Failed to write profile of slow request to {path}: {e}")
+        return
+    print(f"Slow request to {endpoint} took {elapsed * 1000:.1f}ms, profile written to {path}")
+
+
+def render(*extra):
+    """ The Prometheus text exposition of every metric, plus the extra lists of lines"""
+    lines = []
+    for metric in (request_seconds, request_round_trips, db_operations, db_seconds,
+                   email_send_seconds, email_send_failures, emails, game_event_failures, idempotent_requests):
+        lines.extend(metric.render())
+    for metric_lines in extra:
+        lines.extend(metric_lines)
+    return "\n".join(lines) + "\n"
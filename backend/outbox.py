@@ -0,0 +1,463 @@
+"""
+Outbound email queue. Emails are stored as jobs in the outbox collection,
+next to the games, and sent by background worker threads with retries.
+
+Target emails are coalesced: while a player's target email for a game waits out
+COALESCE_SECONDS, a newer one replaces it, so rapid kills send only the latest target.
+A unique partial index keeps one pending job per player and game.
+Sends go through a token bucket so large batches stay under the provider's rate limit.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from pymongo import UpdateOne
+
+import db
+import metrics
+
+
+OUTBOX_COLLECTION = "outbox"
+
+WORKER_THREADS = int(os.environ.get("EMAIL_WORKER_THREADS", 2))
+MAX_ATTEMPTS = int(os.environ.get("EMAIL_MAX_ATTEMPTS", 6))
+BACKOFF_SECONDS = float(os.environ.get("EMAIL_BACKOFF_SECONDS", 30))
+POLL_SECONDS = float(os.environ.get("EMAIL_POLL_SECONDS", 5))
+# a job stuck in "sending" this long belongs to a dead worker and is retried
+STALE_SECONDS = 300
+# coalesced emails wait this long for a newer version before they are sent
+COALESCE_SECONDS = float(os.environ.get("EMAIL_COALESCE_SECONDS", 10))
+# sends per second of this process and the burst allowed above it. 0 disables the limit
+RATE_PER_SECOND = float(os.environ.get("EMAIL_RATE_PER_SECOND", 10))
+RATE_BURST = int(os.environ.get("EMAIL_RATE_BURST", 20))
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+# -----------------------------------------------------------------
+# Transports
+
+class SendGridTransport:
+    """
+    Sends through the SendGrid v3 API over one kept-alive HTTPS connection per thread.
+    The SendGrid helpers and keys are loaded when the first transport is made, not on import.
+    A send is only tried again here when the request could not go out. Once it went out
+    the email may have been delivered, so any failure after that is left to the outbox,
+    which retries the job after its backoff
+    """
+    host = "api.sendgrid.com"
+
+    def __init__(self, api_key=None, from_email=None, timeout=10, max_idle_seconds=30):
+        from db_info import SENDGRID_API_KEY, IVY_ASSASSIN_EMAIL
+        self.api_key = api_key or SENDGRID_API_KEY
+        self.from_email = from_email or IVY_ASSASSIN_EMAIL
+        self.timeout = timeout
+        # a connection idle this long may have been closed by the server, a new one is opened
+        self.max_idle_seconds = max_idle_seconds
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and time.monotonic() - self._local.used_at > self.max_idle_seconds:
+            self._close()
+            conn = None
+        if conn is None:
+            conn = http.client.HTTPSConnection(self.host, timeout=self.timeout)
+            self._local.conn = conn
+        self._local.used_at = time.monotonic()
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def _request(self, body):
+        """ Writes the request on this thread's connection and returns it. Raises if it did not go out"""
+        conn = self._connection()
+        conn.request("POST", "/v3/mail/send", body=body, headers={
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        })
+        return conn
+
+    def send(self, to_email: str, subject: str, content: str, text=None):
+        from sendgrid.helpers.mail import Mail
+
+        message = Mail(
+            from_email=self.from_email,
+            to_emails=to_email,
+            subject=subject,
+            plain_text_content=text,
+            html_content=content
+        )
+        body = json.dumps(message.get())
+        start = time.perf_counter()
+        try:
+            try:
+                conn = self._request(body)
+            except (http.client.HTTPException, OSError):
+                # the connection failed before the request went out, reconnect once
+                self._close()
+                conn = self._request(body)
+            response = conn.getresponse()
+            status, data = response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            # e.g. a read timeout: the email may have been sent, so it is not sent again here
+            self._close()
+            metrics.email_send_failures.inc(transport="sendgrid", reason="connection")
+            raise
+        finally:
+            metrics.email_send_seconds.observe(time.perf_counter() - start, transport="sendgrid")
+
+        if status >= 400:
+            metrics.email_send_failures.inc(transport="sendgrid", reason=str(status))
+            raise RuntimeError(f"SendGrid returned {status}: {data[:200]!r}")
+        return status
+
+
+class FakeTransport:
+    """
+    Records messages instead of sending them. Used for tests and local runs
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.fail_next = 0
+        self._lock = threading.Lock()
+
+    def send(self, to_email: str, subject: str, content: str, text=None):
+        with self._lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                raise RuntimeError("fake transport failure")
+            self.sent.append({"to": to_email, "subject": subject, "content": content, "text": text})
+        return 202
+
+
+_transport = None
+
+
+def get_transport():
+    """
+    Transport chosen by EMAIL_TRANSPORT ("sendgrid" or "fake"), shared by the process
+    """
+    global _transport
+    if _transport is None:
+        if os.environ.get("EMAIL_TRANSPORT", "sendgrid") == "fake":
+            _transport = FakeTransport()
+        else:
+            _transport = SendGridTransport()
+    return _transport
+
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second on average and bursts of up to burst. acquire blocks
+    the calling thread until a token is free
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# shared by the worker threads and send_jobs of this process
+send_limiter = TokenBucket(RATE_PER_SECOND, RATE_BURST)
+
+
+# -----------------------------------------------------------------
+# Queue
+
+def outbox_collection():
+    return db.get_collection(OUTBOX_COLLECTION)
+
+
+def ensure_indexes():
+    collection = outbox_collection()
+    collection.create_index([("status", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)])
+    # at most one pending job per coalesce key, so concurrent enqueues cannot both insert one.
+    # Jobs without a key are left out, a missing field would be a duplicate null
+    try:
+        collection.create_index("coalesce_key", unique=True, name="coalesce_key_pending",
+                                partialFilterExpression={"status": "pending", "coalesce_key": {"$exists": True}})
+    except pymongo.errors.OperationFailure as e:
+        print(f"Could not create the unique index of pending coalesced emails, "
+              f"remove the duplicate pending jobs first: {e}")
+
+
+def enqueue_email(to_email: str, subject: str, content: str, game_name=None, text=None):
+    """
+    Persists an email job and wakes the workers. Returns the job id
+    """
+    job = {
+        "to": to_email,
+        "subject": subject,
+        "content": content,
+        "text": text,
+        "game": game_name,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": _now(),
+        "next_attempt_at": _now(),
+    }
+    job_id = outbox_collection().insert_one(job).inserted_id
+    wake_email_workers()
+    return job_id
+
+
+def enqueue_emails(messages, game_name=None):
+    """
+    Persists many (to_email, subject, content, text) jobs with one insert. The workers
+    are not woken, so the caller can send them itself with send_jobs or call
+    wake_email_workers. Returns the job ids
+    """
+    now = _now()
+    jobs = [{
+        "to": to_email,
+        "subject": subject,
+        "content": content,
+        "text": text,
+        "game": game_name,
+        "status": "pending",
+        "attempts": 0,
+        "created_at": now,
+        "next_attempt_at": now,
+    } for to_email, subject, content, text in messages]
+    if not jobs:
+        return []
+    return outbox_collection().insert_many(jobs).inserted_ids
+
+
+def enqueue_coalesced(messages, game_name=None, kind="target"):
+    """
+    Persists (to_email, subject, content, text) jobs that replace the pending job of the
+    same kind, game and recipient, if there is one. A new job waits COALESCE_SECONDS
+    for newer versions, a replaced one keeps its send time. Returns the number replaced
+    """
+    now = _now()
+    requests = [UpdateOne(
+        {"coalesce_key": f"{kind}:{game_name}:{to_email}", "status": "pending"},
+        {"$set": {"subject": subject, "content": content, "text": text, "updated_at": now},
+         "$setOnInsert": {
+             "to": to_email,
+             "game": game_name,
+             "attempts": 0,
+             "created_at": now,
+             "next_attempt_at": now + timedelta(seconds=COALESCE_SECONDS)}},
+        upsert=True) for to_email, subject, content, text in messages]
+    if not requests:
+        return 0
+    replaced = 0
+    for attempt in range(2):
+        try:
+            replaced += outbox_collection().bulk_write(requests, ordered=False).matched_count
+            break
+        except pymongo.errors.BulkWriteError as e:
+            # a concurrent enqueue inserted the pending job of some recipients first,
+            # their upserts now match it
+            errors = e.details["writeErrors"]
+            if attempt or any(error["code"] != 11000 for error in errors):
+                raise
+            replaced += e.details["nMatched"]
+            requests = [requests[error["index"]] for error in errors]
+    if replaced:
+        metrics.emails.inc(replaced, outcome="coalesced")
+    return replaced
+
+
+def queue_depth():
+    """
+    Number of jobs waiting to be sent, being sent and given up on
+    """
+    collection = outbox_collection()
+    return {status: collection.count_documents({"status": status})
+            for status in ("pending", "sending", "failed")}
+
+
+def claim_next_job():
+    """
+    Atomically marks the next due job as sending and returns it, or None if nothing is due
+    """
+    now = _now()
+    return outbox_collection().find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "claimed_at": {"$lte": now - timedelta(seconds=STALE_SECONDS)}},
+        ]},
+        {"$set": {"status": "sending", "claimed_at": now}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+
+
+def process_job(job: dict):
+    """
+    Sends a claimed job and records the outcome. Failed jobs are retried with exponential backoff.
+    Returns None if the email was sent, otherwise the error
+    """
+    collection = outbox_collection()
+    send_limiter.acquire()
+    try:
+        status_code = get_transport().send(job["to"], job["subject"], job["content"], job.get("text"))
+    except Exception as e:
+        print(f"Error sending email to {job['to']} (attempt {job['attempts']}): {e}")
+        if job["attempts"] >= MAX_ATTEMPTS:
+            metrics.emails.inc(outcome="failed")
+            collection.update_one({"_id": job["_id"]}, {"$set": {
+                "status": "failed", "last_error": str(e)}})
+        else:
+            delay = BACKOFF_SECONDS * 2 ** (job["attempts"] - 1)
+            try:
+                collection.update_one({"_id": job["_id"]}, {"$set": {
+                    "status": "pending",
+                    "last_error": str(e),
+                    "next_attempt_at": _now() + timedelta(seconds=delay)}})
+                metrics.emails.inc(outcome="retry")
+            except pymongo.errors.DuplicateKeyError:
+                # a newer email for the same recipient was queued while this one was sending
+                metrics.emails.inc(outcome="coalesced")
+                collection.update_one({"_id": job["_id"]}, {"$set": {
+                    "status": "coalesced", "last_error": str(e)}})
+        return str(e)
+
+    print(f"Email sent to {job['to']} with status code {status_code}")
+    metrics.emails.inc(outcome="sent")
+    collection.update_one({"_id": job["_id"]}, {"$set": {
+        "status": "sent", "sent_at": _now()}})
+    return None
+
+
+def drain_outbox(limit=None):
+    """
+    Sends due jobs on the calling thread until none are left. Returns the number processed
+    """
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        process_job(job)
+        processed += 1
+    return processed
+
+
+def send_jobs(job_ids, max_workers=8, progress_every=25, label="Emails"):
+    """
+    Sends the given jobs now with a bounded pool of threads and prints progress.
+    Jobs that fail stay in the outbox and are retried by the workers later.
+    Returns a report with the throughput and the error of every failed recipient
+    """
+    collection = outbox_collection()
+    total = len(job_ids)
+    report = {"total": total, "sent": 0, "skipped": 0, "failed": {}}
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def send_one(job_id):
+        job = collection.find_one_and_update(
+            {"_id": job_id, "status": "pending"},
+            {"$set": {"status": "sending", "claimed_at": _now()}, "$inc": {"attempts": 1}},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        error = process_job(job) if job is not None else None
+        with lock:
+            if job is None:
+                # already taken by a background worker
+                report["skipped"] += 1
+            elif error is None:
+                report["sent"] += 1
+            else:
+                report["failed"][job["to"]] = error
+            done = report["sent"] + report["skipped"] + len(report["failed"])
+            if done % progress_every == 0 or done == total:
+                rate = done / max(time.perf_counter() - start, 1e-9)
+                print(f"{label}: {done}/{total} done, {len(report['failed'])} failed ({rate:.1f}/s)")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(send_one, job_ids))
+    if report["failed"]:
+        start_email_worker()
+
+    elapsed = time.perf_counter() - start
+    report["seconds"] = round(elapsed, 3)
+    report["per_second"] = round(total / max(elapsed, 1e-9), 1)
+    return report
+
+
+# -----------------------------------------------------------------
+# Workers
+
+_wakeup = threading.Event()
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+def _worker_loop():
+    while True:
+        try:
+            if drain_outbox() == 0:
+                _wakeup.wait(POLL_SECONDS)
+                _wakeup.clear()
+        except pymongo.errors.PyMongoError as e:
+            print(f"Email worker could not reach the outbox: {e}")
+            _wakeup.wait(POLL_SECONDS)
+
+
+def wake_email_workers():
+    """
+    Has the workers of this process look for due jobs now
+    """
+    start_email_worker()
+    _wakeup.set()
+
+
+def start_email_worker():
+    """
+    Starts the worker threads of this process if they are not running yet.
+    Threads do not survive a fork, so each Gunicorn worker starts its own on first use.
+    """
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        ensure_indexes()
+        for i in range(WORKER_THREADS):
+            threading.Thread(target=_worker_loop, name=f"email-worker-{i}", daemon=True).start()
+        _workers_pid = os.getpid()
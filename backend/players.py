@@ -0,0 +1,139 @@
+"""
+Player documents of the players collection, and the cache in front of it.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+
+import db
+from lru import LRUCache
+
+
+# the fields of a player that the public API serves. The email address stays private
+PUBLIC_FIELDS = ("netid", "name", "nickname", "fullAssassinName")
+
+
+def public_projection():
+    """ Projection that only lets the public fields of player documents leave the db"""
+    projection = dict.fromkeys(PUBLIC_FIELDS, 1)
+    projection["_id"] = 0
+    return projection
+
+
+def normalize_netid(netid: str):
+    """ netids are stored lowercase, so No4250 and no4250 are the same player"""
+    return netid.strip().lower()
+
+
+def build_player_doc(netid: str, name: str, nickname = None, email = None):
+    """
+    returns the document of a new player
+    """
+    # clean netid
+    netid = normalize_netid(netid)
+
+    # give princeton email
+    if not email:
+        email = f'{netid}@princeton.edu'
+
+    # construct the fullAssassinName field
+    if nickname is None or nickname == "*":
+        full_assassin_name = name
+    else:
+        words = name.split()
+        first_word = words[0]
+        rest_of_words = ' '.join(words[1:])
+        full_assassin_name = f"{first_word} '{nickname}' {rest_of_words}"
+
+    return {
+        "netid": netid,
+        "name": name,
+        "nickname": nickname,
+        "email": email.strip().lower(),
+        "fullAssassinName": full_assassin_name
+    }
+
+
+# -----------------------------------------------------------------
+# Cache
+
+class PlayerCache(LRUCache):
+    """
+    Bounded LRU cache of player documents. Entries expire after ttl_seconds,
+    and writers invalidate the netids they change
+    """
+
+    def __init__(self, max_size=5000, ttl_seconds=300):
+        super().__init__(max_size, ttl_seconds)
+
+    def get(self, netid: str):
+        player = super().get(netid)
+        return None if player is None else dict(player)
+
+    def put(self, player: dict):
+        super().put(player["netid"], dict(player))
+
+
+player_cache = PlayerCache(
+    max_size=int(os.environ.get("PLAYER_CACHE_SIZE", 5000)),
+    ttl_seconds=float(os.environ.get("PLAYER_CACHE_TTL_SECONDS", 300)))
+
+
+def get_player(netid: str):
+    """
+    returns the player document of netid, or None if there is no such player
+    """
+    player = player_cache.get(netid)
+    if player is not None:
+        return player
+
+    player = db.get_collection("players").find_one({"netid": netid})
+    if player is not None:
+        player_cache.put(player)
+    return player
+
+
+def get_players(netids):
+    """
+    returns {netid: player document} for the netids that exist.
+    Cache misses are fetched together with one $in query
+    """
+    players = {}
+    missing = []
+    for netid in dict.fromkeys(netids):
+        player = player_cache.get(netid)
+        if player is None:
+            missing.append(netid)
+        else:
+            players[netid] = player
+
+    if missing:
+        for player in db.get_collection("players").find({"netid": {"$in": missing}}):
+            player_cache.put(player)
+            players[player["netid"]] = player
+    return players
+
+
+# -----------------------------------------------------------------
+# Memberships
+
+def add_memberships(game_name: str, netids):
+    """
+    Records that the players are in game_name, in the indexed games array of their
+    documents, so the games of a player are found without reading any game
+    """
+    netids = list(netids)
+    if not netids:
+        return 0
+    result = db.get_collection("players").update_many(
+        {"netid": {"$in": netids}}, {"$addToSet": {"games": game_name}})
+    for netid in netids:
+        player_cache.invalidate(netid)
+    return result.modified_count
+
+
+def games_of(netid: str):
+    """ Names of the games the player is in"""
+    player = get_player(netid)
+    return [] if player is None else player.get("games", [])
@@ -0,0 +1,101 @@
+"""
+The public read path. Identical reads made at the same time share one in-flight query
+(single flight), so the burst of leaderboard loads after a kill announcement rebuilds
+the leaderboard once, and the independent queries of a read are fetched concurrently.
+
+Both are plain threads here. Under gevent (serve.py, or gunicorn -k gevent) the standard
+library is patched, so the threads are greenlets and pymongo yields while it waits on the
+server: one worker holds hundreds of concurrent readers instead of one per thread.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# threads of the pool that runs the concurrent parts of reads
+READ_THREADS = int(os.environ.get("READ_THREADS", 8))
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs fn once per key at a time. Callers that ask for a key already being read
+    wait for that read and get its result, or its exception
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "shared": self.shared}
+
+
+flights = SingleFlight()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """ The pool of this process. Threads do not survive a fork, so each worker makes its own"""
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(max_workers=READ_THREADS, thread_name_prefix="read")
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def concurrently(*calls):
+    """
+    Runs the calls at the same time, the first on the calling thread, and returns their
+    results in order. The calls see the caller's context, so their db round trips count
+    towards its request
+    """
+    futures = [_get_pool().submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    return [calls[0]()] + [future.result() for future in futures]
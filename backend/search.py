@@ -0,0 +1,187 @@
+"""
+Prefix search over player names, nicknames, assassin names and netids, for moderators
+who know 'darth maul' but not the netid. Keys are case-folded and accent-insensitive,
+and every word of a field starts a key, so 'maul' and 'darth m' both find the player.
+
+The index is a sorted list of (key, netid) searched with bisect. It is built from the
+players collection by the first search, not when the worker warms up, since reading every
+player would hold up the worker's first requests. Players inserted by this worker are
+added as they are inserted, and it is rebuilt in the background every
+REBUILD_SECONDS to pick up the other workers' changes, while searches keep using the
+current one. A search within a game walks the players sharing the prefix for about as
+long as checking each member's own keys would take, and then checks the members instead,
+so neither a small game nor a common prefix makes it scan the whole index.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import bisect
+import heapq
+import os
+import threading
+import time
+import unicodedata
+
+import db
+
+
+SEARCH_FIELDS = ("netid", "name", "nickname", "fullAssassinName")
+DISPLAY_FIELDS = ("netid", "name", "nickname", "fullAssassinName")
+REBUILD_SECONDS = float(os.environ.get("SEARCH_REBUILD_SECONDS", 300))
+
+
+def fold(text: str):
+    """ text without accents, case folded and with single spaces, so 'Zoë  Ávila' is 'zoe avila'"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().replace("'", " ").split())
+
+
+def keys_of(player: dict):
+    """ The folded keys of a player: each searched field from each of its words on"""
+    keys = set()
+    for field in SEARCH_FIELDS:
+        value = player.get(field)
+        if not value or value == "*":
+            continue
+        words = fold(value).split(" ")
+        for i in range(len(words)):
+            keys.add(" ".join(words[i:]))
+    return keys
+
+
+class PlayerSearchIndex:
+
+    def __init__(self, rebuild_seconds=REBUILD_SECONDS):
+        self.rebuild_seconds = rebuild_seconds
+        self._entries = []
+        # netid: (display fields, keys)
+        self._players = {}
+        self._built_at = None
+        self._rebuilding = False
+        # players added while a build reads the db, added again to the new index
+        self._added_during_build = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def build(self):
+        """ Rebuilds the index from every player in the db"""
+        with self._lock:
+            self._added_during_build = []
+        projection = {"_id": 0, **{field: 1 for field in SEARCH_FIELDS}}
+        players = {}
+        entries = []
+        for player in db.get_collection("players").find({}, projection):
+            keys = keys_of(player)
+            players[player["netid"]] = ({field: player.get(field) for field in DISPLAY_FIELDS}, keys)
+            entries.extend((key, player["netid"]) for key in keys)
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._players = players
+            for player in self._added_during_build or ():
+                self._add(player)
+            self._added_during_build = None
+            self._built_at = time.monotonic()
+            self._rebuilding = False
+
+    def _rebuild_in_background(self):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"Failed to rebuild the player search index: {e}")
+            with self._lock:
+                self._added_during_build = None
+                self._rebuilding = False
+
+    def warmup(self):
+        """ Builds the index once, concurrent callers wait for the one build"""
+        if self._built_at is None:
+            with self._build_lock:
+                if self._built_at is None:
+                    self.build()
+
+    def _ensure_built(self):
+        if self._built_at is None:
+            self.warmup()
+            return
+        with self._lock:
+            if self._rebuilding or time.monotonic() - self._built_at <= self.rebuild_seconds:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, name="search-index", daemon=True).start()
+
+    def add(self, player: dict):
+        """ Adds or replaces a player. Until the index is first built there is nothing to update"""
+        with self._lock:
+            if self._added_during_build is not None:
+                self._added_during_build.append(player)
+            if self._built_at is not None:
+                self._add(player)
+
+    def _add(self, player: dict):
+        old = self._players.get(player["netid"])
+        if old is not None:
+            for key in old[1]:
+                i = bisect.bisect_left(self._entries, (key, player["netid"]))
+                if i < len(self._entries) and self._entries[i] == (key, player["netid"]):
+                    del self._entries[i]
+        keys = keys_of(player)
+        self._players[player["netid"]] = ({field: player.get(field) for field in DISPLAY_FIELDS}, keys)
+        for key in keys:
+            bisect.insort(self._entries, (key, player["netid"]))
+
+    def _prefix_range(self, prefix: str):
+        """ The slice of the entries whose key starts with prefix"""
+        start = bisect.bisect_left(self._entries, (prefix,))
+        end = bisect.bisect_left(self._entries, (prefix[:-1] + chr(ord(prefix[-1]) + 1),), start)
+        return start, end
+
+    def search(self, query: str, limit=10, among=None):
+        """
+        The display fields of up to limit players with a key starting with query, in key
+        order. among, a set of netids, limits the results to those players
+        """
+        prefix = fold(query)
+        if not prefix or limit < 1:
+            return []
+        self._ensure_built()
+        with self._lock:
+            start, end = self._prefix_range(prefix)
+            stop = end
+            if among is not None:
+                # walk about as many entries as the members have keys
+                stop = min(end, start + len(among) * len(self._entries) // max(len(self._players), 1))
+            found = {}
+            i = start
+            while i < stop and len(found) < limit:
+                netid = self._entries[i][1]
+                i += 1
+                if netid not in found and (among is None or netid in among):
+                    found[netid] = dict(self._players[netid][0])
+            if among is None or len(found) == limit or i == end:
+                return list(found.values())
+        # few of the players sharing the prefix are members, look at the members instead
+        return self._search_among(prefix, limit, among)
+
+    def _search_among(self, prefix: str, limit, among):
+        """
+        search within a few players: their own keys are matched, so players outside among
+        cost nothing. Runs without the lock, every player's entry is replaced whole
+        """
+        matches = []
+        for netid in among:
+            player = self._players.get(netid)
+            if player is None:
+                continue
+            keys = [key for key in player[1] if key.startswith(prefix)]
+            if keys:
+                matches.append((min(keys), netid, player[0]))
+        return [dict(display) for _, _, display in heapq.nsmallest(limit, matches)]
+
+    def stats(self):
+        with self._lock:
+            return {"players": len(self._players), "keys": len(self._entries)}
+
+
+player_index = PlayerSearchIndex()
@@ -0,0 +1,38 @@
+"""
+Serves the app from one gevent process. The standard library is patched before anything
+else is imported, so every request is a greenlet and waiting on Mongo or SendGrid yields
+to the other requests instead of blocking the process. The public reads then scale with
+open connections, not threads; see reads.py.
+
+    python serve.py --port 5000
+
+In production Gunicorn's gevent workers do the same patching:
+
+    gunicorn -k gevent --worker-connections 1000 -w 4 app:app
+"""
+__author__ = 'Pierce Maloney'
+
+
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+
+from gevent.pywsgi import WSGIServer
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"Serving on http://{args.host}:{args.port}")
+    WSGIServer((args.host, args.port), app.app).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
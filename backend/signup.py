@@ -0,0 +1,95 @@
+"""
+Bulk import of the signup form CSV into the players collection.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import csv
+import time
+
+from pymongo.errors import BulkWriteError
+
+import db
+from players import build_player_doc, normalize_netid, player_cache
+from search import player_index
+
+
+CHUNK_SIZE = 500
+
+
+def read_signup_rows(file_path):
+    """
+    Yields (line_number, row) for each row of the signup CSV, without loading the whole file
+    """
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def player_from_row(row: dict):
+    """
+    returns the player document of a signup row. Raises ValueError if the row is unusable
+    """
+    netid = normalize_netid(row.get('netID') or '')
+    full_name = (row.get('Full Name') or '').strip()
+    nickname = (row.get('Assassin Name') or '').strip() or None
+    email_address = (row.get('Email Address') or '').strip()
+
+    if not netid or not full_name:
+        raise ValueError("missing required fields")
+    if "." in netid or netid.startswith("$"):
+        raise ValueError(f"invalid netid {netid}")
+    return build_player_doc(netid, full_name, nickname, email_address)
+
+
+def import_players(rows, chunk_size=CHUNK_SIZE):
+    """
+    Adds the players of (line_number, row) pairs to the players collection.
+    Duplicate netids within the rows keep their first row, players that already
+    exist are left as they are, one query checks which exist, and new players are
+    written with unordered insert_many in chunks.
+    Returns a report with the netids of every usable row and the rejected rows
+    """
+    start = time.perf_counter()
+    collection = db.get_collection("players")
+
+    report = {"rows": 0, "inserted": 0, "existing": 0, "rejected": [], "netids": []}
+    new_players = {}
+    for line_number, row in rows:
+        report["rows"] += 1
+        try:
+            player = player_from_row(row)
+        except ValueError as e:
+            report["rejected"].append({"line": line_number, "reason": str(e), "row": row})
+            continue
+        if player["netid"] in new_players:
+            report["rejected"].append({"line": line_number, "reason": f"duplicate of netid {player['netid']}", "row": row})
+            continue
+        new_players[player["netid"]] = player
+    report["netids"] = list(new_players)
+
+    # one round trip for all the players that already exist
+    existing = collection.find({"netid": {"$in": report["netids"]}}, {"netid": 1, "_id": 0})
+    for player in existing:
+        del new_players[player["netid"]]
+        report["existing"] += 1
+
+    to_insert = list(new_players.values())
+    for player in to_insert:
+        player_cache.invalidate(player["netid"])
+    for i in range(0, len(to_insert), chunk_size):
+        try:
+            result = collection.insert_many(to_insert[i:i + chunk_size], ordered=False)
+            report["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            # someone else inserted some of them since the existence check
+            report["inserted"] += e.details["nInserted"]
+            report["existing"] += len(e.details["writeErrors"])
+    for player in to_insert:
+        player_index.add(player)
+
+    elapsed = time.perf_counter() - start
+    report["seconds"] = round(elapsed, 3)
+    report["rows_per_second"] = round(report["rows"] / max(elapsed, 1e-9), 1)
+    return report
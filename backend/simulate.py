@@ -0,0 +1,205 @@
+"""
+Monte Carlo simulator for planning a game: how long it runs and how kills spread over
+the players of a random ring, as new_game and shuffle_game make it.
+
+A batch of games is simulated at once with NumPy. Each game is a row of (games, players)
+target and hunter arrays that starts as a random permutation ring, and every step
+removes one player from every game of the batch:
+  - a kill, where a random alive player kills their target, at kill_rate per alive player per day
+  - a dropout (unalive_player), at dropout_rate per alive player per day
+until one player is left.
+
+A chain is a line of players who each killed the next one, as in the kill log; the
+longest chain of a game is the depth of its kill tree.
+
+    python simulate.py --players 500 --games 10000
+    python simulate.py --csv ivy_assassin_signup.csv --games 10000 --dropout-rate 0.02 --processes 4
+"""
+__author__ = 'Pierce Maloney'
+
+
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# games simulated together. Memory is about 24 bytes per player per game of the batch
+BATCH_SIZE = 2000
+PERCENTILES = (10, 50, 90, 99)
+
+
+def simulate_batch(players: int, games: int, kill_rate=0.2, dropout_rate=0.0, seed=None):
+    """
+    Plays games games of players players to the end. Returns the per-game results as arrays:
+    days, dropouts, winner, winner_kills, max_kills, longest_chain and gini, and the
+    kills_histogram of the kill counts of every player of every game
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.arange(games)
+    columns = rows[:, None]
+
+    # the player at each position of a shuffled order targets the next one
+    order = rng.permuted(np.tile(np.arange(players, dtype=np.int32), (games, 1)), axis=1)
+    following = np.roll(order, -1, axis=1)
+    targets = np.empty((games, players), dtype=np.int32)
+    hunters = np.empty((games, players), dtype=np.int32)
+    targets[columns, order] = following
+    hunters[columns, following] = order
+
+    # alive players of each game, with their position in it, for O(1) random picks and removal
+    alive = np.tile(np.arange(players, dtype=np.int32), (games, 1))
+    position = alive.copy()
+    kills = np.zeros((games, players), dtype=np.int32)
+    chain = np.zeros((games, players), dtype=np.int32)
+    days = np.zeros(games)
+    dropouts = np.zeros(games, dtype=np.int32)
+    event_rate = kill_rate + dropout_rate
+    kill_chance = kill_rate / event_rate
+
+    for count in range(players, 1, -1):
+        picked = alive[rows, (rng.random(games) * count).astype(np.intp)]
+        is_kill = rng.random(games) < kill_chance if dropout_rate else np.ones(games, dtype=bool)
+        # a killer removes their target, a dropout removes themselves. Either way the
+        # removed player's hunter inherits their target
+        removed = np.where(is_kill, targets[rows, picked], picked)
+        hunter = hunters[rows, removed]
+        target = targets[rows, removed]
+        targets[rows, hunter] = target
+        hunters[rows, target] = hunter
+        kills[rows, hunter] += is_kill
+        chain[rows, hunter] = np.where(is_kill, np.maximum(chain[rows, hunter], chain[rows, removed] + 1),
+                                       chain[rows, hunter])
+        dropouts += ~is_kill
+
+        last = alive[:, count - 1]
+        slot = position[rows, removed]
+        alive[rows, slot] = last
+        position[rows, last] = slot
+        days += rng.exponential(1.0, games) / (count * event_rate)
+
+    winner = alive[:, 0]
+    ordered = np.sort(kills, axis=1)
+    total = ordered.sum(axis=1)
+    weighted = (ordered * np.arange(1, players + 1)).sum(axis=1)
+    gini = np.where(total > 0, 2 * weighted / (players * np.maximum(total, 1)) - (players + 1) / players, 0.0)
+    return {
+        "days": days,
+        "dropouts": dropouts,
+        "winner": winner,
+        "winner_kills": kills[rows, winner],
+        "max_kills": kills.max(axis=1),
+        "longest_chain": chain.max(axis=1),
+        "gini": gini,
+        "kills_histogram": np.bincount(kills.ravel(), minlength=players),
+    }
+
+
+def _simulate_batch(arguments):
+    return simulate_batch(*arguments)
+
+
+def simulate(players: int, games: int, kill_rate=0.2, dropout_rate=0.0, seed=0,
+             batch_size=BATCH_SIZE, processes=1):
+    """ Plays games games in batches, on a pool of processes if processes > 1, and merges their results"""
+    seeds = np.random.SeedSequence(seed).spawn((games + batch_size - 1) // batch_size)
+    batches = [(players, min(batch_size, games - i * batch_size), kill_rate, dropout_rate, batch_seed)
+               for i, batch_seed in enumerate(seeds)]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_simulate_batch, batches))
+    else:
+        results = [_simulate_batch(batch) for batch in batches]
+
+    merged = {key: np.concatenate([result[key] for result in results])
+              for key in results[0] if key != "kills_histogram"}
+    merged["kills_histogram"] = sum(result["kills_histogram"] for result in results)
+    return merged
+
+
+# -----------------------------------------------------------------
+# Report
+
+def distribution(values):
+    values = np.asarray(values)
+    summary = {"mean": round(float(values.mean()), 3)}
+    for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        summary[f"p{percentile}"] = round(float(value), 3)
+    summary["max"] = round(float(values.max()), 3)
+    return summary
+
+
+def report(results: dict, roster):
+    """
+    The distributions of a simulation. Ring fairness: every player should win about as
+    often, so win_spread, the chi-square of the win counts per degree of freedom, is
+    about 1 for a fair ring and grows with any bias
+    """
+    players = len(roster)
+    games = len(results["days"])
+    wins = np.bincount(results["winner"], minlength=players)
+    expected = games / players
+    histogram = results["kills_histogram"]
+    last = int(np.flatnonzero(histogram).max()) + 1
+    return {
+        "players": players,
+        "games": games,
+        "days": distribution(results["days"]),
+        "kills": players - 1 - float(results["dropouts"].mean()),
+        "dropouts": distribution(results["dropouts"]),
+        "winner_kills": distribution(results["winner_kills"]),
+        "max_kills": distribution(results["max_kills"]),
+        "longest_chain": distribution(results["longest_chain"]),
+        "gini": distribution(results["gini"]),
+        # share of players that end a game with each number of kills
+        "players_with_kills": [round(float(count) / (games * players), 5) for count in histogram[:last]],
+        "win_spread": round(float(((wins - expected) ** 2 / expected).sum() / max(players - 1, 1)), 3),
+        "most_wins": {roster[i]: int(wins[i]) for i in np.argsort(wins)[::-1][:3]},
+    }
+
+
+def roster_from_csv(file_path):
+    """ The netids of the usable rows of a signup CSV, as process_csv_and_create_game reads it"""
+    from signup import player_from_row, read_signup_rows
+
+    netids = {}
+    for line, row in read_signup_rows(file_path):
+        try:
+            netids.setdefault(player_from_row(row)["netid"], line)
+        except ValueError as e:
+            print(f"Skipping row {line} ({e})")
+    return list(netids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=500, help="size of a synthetic roster")
+    parser.add_argument("--csv", default=None, help="take the roster from a signup CSV instead")
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--kill-rate", type=float, default=0.2, help="kills per alive player per day")
+    parser.add_argument("--dropout-rate", type=float, default=0.0, help="dropouts per alive player per day")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    roster = roster_from_csv(args.csv) if args.csv else [f"player{i}" for i in range(args.players)]
+    if len(roster) < 2:
+        raise SystemExit("A game needs at least 2 players")
+    start = time.perf_counter()
+    results = simulate(len(roster), args.games, args.kill_rate, args.dropout_rate, args.seed,
+                       args.batch_size, args.processes)
+    summary = report(results, roster)
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
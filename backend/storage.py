@@ -0,0 +1,719 @@
+"""
+In-memory storage engine. The app talks to its collections (games, players, the
+outbox...) through the subset of the pymongo Collection API listed below, so either
+a real Mongo collection or a MemoryCollection can sit behind db.get_collection.
+Select it with ASSASSIN_STORAGE=memory to run, test and benchmark without MongoDB.
+
+    insert_one, insert_many, find_one, find, count_documents, update_one,
+    update_many, find_one_and_update, delete_one, delete_many, bulk_write, create_index
+
+The in-memory engine keeps Mongo's semantics for everything the app relies on:
+documents are copied in and out, every write is atomic under a per-collection lock,
+unique indexes raise DuplicateKeyError, and filters support dotted paths, array
+membership, $in/$nin/$ne/$exists/$lt/$lte/$gt/$gte, $or and $and.
+"""
+__author__ = 'Pierce Maloney'
+
+
+import itertools
+import threading
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+_MISSING = object()
+
+
+# -----------------------------------------------------------------
+# Documents
+
+def _copy(value):
+    """Deep copy of a document. Much faster than copy.deepcopy for plain dicts and lists"""
+    if isinstance(value, dict):
+        return {k: _copy(v) if isinstance(v, (dict, list)) else v for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) if isinstance(v, (dict, list)) else v for v in value]
+    return value
+
+
+def _get(doc, path):
+    """Value at a dotted path, or _MISSING"""
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return _MISSING
+    return value
+
+
+def _parent(doc, path, create=False):
+    """The dict holding the last part of a dotted path, and that last part"""
+    parts = path.split(".")
+    for part in parts[:-1]:
+        if part not in doc or not isinstance(doc[part], dict):
+            if not create:
+                return None, parts[-1]
+            doc[part] = {}
+        doc = doc[part]
+    return doc, parts[-1]
+
+
+def _compare_key(value):
+    # Mongo orders by type before value; this is enough for the types we store
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (4, value)
+    return (5, str(value))
+
+
+class _ValueSet:
+    """The list of an $in or $nin with O(1) membership for hashable values"""
+
+    def __init__(self, items):
+        self.items = list(items)
+        self._hashed = set()
+        for item in self.items:
+            try:
+                self._hashed.add(item)
+            except TypeError:
+                pass
+
+    def __contains__(self, value):
+        try:
+            return value in self._hashed
+        except TypeError:
+            return value in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _prepare(query):
+    """The query with its $in and $nin lists turned into _ValueSets"""
+    prepared = {}
+    for key, condition in query.items():
+        if key in ("$or", "$and"):
+            condition = [_prepare(q) for q in condition]
+        elif isinstance(condition, dict):
+            condition = {op: _ValueSet(arg) if op in ("$in", "$nin") else arg
+                         for op, arg in condition.items()}
+        prepared[key] = condition
+    return prepared
+
+
+def _in(value, values):
+    if value is _MISSING:
+        return None in values
+    if isinstance(value, list):
+        return any(v in values for v in value) or value in values.items
+    return value in values
+
+
+def _matches_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for op, arg in condition.items():
+            if not _matches_operator(value, op, arg):
+                return False
+        return True
+    return _equals(value, condition)
+
+
+def _equals(value, target):
+    if value is _MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    return value == target
+
+
+def _matches_operator(value, op, arg):
+    if op == "$eq":
+        return _equals(value, arg)
+    if op == "$ne":
+        return not _equals(value, arg)
+    if op == "$in":
+        return _in(value, arg if isinstance(arg, _ValueSet) else _ValueSet(arg))
+    if op == "$nin":
+        return not _in(value, arg if isinstance(arg, _ValueSet) else _ValueSet(arg))
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op in ("$lt", "$lte", "$gt", "$gte"):
+        if value is _MISSING or value is None:
+            return False
+        a, b = _compare_key(value), _compare_key(arg)
+        if a[0] != b[0]:
+            return False
+        return {"$lt": a < b, "$lte": a <= b, "$gt": a > b, "$gte": a >= b}[op]
+    raise NotImplementedError(f"Unsupported query operator {op}")
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif not _matches_condition(_get(doc, key), condition):
+            return False
+    return True
+
+
+def _apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == "$setOnInsert":
+            if not inserting:
+                continue
+            op = "$set"
+        for path, arg in fields.items():
+            parent, key = _parent(doc, path, create=op != "$unset")
+            if op == "$set":
+                parent[key] = _copy(arg)
+            elif op == "$unset":
+                if parent is not None:
+                    parent.pop(key, None)
+            elif op == "$inc":
+                parent[key] = parent.get(key, 0) + arg
+            elif op == "$push":
+                items = arg["$each"] if isinstance(arg, dict) and "$each" in arg else [arg]
+                parent.setdefault(key, []).extend(_copy(items))
+            elif op == "$addToSet":
+                items = arg["$each"] if isinstance(arg, dict) and "$each" in arg else [arg]
+                current = parent.setdefault(key, [])
+                current.extend(_copy(i) for i in items if i not in current)
+            elif op == "$pull":
+                if key in parent:
+                    if isinstance(arg, dict) and "$in" in arg:
+                        removed = arg["$in"]
+                        parent[key] = [v for v in parent[key] if v not in removed]
+                    else:
+                        parent[key] = [v for v in parent[key] if v != arg]
+            else:
+                raise NotImplementedError(f"Unsupported update operator {op}")
+
+
+def _project(doc, projection):
+    if not projection:
+        return _copy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = projection.get("_id", 1)
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+
+    if not fields and include_id:
+        return {"_id": doc["_id"]} if "_id" in doc else {}
+    if all(not v for v in fields.values()):
+        result = _copy(doc)
+        for path in fields:
+            parent, key = _parent(result, path)
+            if parent is not None:
+                parent.pop(key, None)
+    else:
+        result = {}
+        for path in fields:
+            # like Mongo, keep the embedded documents on the path even if the leaf is missing
+            source, target = doc, result
+            parts = path.split(".")
+            for part in parts[:-1]:
+                if not isinstance(source.get(part), dict):
+                    break
+                source = source[part]
+                target = target.setdefault(part, {})
+            else:
+                if parts[-1] in source:
+                    target[parts[-1]] = _copy(source[parts[-1]])
+    if include_id and "_id" in doc:
+        result["_id"] = doc["_id"]
+    elif not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _sort_docs(docs, sort):
+    if not sort:
+        return docs
+    if isinstance(sort, str):
+        sort = [(sort, 1)]
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda d: _compare_key(_get(d, field)), reverse=direction < 0)
+    return docs
+
+
+# -----------------------------------------------------------------
+# Results
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+        self.acknowledged = True
+
+
+class InsertManyResult:
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+        self.acknowledged = True
+
+
+class UpdateResult:
+    def __init__(self, matched_count, modified_count, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+        self.acknowledged = True
+
+
+class DeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+        self.acknowledged = True
+
+
+class BulkWriteResult:
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.deleted_count = 0
+        self.upserted_count = 0
+        self.upserted_ids = {}
+        self.acknowledged = True
+
+
+class MemoryCursor:
+    """Lazily sorted and sliced result of MemoryCollection.find"""
+
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=1):
+        self._sort = [(key_or_list, direction)] if isinstance(key_or_list, str) else key_or_list
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def __iter__(self):
+        docs = self._collection._select(self._query, self._sort, self._skip, self._limit)
+        return (_project(doc, self._projection) for doc in docs)
+
+
+# -----------------------------------------------------------------
+# Collection
+
+class MemoryCollection:
+    """
+    Thread-safe in-memory collection with the pymongo semantics the app relies on.
+    Fields with an index get a hash index, so equality and $in lookups on them
+    do not scan the whole collection.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._docs = {}
+        # _id -> insertion number, to return index lookups in natural order
+        self._order = {}
+        self._counter = itertools.count()
+        self._lock = threading.RLock()
+        # field -> {value: set of _ids}
+        self._hash_indexes = {}
+        # index name -> (fields, unique, expire_after_seconds, partial filter or None)
+        self._indexes = {}
+
+    # indexes
+
+    def create_index(self, keys, unique=False, expireAfterSeconds=None, name=None,
+                     partialFilterExpression=None, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        fields = tuple(field for field, _ in keys)
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        # only the documents matching a partial filter are in the index
+        partial = None if partialFilterExpression is None else _prepare(partialFilterExpression)
+        with self._lock:
+            if unique:
+                seen = set()
+                for doc in self._docs.values():
+                    if partial is not None and not matches(doc, partial):
+                        continue
+                    key = self._unique_key(doc, fields)
+                    if key in seen:
+                        raise DuplicateKeyError(f"E11000 duplicate key error index: {name}")
+                    seen.add(key)
+            self._indexes[name] = (fields, unique, expireAfterSeconds, partial)
+            # every field of a unique index is hashed, so uniqueness is checked
+            # against the few documents sharing all of its values
+            for field in fields if unique else fields[:1]:
+                if field not in self._hash_indexes:
+                    index = {}
+                    for _id, doc in self._docs.items():
+                        self._index_value(index, _get(doc, field), _id)
+                    self._hash_indexes[field] = index
+        return name
+
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes = {}
+            self._hash_indexes = {}
+
+    def index_information(self):
+        with self._lock:
+            return {name: {"key": [(f, 1) for f in fields], "unique": unique}
+                    for name, (fields, unique, _, _) in self._indexes.items()}
+
+    @staticmethod
+    def _unique_key(doc, fields):
+        return tuple(repr(_get(doc, field)) for field in fields)
+
+    @staticmethod
+    def _index_value(index, value, _id):
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            try:
+                index.setdefault(v, set()).add(_id)
+            except TypeError:
+                index.setdefault(repr(v), set()).add(_id)
+
+    @staticmethod
+    def _unindex_value(index, value, _id):
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            try:
+                ids = index.get(v)
+            except TypeError:
+                ids = index.get(repr(v))
+            if ids is not None:
+                ids.discard(_id)
+
+    def _check_unique(self, doc, ignore_id=None):
+        for name, (fields, unique, _, partial) in self._indexes.items():
+            if not unique or partial is not None and not matches(doc, partial):
+                continue
+            key = self._unique_key(doc, fields)
+            ids = self._docs
+            for field in fields:
+                index = self._hash_indexes.get(field)
+                value = _get(doc, field)
+                if index is None or isinstance(value, list):
+                    continue
+                try:
+                    field_ids = index.get(value, ())
+                except TypeError:
+                    field_ids = index.get(repr(value), ())
+                if len(field_ids) < len(ids):
+                    ids = field_ids
+            for _id in ids:
+                if _id == ignore_id or partial is not None and not matches(self._docs[_id], partial):
+                    continue
+                if self._unique_key(self._docs[_id], fields) == key:
+                    raise DuplicateKeyError(f"E11000 duplicate key error index: {name} dup key: {key}")
+
+    def _add_to_indexes(self, doc):
+        for field, index in self._hash_indexes.items():
+            self._index_value(index, _get(doc, field), doc["_id"])
+
+    def _remove_from_indexes(self, doc):
+        for field, index in self._hash_indexes.items():
+            self._unindex_value(index, _get(doc, field), doc["_id"])
+
+    def _remove_doc(self, doc):
+        self._remove_from_indexes(doc)
+        del self._docs[doc["_id"]]
+        del self._order[doc["_id"]]
+
+    def _candidates(self, query):
+        """_ids that may match, using a hash index if one applies, otherwise None"""
+        if "$or" in query:
+            ids = set()
+            for branch in query["$or"]:
+                branch_ids = self._candidates(branch)
+                if branch_ids is None:
+                    break
+                ids |= branch_ids
+            else:
+                return ids
+        best = None
+        for field, condition in query.items():
+            if field not in self._hash_indexes:
+                continue
+            index = self._hash_indexes[field]
+            if isinstance(condition, dict) and set(condition) == {"$in"}:
+                values = condition["$in"]
+            elif isinstance(condition, dict) or isinstance(condition, list):
+                continue
+            else:
+                values = [condition]
+            if any(v is None for v in values):
+                continue
+            matched = []
+            for v in values:
+                try:
+                    matched.append(index.get(v, ()))
+                except TypeError:
+                    matched.append(index.get(repr(v), ()))
+            ids = matched[0] if len(matched) == 1 else set().union(*matched)
+            # with several indexed fields, the most selective one wins
+            if best is None or len(ids) < len(best):
+                best = ids
+        return None if best is None else set(best)
+
+    # reads
+
+    def _expire(self):
+        now = datetime.now(timezone.utc)
+        for fields, _, expire_after, _ in self._indexes.values():
+            if expire_after is None:
+                continue
+            cutoff = now - timedelta(seconds=expire_after)
+            expired = [doc for doc in self._docs.values()
+                       if isinstance(_get(doc, fields[0]), datetime)
+                       and _compare_key(_get(doc, fields[0])) < _compare_key(cutoff)]
+            for doc in expired:
+                self._remove_doc(doc)
+
+    def _select(self, query, sort=None, skip=0, limit=0):
+        query = _prepare(query or {})
+        with self._lock:
+            self._expire()
+            if "_id" in query and not isinstance(query["_id"], dict):
+                doc = self._docs.get(query["_id"])
+                docs = [doc] if doc is not None and matches(doc, query) else []
+            else:
+                ids = self._candidates(query)
+                pool = self._docs.values() if ids is None else \
+                    (self._docs[_id] for _id in ids if _id in self._docs)
+                docs = [doc for doc in pool if matches(doc, query)]
+                if ids is not None and not sort:
+                    # keep insertion order, like a collection scan would
+                    docs.sort(key=lambda d: self._order[d["_id"]])
+            docs = _sort_docs(docs, sort)
+            if skip:
+                docs = docs[skip:]
+            if limit:
+                docs = docs[:limit]
+            return docs
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, **kwargs):
+        cursor = MemoryCursor(self, filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return cursor.skip(skip).limit(limit)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        with self._lock:
+            docs = self._select(filter, sort, limit=1)
+            return _project(docs[0], projection) if docs else None
+
+    def count_documents(self, filter, **kwargs):
+        return len(self._select(filter))
+
+    # writes
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            if "_id" not in document:
+                document["_id"] = ObjectId()
+            doc = _copy(document)
+            if doc["_id"] in self._docs:
+                raise DuplicateKeyError(f"E11000 duplicate key error _id: {doc['_id']}")
+            self._check_unique(doc)
+            self._docs[doc["_id"]] = doc
+            self._order[doc["_id"]] = next(self._counter)
+            self._add_to_indexes(doc)
+            return InsertOneResult(doc["_id"])
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        inserted_ids = []
+        errors = []
+        for i, document in enumerate(documents):
+            try:
+                inserted_ids.append(self.insert_one(document).inserted_id)
+            except DuplicateKeyError as e:
+                errors.append({"index": i, "code": 11000, "errmsg": str(e), "op": document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted_ids)})
+        return InsertManyResult(inserted_ids)
+
+    def _indexed_roots(self):
+        fields = set(self._hash_indexes)
+        for index_fields, _, _, partial in self._indexes.values():
+            fields.update(index_fields)
+            # a document can enter a partial index by a change of its filter fields
+            fields.update(key for key in partial or () if not key.startswith("$"))
+        return {field.split(".")[0] for field in fields}
+
+    def _update_doc(self, doc, update):
+        roots = {path.split(".")[0] for fields in update.values() for path in fields}
+        if not roots & self._indexed_roots():
+            # no index can change, so update in place like the server does
+            # instead of copying what may be a very large document
+            _apply_update(doc, update)
+            return True
+
+        updated = _copy(doc)
+        _apply_update(updated, update)
+        if updated == doc:
+            return False
+        self._check_unique(updated, ignore_id=doc["_id"])
+        self._remove_from_indexes(doc)
+        self._docs[doc["_id"]] = updated
+        self._add_to_indexes(updated)
+        return True
+
+    def _upsert(self, filter, update):
+        doc = {k: _copy(v) for k, v in filter.items()
+               if not k.startswith("$") and not isinstance(v, dict)}
+        _apply_update(doc, update, inserting=True)
+        return self.insert_one(doc).inserted_id
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self._lock:
+            docs = self._select(filter, limit=1)
+            if not docs:
+                if upsert:
+                    return UpdateResult(0, 0, self._upsert(filter, update))
+                return UpdateResult(0, 0)
+            return UpdateResult(1, int(self._update_doc(docs[0], update)))
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self._lock:
+            docs = self._select(filter)
+            if not docs and upsert:
+                return UpdateResult(0, 0, self._upsert(filter, update))
+            modified = sum(self._update_doc(doc, update) for doc in docs)
+            return UpdateResult(len(docs), modified)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        with self._lock:
+            docs = self._select(filter, sort, limit=1)
+            if not docs:
+                if upsert:
+                    _id = self._upsert(filter, update)
+                    if return_document == ReturnDocument.AFTER:
+                        return _project(self._docs[_id], projection)
+                return None
+            doc = docs[0]
+            if return_document != ReturnDocument.AFTER:
+                before = _project(doc, projection)
+                self._update_doc(doc, update)
+                return before
+            self._update_doc(doc, update)
+            return _project(self._docs[doc["_id"]], projection)
+
+    def delete_one(self, filter, **kwargs):
+        with self._lock:
+            docs = self._select(filter, limit=1)
+            for doc in docs:
+                self._remove_doc(doc)
+            return DeleteResult(len(docs))
+
+    def delete_many(self, filter, **kwargs):
+        with self._lock:
+            docs = self._select(filter)
+            for doc in docs:
+                self._remove_doc(doc)
+            return DeleteResult(len(docs))
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        Applies InsertOne, UpdateOne, UpdateMany, DeleteOne and DeleteMany requests in order.
+        Duplicate keys raise BulkWriteError once the batch is done: ordered batches stop at
+        the first one, unordered ones apply every other request
+        """
+        result = BulkWriteResult()
+        errors = []
+        with self._lock:
+            for i, op in enumerate(requests):
+                try:
+                    if isinstance(op, InsertOne):
+                        self.insert_one(op._doc)
+                        result.inserted_count += 1
+                    elif isinstance(op, (UpdateOne, UpdateMany)):
+                        method = self.update_one if isinstance(op, UpdateOne) else self.update_many
+                        updated = method(op._filter, op._doc, upsert=bool(op._upsert))
+                        result.matched_count += updated.matched_count
+                        result.modified_count += updated.modified_count
+                        if updated.upserted_id is not None:
+                            result.upserted_count += 1
+                            result.upserted_ids[i] = updated.upserted_id
+                    elif isinstance(op, (DeleteOne, DeleteMany)):
+                        method = self.delete_one if isinstance(op, DeleteOne) else self.delete_many
+                        result.deleted_count += method(op._filter).deleted_count
+                    else:
+                        raise TypeError(f"Unsupported bulk write request {op!r}")
+                except DuplicateKeyError as e:
+                    errors.append({"index": i, "code": 11000, "errmsg": str(e), "op": op._doc})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({
+                "writeErrors": errors,
+                "nInserted": result.inserted_count,
+                "nMatched": result.matched_count,
+                "nModified": result.modified_count,
+                "nUpserted": result.upserted_count,
+                "nRemoved": result.deleted_count,
+                "upserted": [{"index": i, "_id": _id} for i, _id in result.upserted_ids.items()],
+            })
+        return result
+
+    def drop(self):
+        with self._lock:
+            self._docs = {}
+            self._order = {}
+            self._hash_indexes = {field: {} for field in self._hash_indexes}
+
+
+class MemoryDatabase:
+    """Collections of the in-memory engine, created on first access"""
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+        # held by db.run_transaction, so multi-document writes of the app do not interleave
+        self.transaction_lock = threading.RLock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(name)
+            return self._collections[name]
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def drop(self):
+        with self._lock:
+            self._collections = {}
+
+
+memory_db = MemoryDatabase()
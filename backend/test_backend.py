@@ -0,0 +1,1140 @@
+"""
+Tests of the backend on the in-memory engine, with emails recorded by the fake transport:
+
+    cd backend && python -m pytest -q
+"""
+__author__ = 'Pierce Maloney'
+
+
+import os
+
+# before the app reads them on import
+os.environ["ASSASSIN_STORAGE"] = "memory"
+os.environ["EMAIL_TRANSPORT"] = "fake"
+os.environ["EMAIL_WORKER_THREADS"] = "0"
+
+import gzip
+import random
+import sys
+import time
+import types
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+import pytest
+from flask import Flask, jsonify, request
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import app
+import db
+import emails
+import events
+import idempotency
+import kill_log
+import lru
+import memberships
+import metrics
+import outbox
+import players
+import signup
+import storage
+from game_state import GameState, GameStateCache
+
+
+@pytest.fixture(autouse=True)
+def fresh_storage():
+    storage.memory_db.drop()
+    app.create_indexes()
+    for cache in (app.player_cache, app.game_cache, app.leaderboards, idempotency.responses):
+        cache.clear()
+    outbox.set_transport(outbox.FakeTransport())
+    yield
+    app.app.config["GAME_LAYOUT"] = "document"
+
+
+@pytest.fixture
+def db_info(monkeypatch):
+    """ Stands in for the untracked db_info module of secrets"""
+    secrets = types.SimpleNamespace(ADMIN_API_KEY="admin-key", SENDGRID_API_KEY="key",
+                                    IVY_ASSASSIN_EMAIL="game@example.com")
+    monkeypatch.setitem(sys.modules, "db_info", secrets)
+    return secrets
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def make_game(game_name: str, size: int, layout="document"):
+    app.app.config["GAME_LAYOUT"] = layout
+    netids = [f"{game_name}{i}" for i in range(size)]
+    for netid in netids:
+        app.new_player(netid, f"Player {netid}", email=f"{netid}@example.com")
+    app.new_game(game_name, netids)
+    return netids
+
+
+def assert_ring(game: GameState):
+    """ The alive players form one ring, the hunters mirror it and every player is alive or dead"""
+    assert set(game.targets) == set(game.alive)
+    assert game.hunters == {target: hunter for hunter, target in game.targets.items()}
+    assert not set(game.alive) & set(game.dead)
+    assert set(game.kills) == set(game.alive) | set(game.dead)
+    if game.alive:
+        start = next(iter(game.alive))
+        seen = [start]
+        while game.target_of(seen[-1]) != start:
+            seen.append(game.target_of(seen[-1]))
+        assert sorted(seen) == sorted(game.alive)
+
+
+def assert_same_game(game: GameState, other: GameState):
+    assert game.targets == other.targets
+    assert set(game.alive) == set(other.alive)
+    assert list(game.dead) == list(other.dead)
+    assert game.kills == other.kills
+
+
+# -----------------------------------------------------------------
+# In-memory engine
+
+def test_memory_filters_and_updates():
+    collection = storage.MemoryCollection("things")
+    collection.insert_many([
+        {"name": "a", "n": 1, "tags": ["x", "y"], "meta": {"color": "red"}},
+        {"name": "b", "n": 2, "tags": ["y"]},
+        {"name": "c", "n": 3, "tags": [], "meta": {"color": "blue"}},
+    ])
+
+    def names(query, **kwargs):
+        return [doc["name"] for doc in collection.find(query, sort=[("name", 1)], **kwargs)]
+
+    assert names({"tags": "x"}) == ["a"]
+    assert names({"meta.color": "blue"}) == ["c"]
+    assert names({"n": {"$in": [1, 3]}}) == ["a", "c"]
+    assert names({"n": {"$nin": [1, 3]}}) == ["b"]
+    assert names({"n": {"$ne": 2}}) == ["a", "c"]
+    assert names({"meta": {"$exists": False}}) == ["b"]
+    assert names({"n": {"$gt": 1, "$lte": 3}}) == ["b", "c"]
+    assert names({"$or": [{"n": 1}, {"meta.color": "blue"}]}) == ["a", "c"]
+    assert names({"$and": [{"tags": "y"}, {"n": {"$gte": 2}}]}) == ["b"]
+    assert names({}, skip=1, limit=1) == ["b"]
+    assert [doc["name"] for doc in collection.find({}, sort=[("n", pymongo.DESCENDING)])] == ["c", "b", "a"]
+    assert collection.find_one({"name": "a"}, {"_id": 0, "meta.color": 1}) == {"meta": {"color": "red"}}
+
+    collection.update_one({"name": "a"}, {"$inc": {"n": 10}, "$push": {"tags": "z"}, "$unset": {"meta": ""}})
+    collection.update_many({"tags": "y"}, {"$pull": {"tags": "y"}})
+    assert collection.find_one({"name": "a"}, {"_id": 0}) == {"name": "a", "n": 11, "tags": ["x", "z"]}
+    assert collection.find_one({"name": "b"})["tags"] == []
+
+    after = collection.find_one_and_update({"name": "c"}, {"$set": {"n": 4}}, projection={"n": 1, "_id": 0},
+                                           return_document=pymongo.ReturnDocument.AFTER)
+    assert after == {"n": 4}
+    assert collection.update_one({"name": "d"}, {"$set": {"n": 5}}, upsert=True).upserted_id is not None
+    assert collection.count_documents({"n": {"$gte": 4}}) == 3
+
+    # documents are copied in and out
+    doc = collection.find_one({"name": "d"})
+    doc["n"] = 99
+    assert collection.find_one({"name": "d"})["n"] == 5
+
+
+def test_memory_unique_indexes():
+    collection = storage.MemoryCollection("players")
+    collection.insert_one({"netid": "a", "game": "g"})
+    collection.insert_one({"netid": "a", "game": "h"})
+    with pytest.raises(DuplicateKeyError):
+        collection.create_index("netid", unique=True)
+
+    collection.create_index([("game", 1), ("netid", 1)], unique=True)
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({"netid": "a", "game": "g"})
+    collection.insert_one({"netid": "b", "game": "g"})
+    with pytest.raises(DuplicateKeyError):
+        collection.update_one({"netid": "b"}, {"$set": {"netid": "a"}})
+    assert collection.count_documents({"game": "g"}) == 2
+
+
+def test_memory_partial_unique_index():
+    collection = storage.MemoryCollection("jobs")
+    collection.insert_many([{"key": "a", "status": "sent"}, {"key": "a", "status": "sent"}, {"status": "pending"}])
+    collection.create_index("key", unique=True, partialFilterExpression={"status": "pending"})
+    collection.insert_one({"key": "a", "status": "pending"})
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({"key": "a", "status": "pending"})
+    # entering the index by a change of the filter field is checked too
+    with pytest.raises(DuplicateKeyError):
+        collection.update_one({"key": "a", "status": "sent"}, {"$set": {"status": "pending"}})
+    collection.update_one({"key": "a", "status": "pending"}, {"$set": {"status": "sending"}})
+    collection.update_one({"key": "a", "status": "sent"}, {"$set": {"status": "pending"}})
+    assert collection.count_documents({"key": "a", "status": "pending"}) == 1
+
+
+def test_memory_ttl_index():
+    collection = storage.MemoryCollection("claims")
+    collection.create_index("expires_at", expireAfterSeconds=0)
+    now = datetime.now(timezone.utc)
+    collection.insert_many([{"key": "old", "expires_at": now - timedelta(seconds=1)},
+                            {"key": "new", "expires_at": now + timedelta(hours=1)}])
+    assert [doc["key"] for doc in collection.find({})] == ["new"]
+
+
+def test_memory_insert_many_errors():
+    collection = storage.MemoryCollection("players")
+    collection.create_index("netid", unique=True)
+    collection.insert_one({"netid": "b"})
+    with pytest.raises(BulkWriteError) as ordered:
+        collection.insert_many([{"netid": "a"}, {"netid": "b"}, {"netid": "c"}])
+    assert ordered.value.details["nInserted"] == 1
+    with pytest.raises(BulkWriteError) as unordered:
+        collection.insert_many([{"netid": "b"}, {"netid": "d"}, {"netid": "e"}], ordered=False)
+    assert unordered.value.details["nInserted"] == 2
+    assert [error["index"] for error in unordered.value.details["writeErrors"]] == [0]
+    assert sorted(doc["netid"] for doc in collection.find({})) == ["a", "b", "d", "e"]
+
+
+def test_memory_bulk_write_errors():
+    collection = storage.MemoryCollection("players")
+    collection.create_index("netid", unique=True)
+    collection.insert_many([{"netid": "a", "n": 0}, {"netid": "b", "n": 0}])
+    requests = [
+        UpdateOne({"netid": "a"}, {"$inc": {"n": 1}}),
+        InsertOne({"netid": "b"}),
+        DeleteOne({"netid": "b"}),
+    ]
+    with pytest.raises(BulkWriteError) as ordered:
+        collection.bulk_write(requests)
+    details = ordered.value.details
+    assert (details["nModified"], details["nRemoved"]) == (1, 0)
+    assert details["writeErrors"][0]["index"] == 1
+    assert collection.count_documents({"netid": "b"}) == 1
+
+    with pytest.raises(BulkWriteError) as unordered:
+        collection.bulk_write(requests, ordered=False)
+    assert unordered.value.details["nRemoved"] == 1
+    assert collection.count_documents({"netid": "b"}) == 0
+    assert collection.find_one({"netid": "a"})["n"] == 2
+
+    result = collection.bulk_write([UpdateOne({"netid": "c"}, {"$set": {"n": 1}}, upsert=True)])
+    assert result.upserted_count == 1
+
+
+# -----------------------------------------------------------------
+# GameState
+
+def test_new_game_is_one_ring():
+    game = GameState.new("g", [f"p{i}" for i in range(50)])
+    assert_ring(game)
+    assert len(game.alive) == 50 and not game.dead
+
+
+def test_ring_survives_every_mutation():
+    rng = random.Random(7)
+    game = GameState.new("g", [f"p{i}" for i in range(40)])
+    joined = 0
+    for step in range(200):
+        alive = list(game.alive)
+        action = rng.choice(["kill", "kill", "unalive", "insert", "shuffle", "undo"])
+        if action == "kill" and len(alive) > 1:
+            killer = rng.choice(alive)
+            victim = game.target_of(killer)
+            assert game.kill(killer) == victim
+            assert game.target_of(killer) != victim and victim in game.dead
+        elif action == "unalive" and len(alive) > 1:
+            netid = rng.choice(alive)
+            hunter = game.hunter_of(netid)
+            target = game.target_of(netid)
+            assert game.unalive(netid) == hunter
+            assert game.target_of(hunter) == target
+        elif action == "insert":
+            joined += 1
+            assert game.insert_many([f"new{joined}", alive[0]]) == [f"new{joined}"]
+        elif action == "shuffle":
+            game.shuffle()
+        elif action == "undo" and game.dead:
+            victim = next(reversed(game.dead))
+            killer = rng.choice(alive)
+            kills = game.kills[killer]
+            if game.undo_kill(killer, victim):
+                assert game.target_of(killer) == victim and game.kills[killer] == kills - 1
+        assert_ring(game)
+
+
+def test_last_player_has_no_kill_left():
+    game = GameState.new("g", ["a", "b"])
+    winner = game.target_of(game.target_of("a"))
+    assert game.kill(winner) is not None
+    assert game.kill(winner) is None
+    assert game.target_of(winner) == winner
+    assert_ring(game)
+
+
+def test_doc_round_trip():
+    game = GameState.new("g", [f"p{i}" for i in range(10)])
+    game.kill(next(iter(game.alive)))
+    game.extra["version"] = 3
+    copy = GameState.from_doc(game.to_doc())
+    assert_same_game(game, copy)
+    assert copy.extra["version"] == 3
+
+
+# -----------------------------------------------------------------
+# Player cache
+
+def test_player_cache_is_a_bounded_lru_of_copies():
+    cache = players.PlayerCache(max_size=2, ttl_seconds=60)
+    assert cache.get("a") is None
+    cache.put({"netid": "a", "name": "A"})
+    cache.put({"netid": "b", "name": "B"})
+    cached = cache.get("a")
+    cached["name"] = "changed"
+    assert cache.get("a")["name"] == "A"
+    # b is now the least recently used
+    cache.put({"netid": "c", "name": "C"})
+    assert cache.get("b") is None and cache.get("c") is not None
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 2, "hit_rate": 0.6}
+
+
+def test_player_cache_entries_expire(monkeypatch):
+    cache = players.PlayerCache(max_size=10, ttl_seconds=5)
+    now = time.monotonic()
+    monkeypatch.setattr(lru.time, "monotonic", lambda: now)
+    cache.put({"netid": "a"})
+    monkeypatch.setattr(lru.time, "monotonic", lambda: now + 6)
+    assert cache.get("a") is None
+
+
+def test_player_lookups_are_served_from_the_cache():
+    app.new_player("a", "Ann Lee")
+    app.new_player("b", "Bo Diaz")
+    assert set(app.get_players(["a", "b", "a", "nobody"])) == {"a", "b"}
+    # read from the cache, not the collection
+    db.get_collection("players").delete_many({})
+    assert app.get_player_info("a")["name"] == "Ann Lee"
+    assert set(app.get_players(["a", "b"])) == {"a", "b"}
+
+    app.player_cache.invalidate("a")
+    assert app.get_player_info("a") is None
+
+
+def test_writers_invalidate_the_players_they_change():
+    app.new_player("a", "Ann Lee")
+    assert app.get_player_info("a").get("games") is None
+    players.add_memberships("g", ["a"])
+    assert app.get_player_info("a")["games"] == ["g"]
+
+
+# -----------------------------------------------------------------
+# Late joins
+
+def test_late_joiners_are_spliced_into_the_ring(client, db_info):
+    netids = make_game("g", 10)
+    before = app.get_game_state("g")
+    for netid in ("new1", "new2", "new3"):
+        app.new_player(netid, f"Player {netid}", email=f"{netid}@example.com")
+
+    response = client.post("/admin/add_players/g?api_key=" + db_info.ADMIN_API_KEY,
+                           json={"netids": ["New1", "new2", "new3", netids[0], "ghost"], "notify": True})
+    result = response.get_json()
+    assert response.status_code == 200
+    assert result["added"] == ["new1", "new2", "new3"]
+    assert (result["already_in_game"], result["unknown"]) == ([netids[0]], ["ghost"])
+
+    game = app.get_game_state("g")
+    assert_ring(game)
+    assert set(game.alive) == set(before.alive) | {"new1", "new2", "new3"}
+    # only the newcomers and the players now hunting them have new targets
+    changed = {netid for netid in before.alive if game.target_of(netid) != before.target_of(netid)}
+    assert set(result["changed_targets"]) == changed | {"new1", "new2", "new3"}
+    assert len(changed) <= 3
+    emailed = {job["to"] for job in outbox.outbox_collection().find({})}
+    assert emailed == {f"{netid}@example.com" for netid in result["changed_targets"]}
+
+
+def test_late_joiners_with_a_reshuffle():
+    make_game("g", 6)
+    app.new_player("new1", "Player new1")
+    result = app.add_players_to_game("g", ["new1"], reshuffle=True)
+    assert result["added"] == ["new1"]
+    game = app.get_game_state("g")
+    assert_ring(game)
+    assert game.is_alive("new1") and game.kills["new1"] == 0
+    assert_same_game(kill_log.rebuild("g"), game)
+
+
+@pytest.mark.parametrize("body", [{"netids": [1]}, {"netids": ["a", None]}, {"netids": "abc"}, {"netids": []}, {}])
+def test_add_players_rejects_bodies_that_are_not_netid_lists(client, db_info, body):
+    make_game("g", 4)
+    response = client.post("/admin/add_players/g?api_key=" + db_info.ADMIN_API_KEY, json=body)
+    assert response.status_code == 400
+
+
+def test_shuffle_keeps_the_alive_players():
+    make_game("g", 8)
+    app.killed_target("g", next(iter(app.get_game_state("g").alive)))
+    before = app.get_game_state("g")
+    app.shuffle_game("g")
+    game = app.get_game_state("g")
+    assert_ring(game)
+    assert set(game.alive) == set(before.alive) and game.kills == before.kills
+
+
+# -----------------------------------------------------------------
+# Signup import
+
+SIGNUP_CSV = """\
+Timestamp,Email Address,Full Name,netID,Assassin Name
+4/23/2023 21:45:33,ann@example.com,Ann Lee,AnnL ,*
+4/23/2023 21:46:10,bo@example.com,Bo Diaz,bod,the blade
+4/23/2023 21:47:02,ann2@example.com,Ann Again,annl,
+4/23/2023 21:48:40,,No Netid,,
+4/23/2023 21:49:13,dot@example.com,Dot Com,d.c,
+4/23/2023 21:50:55,old@example.com,Old Timer,old,
+4/23/2023 21:51:30,,Cy Young,cy,
+"""
+
+
+def test_signup_csv_import(tmp_path):
+    app.new_player("old", "Old Timer", email="old@example.com")
+    path = tmp_path / "signup.csv"
+    path.write_text(SIGNUP_CSV, encoding="utf-8")
+
+    report = app.process_csv_and_create_game(str(path), "g")
+    assert (report["rows"], report["inserted"], report["existing"]) == (7, 3, 1)
+    assert report["netids"] == ["annl", "bod", "old", "cy"]
+    assert [(rejected["line"], rejected["reason"]) for rejected in report["rejected"]] == [
+        (4, "duplicate of netid annl"), (5, "missing required fields"), (6, "invalid netid d.c")]
+
+    players = app.get_players(report["netids"])
+    assert players["bod"]["fullAssassinName"] == "Bo 'the blade' Diaz"
+    assert players["annl"]["email"] == "ann@example.com"
+    assert players["cy"]["email"] == "cy@princeton.edu"
+    assert set(app.get_game_state("g").alive) == set(report["netids"])
+
+
+def test_signup_import_in_chunks():
+    rows = [(i + 2, {"netID": f"p{i}", "Full Name": f"Player {i}", "Email Address": ""}) for i in range(7)]
+    report = signup.import_players(rows, chunk_size=3)
+    assert report["inserted"] == 7
+    assert db.get_collection("players").count_documents({}) == 7
+    assert signup.import_players(rows, chunk_size=3)["existing"] == 7
+
+
+# -----------------------------------------------------------------
+# Leaderboard
+
+def test_leaderboard_is_sorted_and_revalidated_with_its_etag(client):
+    make_game("g", 6)
+    killer = next(iter(app.get_game_state("g").alive))
+    app.killed_target("g", killer)
+
+    response = client.get("/api/game-players/g")
+    rows = response.get_json()
+    assert response.status_code == 200 and len(rows) == 6
+    assert rows[0]["netid"] == killer and rows[0]["kills"] == 1
+    assert "email" not in rows[0]
+    etag = response.headers["ETag"]
+    assert client.get("/api/game-players/g", headers={"If-None-Match": etag}).status_code == 304
+    assert app.leaderboards.hits >= 1
+
+    app.killed_target("g", killer)
+    response = client.get("/api/game-players/g", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert response.get_json()[0]["kills"] == 2
+
+
+def test_leaderboard_is_gzipped_for_clients_that_accept_it(client):
+    make_game("g", 40)
+    plain = client.get("/api/game-players/g")
+    assert "Content-Encoding" not in plain.headers
+    assert len(plain.data) >= app.GZIP_MIN_BYTES
+
+    compressed = client.get("/api/game-players/g", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(compressed.data) == plain.data
+    # a different representation, with its own etag
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+    assert client.get("/api/game-players/g", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]}).status_code == 304
+
+
+def test_leaderboard_pages_follow_their_cursors(client):
+    make_game("g", 9)
+    for _ in range(3):
+        app.killed_target("g", next(iter(app.get_game_state("g").alive)))
+    full = client.get("/api/game-players/g").get_json()
+
+    pages, after = [], None
+    while True:
+        query = "limit=4" + (f"&after={after}" if after else "")
+        page = client.get(f"/api/game-players/g?{query}").get_json()
+        pages.append(page["players"])
+        after = page["next"]
+        if after is None:
+            break
+    assert [len(page) for page in pages] == [4, 4, 1]
+    assert [row for page in pages for row in page] == full
+
+    alive = client.get("/api/game-players/g?alive=true&limit=50").get_json()
+    assert alive["next"] is None
+    assert [row["netid"] for row in alive["players"]] == [row["netid"] for row in full if row["isAlive"]]
+
+
+def test_leaderboard_pages_project_their_fields(client):
+    make_game("g", 3)
+    page = client.get("/api/game-players/g?fields=netid,kills").get_json()
+    assert all(set(row) == {"netid", "kills"} for row in page["players"])
+    assert client.get("/api/game-players/g?fields=netid,email").status_code == 400
+
+
+@pytest.mark.parametrize("query", ["limit=abc", "limit=0", "limit=-3", "after=nope", "alive=maybe"])
+def test_leaderboard_page_parameters_are_checked(client, query):
+    make_game("g", 3)
+    assert client.get(f"/api/game-players/g?{query}").status_code == 400
+
+
+def test_player_api_serves_public_fields(client):
+    app.new_player("a", "Ann Lee", nickname="the axe", email="ann@example.com")
+    player = client.get("/api/players/A").get_json()
+    assert player["fullAssassinName"] == "Ann 'the axe' Lee"
+    assert "email" not in player and "_id" not in player
+
+
+# -----------------------------------------------------------------
+# Leaderboard streams
+
+def test_leaderboard_diff_events():
+    old = [{"netid": "a", "kills": 0, "isAlive": True}, {"netid": "b", "kills": 0, "isAlive": True},
+           {"netid": "c", "kills": 1, "isAlive": False}]
+    new = [{"netid": "a", "kills": 1, "isAlive": True}, {"netid": "b", "kills": 0, "isAlive": False},
+           {"netid": "c", "kills": 1, "isAlive": True}, {"netid": "d", "kills": 0, "isAlive": True}]
+    assert events.leaderboard_diff(old, new) == [
+        ("kills", {"netid": "a", "kills": 1}),
+        ("died", {"netid": "b"}),
+        ("revived", {"netid": "c"}),
+        ("joined", new[3]),
+    ]
+    assert events.format_event("died", {"netid": "b"}) == 'event: died\ndata: {"netid":"b"}\n\n'
+
+
+def test_broker_sends_the_changes_of_a_kill(monkeypatch):
+    broker = events.LeaderboardBroker(app.get_leaderboard)
+    # published by hand instead of by the watcher thread
+    monkeypatch.setattr(broker, "_start_watcher", lambda: None)
+    make_game("g", 4)
+    assert broker.subscribe("missing") is None
+    subscriber = broker.subscribe("g")
+    assert broker.subscriber_count() == 1
+
+    killer = next(iter(app.get_game_state("g").alive))
+    victim = app.killed_target("g", killer)
+    broker.publish("g")
+    messages = []
+    while not subscriber.empty():
+        messages.append(subscriber.get_nowait())
+    leaderboard = app.get_leaderboard("g")
+    assert messages == [
+        events.format_event("kills", {"netid": killer, "kills": 1}),
+        events.format_event("died", {"netid": victim}),
+        events.format_event("version", {"version": leaderboard.version, "etag": leaderboard.etag}),
+    ]
+    # nothing new, nothing sent
+    broker.publish("g")
+    assert subscriber.empty()
+    broker.unsubscribe("g", subscriber)
+    assert broker.subscriber_count() == 0
+
+
+def test_slow_subscriber_is_asked_to_reload(monkeypatch):
+    monkeypatch.setattr(events, "SUBSCRIBER_BUFFER", 2)
+    broker = events.LeaderboardBroker(app.get_leaderboard)
+    monkeypatch.setattr(broker, "_start_watcher", lambda: None)
+    make_game("g", 6)
+    subscriber = broker.subscribe("g")
+    app.killed_target("g", next(iter(app.get_game_state("g").alive)))
+    broker.publish("g")
+    assert subscriber.get_nowait() == events.format_event("reload", {})
+    assert subscriber.empty()
+
+
+def test_streams_are_refused_by_sync_workers(client, monkeypatch):
+    make_game("g", 4)
+    monkeypatch.setattr(events, "STREAMS", None)
+    assert client.get("/api/game-players/g/stream").status_code == 503
+
+    monkeypatch.setattr(events, "STREAMS", "true")
+    assert client.get("/api/game-players/missing/stream").status_code == 404
+    response = client.get("/api/game-players/g/stream")
+    assert response.status_code == 200 and response.mimetype == "text/event-stream"
+    assert next(response.response) == b"retry: 5000\n\n"
+    response.close()
+
+
+# -----------------------------------------------------------------
+# Metrics
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram("test_seconds", "Test latencies", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, endpoint="a")
+    histogram.observe(0.01, endpoint='b"')
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP test_seconds Test latencies", "# TYPE test_seconds histogram"]
+    assert 'test_seconds_bucket{endpoint="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{endpoint="a",le="1"} 3' in lines
+    assert 'test_seconds_bucket{endpoint="a",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{endpoint="a"} 4.250000' in lines
+    assert 'test_seconds_count{endpoint="a"} 4' in lines
+    assert 'test_seconds_count{endpoint="b\\""} 1' in lines
+
+
+def test_counter_counts_per_label_set():
+    counter = metrics.Counter("test_total", "Test events")
+    counter.inc(outcome="sent")
+    counter.inc(2, outcome="sent")
+    counter.inc(outcome="failed")
+    assert counter.render()[2:] == ['test_total{outcome="failed"} 1', 'test_total{outcome="sent"} 3']
+
+
+def test_requests_are_timed_with_their_db_round_trips(client, db_info):
+    make_game("g", 4)
+    assert client.get("/metrics").status_code == 401
+
+    def scrape():
+        """ {series: value} of this process's metrics, which earlier tests added to"""
+        body = client.get("/metrics?api_key=" + db_info.ADMIN_API_KEY).get_data(as_text=True)
+        return dict(line.rsplit(" ", 1) for line in body.splitlines() if not line.startswith("#"))
+
+    before = scrape()
+    for _ in range(3):
+        client.get("/api/game-players/g")
+    after = scrape()
+
+    def added(series):
+        return float(after[series]) - float(before.get(series, 0))
+
+    endpoint = '{endpoint="get_game_players_info"}'
+    assert added(f"assassin_request_seconds_count{endpoint}") == 3
+    assert added(f"assassin_request_db_round_trips_count{endpoint}") == 3
+    # the version check of each read at least
+    assert added(f"assassin_request_db_round_trips_sum{endpoint}") >= 3
+    assert added('assassin_db_operations_total{collection="games",operation="find_one"}') >= 3
+    assert after['assassin_outbox_jobs{status="pending"}'] == "0"
+
+
+# -----------------------------------------------------------------
+# Game cache
+
+def cached_game(name: str, version):
+    game = GameState(name, kills=dict.fromkeys(["a", "b", "c"], 0))
+    game.set_ring(["a", "b", "c"])
+    game.extra["version"] = version
+    return game
+
+
+def test_game_cache_serves_only_the_current_version():
+    cache = GameStateCache(max_games=2)
+    cache.put(cached_game("g", 1))
+    assert cache.get("g", 2) is None
+    game = cache.get("g", 1)
+    game.kill("a")
+    # a copy, the cached game is untouched
+    assert cache.get("g", 1).is_alive("b")
+
+    cache.put(cached_game("h", 1))
+    cache.put(cached_game("i", 1))
+    assert cache.get("g", 1) is None
+    assert cache.stats()["size"] == 2
+
+
+def test_game_cache_advances_by_one_version():
+    cache = GameStateCache()
+    cache.put(cached_game("g", 1))
+    cache.advance("g", 2, lambda game: game.kill("a") == "b")
+    assert not cache.get("g", 2).is_alive("b")
+    # a skipped version or a change that does not apply drops the entry
+    cache.advance("g", 4, lambda game: None)
+    assert cache.get("g", 4) is None and cache.get("g", 2) is None
+    cache.put(cached_game("g", 1))
+    cache.advance("g", 2, lambda game: False)
+    assert cache.get("g", 2) is None
+
+
+def test_game_state_is_reloaded_only_when_the_version_changed():
+    make_game("g", 6)
+    app.get_game_state("g")
+    hits = app.game_cache.hits
+    killer = next(iter(app.get_game_state("g").alive))
+    victim = app.killed_target("g", killer)
+    game = app.get_game_state("g")
+    assert app.game_cache.hits == hits + 2
+    assert not game.is_alive(victim)
+
+    # a write made by another worker
+    db.get_collection("games").update_one({"name": "g"}, {"$inc": {"version": 1}})
+    app.get_game_state("g")
+    assert app.game_cache.hits == hits + 2
+
+
+# -----------------------------------------------------------------
+# Kill log
+
+def play(game_name: str, rounds=6):
+    """ Kills, an unalive, a join, a shuffle and a batch of kills through the app"""
+    for _ in range(rounds):
+        app.killed_target(game_name, next(iter(app.get_game_state(game_name).alive)))
+    app.unalive_player(game_name, next(iter(app.get_game_state(game_name).alive)))
+    app.new_player("late1", "Late Comer", email="late1@example.com")
+    assert app.add_players_to_game(game_name, ["late1"])["added"] == ["late1"]
+    app.shuffle_game(game_name)
+    game = app.get_game_state(game_name)
+    killer = next(iter(game.alive))
+    victim = game.target_of(killer)
+    assert isinstance(app.killed_targets(game_name, [killer, [killer, game.target_of(victim)]]), list)
+
+
+@pytest.mark.parametrize("layout", ["document", "memberships"])
+def test_rebuild_replays_the_game(layout):
+    make_game("g", 20, layout)
+    play("g")
+    game = app.get_game_state("g")
+    assert_ring(game)
+    rebuilt = kill_log.rebuild("g")
+    assert_same_game(rebuilt, game)
+    assert rebuilt.extra["version"] == game.extra["version"]
+
+
+def test_rebuild_at_an_earlier_version():
+    make_game("g", 10)
+    first = app.killed_target("g", next(iter(app.get_game_state("g").alive)))
+    version = app.get_game_state("g").extra["version"]
+    app.killed_target("g", next(iter(app.get_game_state("g").alive)))
+    earlier = kill_log.rebuild("g", seq=version)
+    assert list(earlier.dead) == [first]
+    assert kill_log.rebuild("g", seq=version + 5) is None
+
+
+def test_undo_last_kill():
+    make_game("g", 8)
+    game = app.get_game_state("g")
+    killer = next(iter(game.alive))
+    victim = app.killed_target("g", killer)
+    undone = app.undo_last_kill("g")
+    assert (undone["data"]["killer"], undone["data"]["victim"]) == (killer, victim)
+
+    game = app.get_game_state("g")
+    assert game.is_alive(victim) and game.target_of(killer) == victim
+    assert game.kills[killer] == 0
+    assert_ring(game)
+    assert_same_game(kill_log.rebuild("g"), game)
+    assert app.undo_last_kill("g") == "No kill to undo in g"
+
+
+def test_undo_takes_back_a_batch_one_kill_at_a_time():
+    make_game("g", 8)
+    game = app.get_game_state("g")
+    killer = next(iter(game.alive))
+    applied = app.killed_targets("g", [killer, killer])
+    assert app.undo_last_kill("g")["data"] == applied[1]
+    assert app.undo_last_kill("g")["data"] == applied[0]
+    assert not app.get_game_state("g").dead
+    assert_same_game(kill_log.rebuild("g"), app.get_game_state("g"))
+
+
+def test_undo_refused_when_a_later_kill_was_not_recorded():
+    make_game("g", 8)
+    first_killer = next(iter(app.get_game_state("g").alive))
+    app.killed_target("g", first_killer)
+    second_killer = next(iter(app.get_game_state("g").alive))
+    app.killed_target("g", second_killer)
+    version = app.get_game_state("g").extra["version"]
+    # as if the process died between the game update and its event
+    kill_log.events_collection().delete_one({"game": "g", "seq": version})
+
+    result = app.undo_last_kill("g")
+    assert isinstance(result, app.Conflict)
+    assert app.get_game_state("g").extra["version"] == version
+    assert kill_log.last_kill("g", through=version)["data"]["killer"] == first_killer
+
+
+def test_batch_kills_are_all_or_nothing():
+    make_game("g", 6)
+    game = app.get_game_state("g")
+    killer = next(iter(game.alive))
+    result = app.killed_targets("g", [killer, [killer, killer]])
+    assert isinstance(result, str) and not isinstance(result, app.Conflict)
+    assert result.startswith("Kill 1")
+    assert not app.get_game_state("g").dead
+
+
+# -----------------------------------------------------------------
+# Memberships layout
+
+def test_memberships_game_reads_like_a_document_game():
+    make_game("g", 12, "memberships")
+    assert memberships.uses_memberships(db.games_collection().find_one({"name": "g"}))
+    assert db.get_collection("memberships").count_documents({"game": "g"}) == 12
+    victims = []
+    for _ in range(3):
+        game = app.get_game_state("g")
+        victims.append(app.killed_target("g", next(iter(game.alive))))
+    app.game_cache.clear()
+    game = app.get_game_state("g")
+    assert list(game.dead) == victims
+    assert_ring(game)
+
+    rows = memberships.leaderboard_rows("g")
+    assert [kills for _, kills, _ in rows] == sorted((kills for _, kills, _ in rows), reverse=True)
+    assert {netid for netid, _, alive in rows if not alive} == set(victims)
+
+
+def test_memberships_keep_the_order_deaths_happened_in():
+    make_game("g", 10, "memberships")
+    game = app.get_game_state("g")
+    victims = sorted(game.alive, reverse=True)[:3]
+    for victim in victims:
+        app.killed_target("g", app.get_game_state("g").hunter_of(victim))
+    # one write kills a player and then their killer, who sorts first
+    game = app.get_game_state("g")
+    a = next(a for a in game.alive if game.target_of(a) < game.target_of(game.target_of(a)))
+    b = game.target_of(a)
+    applied = app.killed_targets("g", [[b, game.target_of(b)], [a, b]])
+    victims += [kill["victim"] for kill in applied]
+    # read back from the memberships, not the cached game
+    app.game_cache.clear()
+    assert list(app.get_game_state("g").dead) == victims
+    assert list(kill_log.rebuild("g").dead) == victims
+
+
+def test_migrate_keeps_the_game():
+    make_game("g", 10)
+    for _ in range(3):
+        app.killed_target("g", next(iter(app.get_game_state("g").alive)))
+    before = app.get_game_state("g")
+    assert memberships.migrate_game("g")
+    app.game_cache.clear()
+    after = app.get_game_state("g")
+    assert_same_game(after, before)
+
+    victim = app.killed_target("g", next(iter(after.alive)))
+    assert list(app.get_game_state("g").dead) == list(before.dead) + [victim]
+    assert_ring(app.get_game_state("g"))
+
+
+# -----------------------------------------------------------------
+# Outbox
+
+def test_send_email_is_queued_and_sent_by_the_outbox():
+    app.send_email("a@example.com", "Hi", "<p>hi</p>", text="hi")
+    assert outbox.get_transport().sent == []
+    assert outbox.queue_depth() == {"pending": 1, "sending": 0, "failed": 0}
+
+    assert outbox.drain_outbox() == 1
+    assert outbox.get_transport().sent == [{"to": "a@example.com", "subject": "Hi", "content": "<p>hi</p>", "text": "hi"}]
+    assert outbox.outbox_collection().find_one({})["status"] == "sent"
+    assert outbox.drain_outbox() == 0
+
+
+def test_failed_email_is_retried_with_backoff_then_given_up(monkeypatch):
+    monkeypatch.setattr(outbox, "MAX_ATTEMPTS", 2)
+    transport = outbox.get_transport()
+    transport.fail_next = 2
+    app.send_email("a@example.com", "Hi", "<p>hi</p>")
+
+    assert outbox.drain_outbox() == 1
+    job = outbox.outbox_collection().find_one({})
+    assert (job["status"], job["attempts"]) == ("pending", 1)
+    assert job["next_attempt_at"] > outbox._now()
+    # not due yet
+    assert outbox.drain_outbox() == 0
+
+    outbox.outbox_collection().update_one({}, {"$set": {"next_attempt_at": outbox._now()}})
+    assert outbox.drain_outbox() == 1
+    job = outbox.outbox_collection().find_one({})
+    assert (job["status"], job["attempts"]) == ("failed", 2)
+    assert job["last_error"] == "fake transport failure"
+    assert transport.sent == []
+
+
+def test_kill_queues_its_emails_after_the_kill():
+    make_game("g", 4)
+    game = app.get_game_state("g")
+    killer = next(iter(game.alive))
+    victim = app.killed_target("g", killer)
+    jobs = {job["to"]: job for job in outbox.outbox_collection().find({})}
+    assert jobs[f"{victim}@example.com"]["subject"] == "You Have Been Slain"
+    assert jobs[f"{killer}@example.com"]["subject"] == "Your New Target"
+    assert f"Player {app.get_game_state('g').target_of(killer)}" in jobs[f"{killer}@example.com"]["content"]
+
+
+def test_welcome_emails_tell_every_alive_player_their_target(monkeypatch):
+    monkeypatch.setattr(outbox.send_limiter, "rate", 0)
+    netids = make_game("g", 12)
+    lookups = []
+    get_players = app.get_players
+    monkeypatch.setattr(app, "get_players", lambda netids: lookups.append(netids) or get_players(netids))
+
+    report = app.send_welcome_emails("g", max_workers=4)
+    assert len(lookups) == 1
+    assert (report["total"], report["sent"], report["failed"]) == (12, 12, {})
+    game = app.get_game_state("g")
+    sent = {message["to"]: message for message in outbox.get_transport().sent}
+    assert len(sent) == 12
+    for netid in netids:
+        message = sent[f"{netid}@example.com"]
+        assert message["subject"] == "Your First Target"
+        assert f"Player {game.target_of(netid)}" in message["text"]
+
+
+def test_welcome_emails_that_fail_stay_queued(monkeypatch):
+    monkeypatch.setattr(outbox.send_limiter, "rate", 0)
+    make_game("g", 5)
+    outbox.get_transport().fail_next = 2
+    report = app.send_welcome_emails("g", max_workers=1)
+    assert report["sent"] == 3 and len(report["failed"]) == 2
+    assert outbox.queue_depth()["pending"] == 2
+
+
+def target_email(netid: str, target: str):
+    return (f"{netid}@example.com", "Your new target", f"<p>{target}</p>", target)
+
+
+def test_newer_target_email_replaces_the_pending_one():
+    assert outbox.enqueue_coalesced([target_email("a", "b"), target_email("c", "d")], "g") == 0
+    assert outbox.enqueue_coalesced([target_email("a", "e")], "g") == 1
+    outbox.enqueue_coalesced([target_email("a", "f")], "h")
+    jobs = {(job["game"], job["to"]): job for job in outbox.outbox_collection().find({})}
+    assert len(jobs) == 3
+    assert jobs[("g", "a@example.com")]["text"] == "e"
+
+    # they wait for newer versions before they are sent
+    assert outbox.drain_outbox() == 0
+    outbox.outbox_collection().update_many({}, {"$set": {"next_attempt_at": outbox._now()}})
+    assert outbox.drain_outbox() == 3
+    assert sorted(message["text"] for message in outbox.get_transport().sent) == ["d", "e", "f"]
+
+
+def test_rapid_kills_send_the_killer_one_target_email():
+    make_game("g", 8)
+    killer = next(iter(app.get_game_state("g").alive))
+    for _ in range(3):
+        app.killed_target("g", killer)
+    jobs = list(outbox.outbox_collection().find({"to": f"{killer}@example.com"}))
+    assert len(jobs) == 1
+    assert f"Player {app.get_game_state('g').target_of(killer)}" in jobs[0]["text"]
+
+
+def test_token_bucket_allows_a_burst_then_the_rate(monkeypatch):
+    clock = [100.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(outbox.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(outbox.time, "sleep", sleep)
+    bucket = outbox.TokenBucket(rate=10, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert sleeps == []
+    bucket.acquire()
+    assert sleeps == [pytest.approx(0.1)]
+    clock[0] += 1
+    for _ in range(3):
+        bucket.acquire()
+    assert len(sleeps) == 1
+
+
+def test_email_templates_escape_names_in_html():
+    player = {"fullAssassinName": "Ann"}
+    target = {"fullAssassinName": "<b>Bo</b> & co"}
+    subject, html, text = emails.render("new_target", player=player, target=target, welcome=False)
+    assert subject == "Your New Target"
+    assert "&lt;b&gt;Bo&lt;/b&gt; &amp; co" in html
+    assert "Your new target is: <b>Bo</b> & co" in text
+
+
+def test_concurrent_coalesced_enqueue_updates_the_pending_job(monkeypatch):
+    collection = outbox.outbox_collection()
+
+    class Racing:
+        """ Inserts the pending job of the recipient right before the first bulk write, like a concurrent enqueue"""
+        raced = False
+
+        def __getattr__(self, name):
+            return getattr(collection, name)
+
+        def bulk_write(self, requests, **kwargs):
+            if not Racing.raced:
+                Racing.raced = True
+                collection.insert_one({"coalesce_key": "target:g:a@example.com", "status": "pending",
+                                       "to": "a@example.com", "attempts": 0})
+                # both upserts saw no pending job and inserted one
+                raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "dup"}],
+                                      "nInserted": 0, "nMatched": 0, "nModified": 0, "nUpserted": 1,
+                                      "nRemoved": 0, "upserted": [{"index": 1}]})
+            return collection.bulk_write(requests, **kwargs)
+
+    monkeypatch.setattr(outbox, "outbox_collection", Racing)
+    assert outbox.enqueue_coalesced([target_email("a", "b")], "g") == 1
+    monkeypatch.undo()
+    jobs = list(collection.find({"coalesce_key": "target:g:a@example.com", "status": "pending"}))
+    assert len(jobs) == 1 and jobs[0]["text"] == "b"
+
+
+def test_failed_coalesced_job_gives_way_to_a_newer_one(monkeypatch):
+    monkeypatch.setattr(outbox.send_limiter, "rate", 0)
+    outbox.enqueue_coalesced([target_email("a", "b")], "g")
+    outbox.outbox_collection().update_many({}, {"$set": {"next_attempt_at": outbox._now()}})
+    job = outbox.claim_next_job()
+    # a kill while the first email is being sent
+    outbox.enqueue_coalesced([target_email("a", "c")], "g")
+    outbox.get_transport().fail_next = 1
+    assert outbox.process_job(job) is not None
+
+    statuses = {job["text"]: job["status"] for job in outbox.outbox_collection().find({})}
+    assert statuses == {"b": "coalesced", "c": "pending"}
+
+
+class FakeConnection:
+    """ An HTTPS connection whose next requests and responses fail as told"""
+    failures = []
+    requests = []
+
+    def __init__(self, host, timeout=None):
+        pass
+
+    def request(self, method, path, body=None, headers=None):
+        if FakeConnection.failures and FakeConnection.failures[0] == "request":
+            FakeConnection.failures.pop(0)
+            raise ConnectionResetError("closed by the server")
+        FakeConnection.requests.append(body)
+
+    def getresponse(self):
+        if FakeConnection.failures and FakeConnection.failures[0] == "response":
+            FakeConnection.failures.pop(0)
+            raise TimeoutError("read timed out")
+        return types.SimpleNamespace(status=202, read=lambda: b"")
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sendgrid_transport(monkeypatch, db_info):
+    monkeypatch.setattr(outbox.http.client, "HTTPSConnection", FakeConnection)
+    FakeConnection.failures = []
+    FakeConnection.requests = []
+    return outbox.SendGridTransport()
+
+
+def test_sendgrid_reconnects_when_the_request_did_not_go_out(sendgrid_transport):
+    FakeConnection.failures = ["request"]
+    assert sendgrid_transport.send("a@example.com", "Hi", "<p>hi</p>") == 202
+    assert len(FakeConnection.requests) == 1
+
+
+def test_sendgrid_does_not_resend_after_the_request_went_out(sendgrid_transport):
+    FakeConnection.failures = ["response"]
+    with pytest.raises(TimeoutError):
+        sendgrid_transport.send("a@example.com", "Hi", "<p>hi</p>")
+    assert len(FakeConnection.requests) == 1
+    # the next send opens a new connection
+    assert sendgrid_transport.send("a@example.com", "Hi", "<p>hi</p>") == 202
+
+
+# -----------------------------------------------------------------
+# Idempotency keys
+
+@pytest.fixture
+def idempotent_client():
+    """ A client of one idempotent route, and the list of the times it ran"""
+    flask_app = Flask("idempotency_test")
+    calls = []
+
+    @flask_app.route("/act/<name>", methods=["POST"])
+    @idempotency.idempotent
+    def act(name):
+        calls.append(name)
+        if request.args.get("fail"):
+            raise RuntimeError("failed")
+        return jsonify({"run": len(calls)}), request.args.get("status", 200, type=int)
+
+    flask_app.config["PROPAGATE_EXCEPTIONS"] = False
+    return flask_app.test_client(), calls
+
+
+def post(client, path, key=None, body=None):
+    return client.post(path, json=body, headers={idempotency.HEADER: key} if key else {})
+
+
+def test_idempotent_retry_replays_the_first_response(idempotent_client):
+    client, calls = idempotent_client
+    first = post(client, "/act/a", "k1", {"x": 1})
+    retry = post(client, "/act/a", "k1", {"x": 1})
+    assert retry.get_json() == first.get_json() == {"run": 1}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    # another worker has only the db record
+    idempotency.responses.clear()
+    assert post(client, "/act/a", "k1", {"x": 1}).get_json() == {"run": 1}
+    assert calls == ["a"]
+
+    assert post(client, "/act/a").get_json() == {"run": 2}
+    assert post(client, "/act/a").get_json() == {"run": 3}
+
+
+def test_idempotency_key_of_another_request(idempotent_client):
+    client, calls = idempotent_client
+    post(client, "/act/a", "k1", {"x": 1})
+    assert post(client, "/act/a", "k1", {"x": 2}).status_code == 422
+    assert post(client, "/act/b", "k1", {"x": 1}).status_code == 422
+    assert calls == ["a"]
+
+
+def test_idempotency_key_in_progress(idempotent_client):
+    client, calls = idempotent_client
+    assert idempotency.claim("k1", idempotency.fingerprint("POST", "/act/a", b"")) is None
+    response = post(client, "/act/a", "k1")
+    assert response.status_code == 409 and "still running" in response.get_json()
+    assert calls == []
+
+    # a claim that never got its response is refused, never run again
+    idempotency.idempotency_collection().update_one(
+        {"key": "k1"}, {"$set": {"created_at": datetime.now(timezone.utc) - timedelta(hours=1)}})
+    response = post(client, "/act/a", "k1")
+    assert response.status_code == 409 and "did not record its outcome" in response.get_json()
+    assert calls == []
+
+
+@pytest.mark.parametrize("query", ["?status=409", "?status=503", "?fail=1"])
+def test_idempotency_claim_released_for_retries(idempotent_client, query):
+    client, calls = idempotent_client
+    assert post(client, "/act/a" + query, "k1").status_code in (409, 500, 503)
+    assert post(client, "/act/a" + query, "k1").headers.get("Idempotent-Replayed") is None
+    assert len(calls) == 2
+
+
+def test_idempotent_response_not_stored_is_not_run_again(idempotent_client, monkeypatch):
+    client, calls = idempotent_client
+    collection = idempotency.idempotency_collection()
+
+    class Unwritable:
+        def __getattr__(self, name):
+            return getattr(collection, name)
+
+        def update_one(self, *args, **kwargs):
+            raise pymongo.errors.AutoReconnect("db down")
+
+    monkeypatch.setattr(idempotency, "idempotency_collection", Unwritable)
+    monkeypatch.setattr(idempotency.time, "sleep", lambda seconds: None)
+    assert post(client, "/act/a", "k1").status_code == 200
+    monkeypatch.undo()
+
+    assert post(client, "/act/a", "k1").headers["Idempotent-Replayed"] == "true"
+    idempotency.responses.clear()
+    assert post(client, "/act/a", "k1").status_code == 409
+    assert calls == ["a"]
@@ -17,6 +17,11 @@ import ivyLogoAssassin from './ivy_logo_assassin.png';
 // React imports
 import React, { useState, useEffect } from 'react';
 
+// the leaderboard is polled every POLL_INTERVAL_MS. Build with REACT_APP_LIVE_LEADERBOARD=true
+// to stream its changes instead, from an API served by gevent workers (see backend/events.py)
+const LIVE_LEADERBOARD = process.env.REACT_APP_LIVE_LEADERBOARD === 'true';
+const POLL_INTERVAL_MS = 15000;
+
 const darkTheme = createTheme({
   palette: {
     mode: 'dark',
@@ -28,18 +33,77 @@ function App() {
   const API_URL = 'https://assassin-api.onrender.com';
   // const API_URL = 'http://127.0.0.1:5000'; // For local testing
   
-  const gameName = 'ivy';
+  // the game to show comes from the URL, e.g. ?game=ivy
+  const gameName = new URLSearchParams(window.location.search).get('game') || 'ivy';
 
   const [isLoading, setIsLoading] = React.useState(true);
   const [playerInfo, setPlayerInfo] = React.useState([]);
 
   React.useEffect(() => {
-    fetch(`${API_URL}/api/game-players/${gameName}`)
-      .then(response => response.json())
-      .then(players => {
-        setPlayerInfo(players);
-        setIsLoading(false);
-      });
+    let etag = null;
+    const loadPlayers = () => {
+      // no-cache has the browser revalidate its copy with the ETag, so an unchanged
+      // leaderboard is a 304 and is not parsed and sorted again
+      fetch(`${API_URL}/api/game-players/${gameName}`, { cache: 'no-cache' })
+        .then(response => {
+          const responseEtag = response.headers.get('ETag');
+          if (responseEtag !== null && responseEtag === etag) {
+            return null;
+          }
+          etag = responseEtag;
+          return response.json();
+        })
+        .then(players => {
+          if (players !== null) {
+            setPlayerInfo(players);
+          }
+          setIsLoading(false);
+        });
+    };
+    loadPlayers();
+
+    let poll = null;
+    const startPolling = () => {
+      if (poll === null) {
+        poll = setInterval(loadPlayers, POLL_INTERVAL_MS);
+      }
+    };
+    if (!LIVE_LEADERBOARD) {
+      startPolling();
+      return () => clearInterval(poll);
+    }
+
+    // live updates: patch the leaderboard instead of refetching it
+    const updatePlayer = (netid, changes) => {
+      setPlayerInfo(players => players
+        .map(player => player.netid === netid ? { ...player, ...changes } : player)
+        .sort((a, b) => b.kills - a.kills));
+    };
+    const stream = new EventSource(`${API_URL}/api/game-players/${gameName}/stream`);
+    stream.addEventListener('kills', event => {
+      const { netid, kills } = JSON.parse(event.data);
+      updatePlayer(netid, { kills });
+    });
+    stream.addEventListener('died', event => {
+      const { netid } = JSON.parse(event.data);
+      updatePlayer(netid, { isAlive: false });
+    });
+    stream.addEventListener('revived', event => {
+      const { netid } = JSON.parse(event.data);
+      updatePlayer(netid, { isAlive: true });
+    });
+    stream.addEventListener('joined', loadPlayers);
+    stream.addEventListener('reload', loadPlayers);
+    // a server that does not serve streams answers 503, and the browser gives up on it
+    stream.onerror = () => {
+      if (stream.readyState === EventSource.CLOSED) {
+        startPolling();
+      }
+    };
+    return () => {
+      stream.close();
+      clearInterval(poll);
+    };
   }, []);
 
 
@@ -50,9 +114,7 @@ function App() {
       .then(data => setMessage(data));
   }, []);
 
-  // sort by most kills
-  playerInfo.sort((a, b) => b.kills - a.kills);
-
+  // the API sends the players sorted by most kills
 
   return (
     <ThemeProvider theme={darkTheme}>